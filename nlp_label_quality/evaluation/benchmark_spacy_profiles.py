@@ -0,0 +1,92 @@
+"""
+Benchmark the spacy pipeline profiles
+
+Loads the spacy model once with the full pipeline and once with the components the analysis_options of TkDataModel
+need. For both profiles the load time and the parse throughput over the preprocessed labels of the selected attributes
+are reported; the AttributeValue fields the analysis reads (tokens, lemmas, POS tags) are compared to the full
+pipeline.
+
+Start from the folder nlp_label_quality/ (relative data paths):
+    python -m evaluation.benchmark_spacy_profiles <log.xes> <attribute> [<attribute> ...] [--repeat 3]
+"""
+from nlp_label_quality.model.model import TkDataModel
+from nlp_label_quality.analysis.label_utils import preprocess_value
+from nlp_label_quality.analysis.nlp_models import SpaCyModel, select_spacy_components
+
+from evaluation.compare_quantization import load_attribute_content
+
+from typing import Dict, List, Tuple, Union
+from tkinter import filedialog
+import argparse
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def analysis_fields(docs: List['Doc']) -> List[Tuple[List[str], List[str], List[str]]]:
+    """
+    Fields of AttributeValue.init_nlp that the analysis reads
+    """
+    fields = []
+    for doc in docs:
+        tokens = [token.text for token in doc if (not token.is_stop) and (not token.is_oov)]
+        lemmas = [token.lemma_ if token.lemma_ != '-PRON-' else token.lower_ for token in doc if (not token.is_oov) and (not token.is_stop)]
+        pos_tags = [token.pos_ for token in doc]
+        fields.append((tokens, lemmas, pos_tags))
+    return fields
+
+
+def benchmark_profile(profile: Union[str, List[str]], labels: List[str], repeat: int) -> Tuple[Dict[str, float], list]:
+    """
+    Load time and parse time of one profile
+
+    Returns
+    -------
+    timings, fields
+        {'load', 'parse', 'per_label'} in seconds (parse is the fastest of all repetitions), analysis fields per label
+    """
+    tic = time.perf_counter()
+    nlp = SpaCyModel('spacy', profile=profile, n_process=1)
+    load_time = time.perf_counter() - tic
+
+    parse_time, docs = float('inf'), []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        docs = list(nlp.pipe(labels))
+        parse_time = min(parse_time, time.perf_counter() - tic)
+    timings = {'load': load_time,
+               'parse': parse_time,
+               'per_label': parse_time / len(labels) if labels else 0.0}
+    return timings, analysis_fields(docs)
+
+
+def main(log_file: str, attribute_keys: List[str], repeat: int = 3) -> None:
+    model = TkDataModel()
+    attribute_content = load_attribute_content(log_file, attribute_keys)
+    labels = [preprocess_value(value) for values in attribute_content.values() for value in values]
+    components = select_spacy_components(model.analysis_options)
+
+    full_timings, full_fields = benchmark_profile('full', labels, repeat)
+    selected_timings, selected_fields = benchmark_profile(components, labels, repeat)
+    equal = sum(1 for full, selected in zip(full_fields, selected_fields) if full == selected)
+
+    print(f'\n{len(labels)} labels, components needed by the analysis_options: {components}')
+    for name, timings in [('full', full_timings), ('analysis', selected_timings)]:
+        print(f'{name:>8}: load {timings["load"]:.3f}s | parse {timings["parse"]:.3f}s '
+              f'({timings["per_label"] * 1e6:.1f} µs per label)')
+    print(f'speedup: load {full_timings["load"] / max(selected_timings["load"], 1e-9):.2f}x, '
+          f'parse {full_timings["parse"] / max(selected_timings["parse"], 1e-9):.2f}x')
+    print(f'identical tokens, lemmas and POS tags for {equal}/{len(labels)} labels')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the spacy pipeline profiles')
+    parser.add_argument('log_file', nargs='?', help='.xes event log, a file dialog opens if it is missing')
+    parser.add_argument('attributes', nargs='*', default=['concept:name'], help='attributes to analyse')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions of the parse measurement')
+    args = parser.parse_args()
+
+    log_file = args.log_file or filedialog.askopenfilename(title='Select a File ...',
+                                                           filetypes=(("eventlog files", "*.xes"), ("all files", ".*")))
+    main(log_file, args.attributes or ['concept:name'], args.repeat)
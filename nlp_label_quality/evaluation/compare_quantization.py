@@ -0,0 +1,177 @@
+"""
+Compare the analysis steps in full and in quantized precision
+
+Runs all analysis_options of TkDataModel on the selected attributes of an event log, first with full precision
+vectors and afterwards with the quantized vector backend. For each step the drift of the similarity scores,
+the agreement of the results above the step threshold and the runtime are reported, followed by the size of the
+vector tables in both precisions and the resident memory of the process after each run.
+
+Start from the folder nlp_label_quality/ (relative data paths):
+    python -m evaluation.compare_quantization <log.xes> <attribute> [<attribute> ...] [--mode int8]
+"""
+from nlp_label_quality.model.model import TkDataModel
+from nlp_label_quality.analysis import analysis_utils, matrix_eval
+from nlp_label_quality.analysis.analysis import AnalysisModule
+from nlp_label_quality.analysis.attribute_value import Attribute
+from nlp_label_quality.analysis.nlp_models import GloVeModel, SpaCyModel
+from nlp_label_quality.analysis.quantization import QUANTIZATION_MODES, QuantizedVectors, quantization_report
+
+import numpy as np
+
+from typing import Dict, List, Set, Tuple, Union
+from tkinter import filedialog
+import argparse
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def load_attribute_content(log_file: str, attributes: List[str]) -> Dict[str, Dict[str, int]]:
+    """
+    Import and preprocess the log exactly as the tool does
+
+    Parameters
+    ----------
+    log_file
+        filepath of the .xes event log
+    attributes
+        attributes to be analysed
+
+    Returns
+    -------
+    attribute_content
+        {attr1: {'attr_value1': count, ...}, attr2: ...}
+    """
+    model = TkDataModel()
+    model.filename = log_file
+    model.import_log()
+    model.selected_attributes = attributes
+    model.preprocess_log()
+    return model.attribute_content
+
+
+def run_steps(attributes: List[Attribute],
+              analysis_options: List[Union[List[str], List[List[str]]]]) -> Tuple[Dict[str, Dict[str, List[np.ndarray]]], Dict[str, float]]:
+    """
+    Build the similarity matrices of every analysis step for all attributes
+
+    Returns
+    -------
+    step_matrices, step_times
+        {step name: {attribute: matrices}}, {step name: seconds}
+    """
+    step_matrices, step_times = {}, {}
+    for index, options in enumerate(analysis_options):
+        name = str(index)
+        multiple = AnalysisModule._check_content_of_options(options)
+        tic = time.perf_counter()
+        analysis_utils.generate_sim_matrices(multiple, attributes, name, options)
+        toc = time.perf_counter()
+        step_matrices[name] = {attribute.attr: [np.array(matrix, dtype=np.float64) for matrix in attribute.matrix_content[name]]
+                               for attribute in attributes}
+        step_times[name] = toc - tic
+    return step_matrices, step_times
+
+
+def _pairs_above_threshold(matrix: np.ndarray, threshold: float) -> Set[Tuple[int, int]]:
+    indices, _ = matrix_eval.get_results_from_matrix(matrix, threshold)
+    return set(map(tuple, indices))
+
+
+def compare_steps(full: Dict[str, Dict[str, List[np.ndarray]]],
+                  quantized: Dict[str, Dict[str, List[np.ndarray]]],
+                  thresholds: List[float]) -> Dict[str, Dict[str, float]]:
+    """
+    Score drift and result agreement per step
+
+    Returns
+    -------
+    drift
+        {step name: {'max_abs_drift', 'mean_abs_drift', 'results_full', 'results_quantized', 'results_shared'}}
+    """
+    drift = {}
+    for (name, full_attributes), threshold in zip(full.items(), thresholds):
+        max_drift, sum_drift, cells = 0.0, 0.0, 0
+        results_full, results_quantized, results_shared = 0, 0, 0
+        for attr, full_matrices in full_attributes.items():
+            for full_matrix, quantized_matrix in zip(full_matrices, quantized[name][attr]):
+                difference = np.abs(full_matrix - quantized_matrix)
+                if difference.size:
+                    max_drift = max(max_drift, float(difference.max()))
+                    sum_drift += float(difference.sum())
+                    cells += difference.size
+                pairs_full = _pairs_above_threshold(full_matrix, threshold)
+                pairs_quantized = _pairs_above_threshold(quantized_matrix, threshold)
+                results_full += len(pairs_full)
+                results_quantized += len(pairs_quantized)
+                results_shared += len(pairs_full & pairs_quantized)
+        drift[name] = {'max_abs_drift': max_drift,
+                       'mean_abs_drift': sum_drift / cells if cells else 0.0,
+                       'results_full': results_full,
+                       'results_quantized': results_quantized,
+                       'results_shared': results_shared}
+    return drift
+
+
+def resident_bytes() -> Union[None, int]:
+    """
+    Resident memory of this process (None where /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def main(log_file: str, attribute_keys: List[str], mode: str = 'int8') -> None:
+    model = TkDataModel()
+    attribute_content = load_attribute_content(log_file, attribute_keys)
+    nlp, glove = SpaCyModel('spacy'), GloVeModel('glove')
+    attributes = [Attribute(attr, values, nlp, glove) for attr, values in attribute_content.items()]
+
+    # tables are compared before switching, the quantized backend releases or memory-maps the full precision ones
+    reports = {'glove': quantization_report(glove.full_model.vectors, QuantizedVectors(glove.full_model.vectors, mode)),
+               'spacy': quantization_report(nlp.model.vocab.vectors.data,
+                                            QuantizedVectors(nlp.model.vocab.vectors.data, mode))}
+
+    full_matrices, full_times = run_steps(attributes, model.analysis_options)
+    full_resident = resident_bytes()
+    nlp.set_quantization(mode)
+    glove.set_quantization(mode)
+    quantized_matrices, quantized_times = run_steps(attributes, model.analysis_options)
+    quantized_resident = resident_bytes()
+    drift = compare_steps(full_matrices, quantized_matrices, model.analysis_thresholds)
+
+    print(f'\nScore drift and speed per analysis step ({mode} against full precision):')
+    for name, options in zip(drift, model.analysis_options):
+        step_drift = drift[name]
+        speedup = full_times[name] / quantized_times[name] if quantized_times[name] else float('inf')
+        print(f'step {name} {options}\n'
+              f'    drift max {step_drift["max_abs_drift"]:.5f}, mean {step_drift["mean_abs_drift"]:.6f} | '
+              f'results full {step_drift["results_full"]}, quantized {step_drift["results_quantized"]}, '
+              f'shared {step_drift["results_shared"]} | '
+              f'time full {full_times[name]:.3f}s, quantized {quantized_times[name]:.3f}s ({speedup:.2f}x)')
+
+    print('\nSize of the vector tables:')
+    for name, report in reports.items():
+        print(f'{name}: full {report["full_bytes"]} bytes, {mode} {report["quantized_bytes"]} bytes '
+              f'({report["compression"]:.2f}x smaller), reconstruction error max {report["max_abs_error"]:.5f}, '
+              f'mean {report["mean_abs_error"]:.6f}')
+    if full_resident is not None:
+        print(f'\nResident memory of the process: {full_resident} bytes after the full precision run, '
+              f'{quantized_resident} bytes after the {mode} run')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare analysis results in full and quantized precision')
+    parser.add_argument('log_file', nargs='?', help='.xes event log, a file dialog opens if it is missing')
+    parser.add_argument('attributes', nargs='*', default=['concept:name'], help='attributes to analyse')
+    parser.add_argument('--mode', choices=QUANTIZATION_MODES, default='int8')
+    args = parser.parse_args()
+
+    log_file = args.log_file or filedialog.askopenfilename(title='Select a File ...',
+                                                           filetypes=(("eventlog files", "*.xes"), ("all files", ".*")))
+    main(log_file, args.attributes or ['concept:name'], args.mode)
@@ -4,6 +4,7 @@ from nlp_label_quality.custom_errors import IncorrectOptionTypeError, IncorrectO
 
 from typing import List, Dict, Tuple, Any, Union
 from nlp_label_quality.analysis.attribute_value import Attribute, AttributeValue
+from nlp_label_quality.analysis.matrix_storage import Matrix, max_matrix
 from nlp_label_quality.analysis.nlp_models import GloVeModel, SpaCyModel
 
 import numpy as np
@@ -13,6 +14,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+COMBINED_THRESHOLD = 0.75  # fixed threshold of the max matrix of combined options
+
 
 class Analysis(ABC):
     def __init__(self, name: str, controller: 'Controller') -> None:
@@ -42,6 +45,8 @@ class AnalysisModule(Analysis):
         configuration under which the results are filtered
     controller
         main controller for the full program
+    session
+        state shared by all analysis steps of the log (execution resources, score memo, kept Attributes)
     """
 
     def __init__(self,
@@ -50,16 +55,18 @@ class AnalysisModule(Analysis):
                  nlp: SpaCyModel,
                  glove: GloVeModel,
                  options: Union[List[str], List[List[str]]],  # both single options and multiple options have to work
-                 thresholds: Union[float, List[float]]) -> None:  # accordingly thresholds as well
+                 thresholds: Union[float, List[float]],  # accordingly thresholds as well
+                 session: 'AnalysisSession' = None) -> None:
         super().__init__(name, controller)
         self.nlp = nlp
         self.glove = glove
+        self.session = session
         self.options = options
         self.thresholds = thresholds
 
         self.attributes = []
         self.treeview_headers = self.controller.get_treeview_headers()
-        self.antonym_library = analysis_utils.get_antonyms_from_verbocean()
+        self.antonym_library = self.controller.get_antonym_library()
 
     def start(self,
               attribute_content: Dict[str, Dict[str, int]]) -> Dict[int, Dict[str, Union[str, int, float]]]:
@@ -94,8 +101,11 @@ class AnalysisModule(Analysis):
             content to be analyzed {attr1: {'attr_value1': count, ...}, attr2: ...}
         """
         tic = time.perf_counter()
-        for attr, values in attribute_content.items():
-            self.attributes.append(Attribute(attr, values, self.nlp, self.glove))
+        if self.session is not None:  # Attributes of former steps are updated (incremental mode)
+            self.attributes = self.session.get_attributes(attribute_content)
+        else:
+            for attr, values in attribute_content.items():
+                self.attributes.append(Attribute(attr, values, self.nlp, self.glove, self.session))
         toc = time.perf_counter()
         logger.info(f'AttributeValue instances were initialized in {toc - tic} seconds')
 
@@ -125,7 +135,15 @@ class AnalysisModule(Analysis):
             result selection filtered with thresholds and prepared to be used in
         """
         bool_mulitple_options = self._check_content_of_options(options)
-        analysis_utils.generate_sim_matrices(bool_mulitple_options, attributes, name, options)
+        # single options are filtered by their threshold, combined options by the fixed threshold of the max matrix
+        min_score = None if bool_mulitple_options else thresholds
+        result_threshold = COMBINED_THRESHOLD if bool_mulitple_options else thresholds
+        # sparse results keep only the scores that can pass the threshold of this step
+        floor = result_threshold if self.session is not None and self.session.sparse_results else None
+        # combined options are maximised row by row without the matrix of every option (fused)
+        fused = bool_mulitple_options and self.session is not None and self.session.fused_max
+        analysis_utils.generate_sim_matrices(bool_mulitple_options, attributes, name, options, min_score, floor,
+                                             fused, result_threshold)
         # get the just created matrices to work with them
         all_sim_matrices = {attribute: attribute.matrix_content for attribute in self.attributes}
 
@@ -133,8 +151,9 @@ class AnalysisModule(Analysis):
             max_matrices = self.generate_max_matrix_per_attribute()
             logger.info('For the combination of analysis modules, the options cannot be output and the threshold is fixed.')
             repair_selection_dict = analysis_utils.get_result_selection(bool_mulitple_options, max_matrices,
-                                                                        ['combined_options', 'max_combined', 'spacy_lemmas', 'max'], 0.75,
-                                                                        self.treeview_headers, self.antonym_library)
+                                                                        ['combined_options', 'max_combined', 'spacy_lemmas', 'max'], COMBINED_THRESHOLD,
+                                                                        self.treeview_headers, self.antonym_library,
+                                                                        name, options)
 
         else:
             repair_selection_dict = analysis_utils.get_result_selection(bool_mulitple_options, all_sim_matrices,
@@ -189,9 +208,10 @@ class AnalysisModule(Analysis):
         else:
             raise IncorrectOptionTypeError(options)
 
-    def generate_max_matrix_per_attribute(self) -> Dict[Attribute, Dict[str, List[np.ndarray]]]:
+    def generate_max_matrix_per_attribute(self) -> Dict[Attribute, Dict[str, List[Matrix]]]:
         """
         Return the matrix where from all models only the highest values are saved, only works after all matrices were calculated
+        -> sparse matrices are combined without densifying them, fused steps already hold their max matrix
 
         Returns
         -------
@@ -201,12 +221,10 @@ class AnalysisModule(Analysis):
         max_matrices = {}
         for attribute in self.attributes:  # this and the next line would have to change
             dim = len(attribute.attr_values)  # shape for the zeros matrix
-            max_matrix = np.zeros((dim, dim))
             result_matrix = {}
-            for name, matrices in attribute.matrix_content.items():
-                for i, matrix in enumerate(matrices):
-                    max_matrix = np.maximum(max_matrix, matrix)
-                result_matrix['max_matrix'] = [max_matrix]  # line only necessary to make it work with get_result_selectioin
+            matrices = attribute.matrix_content.get(self.name, [])  # only the matrices of this step
+            if matrices:
+                result_matrix['max_matrix'] = [max_matrix(matrices, dim)]  # line only necessary to make it work with get_result_selectioin
 
             max_matrices[attribute] = result_matrix
         return max_matrices
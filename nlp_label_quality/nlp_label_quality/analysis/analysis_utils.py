@@ -6,6 +6,7 @@ import pm4py
 from pm4py.objects.log.log import EventLog
 
 from nlp_label_quality.analysis import matrix_eval
+from nlp_label_quality.analysis.matrix_storage import Matrix
 
 from typing import Dict, List, Tuple, Union, Any
 from nlp_label_quality.analysis.attribute_value import Attribute, AttributeValue
@@ -50,7 +51,11 @@ def filter_log_on_given_level(log: EventLog,
 def generate_sim_matrices(bool_mulitple_options: bool,
                           attributes: List[Attribute],
                           name: str,
-                          options: Union[List[str], List[List[str]]]) -> None:
+                          options: Union[List[str], List[List[str]]],
+                          threshold: float = None,
+                          floor: float = None,
+                          fused: bool = False,
+                          result_threshold: float = None) -> None:
     """
     Calculate the similarity matrices for each attribute and save them within their instance in a dict
 
@@ -64,21 +69,34 @@ def generate_sim_matrices(bool_mulitple_options: bool,
         key for dict to get correct similarity_matrices back for different analysis purposes
     options
         list of options [model, name, attribute to look for, function]
+    threshold
+        threshold of a single option step, pairs that provably cannot exceed it may be skipped (None computes all)
+    floor
+        only the scores above it are kept (sparse matrices), dense matrices if None
+    fused
+        multiple options are combined row by row into their max matrix without the matrix of every option
+    result_threshold
+        threshold the results of fused multiple options are filtered with, the winning option is kept above it
     """
-    if bool_mulitple_options:
+    if bool_mulitple_options and fused:
+        for attribute in attributes:
+            attribute.build_max_matrix(name, options, floor, result_threshold)
+    elif bool_mulitple_options:
         for attribute in attributes:
-            attribute.build_sim_matrices(name, options)
+            attribute.build_sim_matrices(name, options, floor)
     else:
         for attribute in attributes:
-            attribute.build_sim_matrix(name, options)
+            attribute.build_sim_matrix(name, options, threshold, floor)
 
 
 def get_result_selection(bool_mulitple_options: bool,
-                         all_sim_matrices: Dict[Attribute, Dict[str, List[np.ndarray]]],
+                         all_sim_matrices: Dict[Attribute, Dict[str, List[Matrix]]],
                          options: Union[List[str], List[List[str]]],
                          thresholds: Union[float, List[float]],
                          treeview_headers: List[str],
-                         antonym_library) -> Dict[int, Dict[str, Union[str, int, float]]]:
+                         antonym_library,
+                         name: str = None,
+                         combined_options: List[List[str]] = None) -> Dict[int, Dict[str, Union[str, int, float]]]:
     """
     Return the results for all similarity matrices and taking the thresholds into account
 
@@ -87,7 +105,7 @@ def get_result_selection(bool_mulitple_options: bool,
     bool_mulitple_options
         boolean to decide how the results have to be analysed
     all_sim_matrices
-        -- missing --
+        dense matrices or SparseScores (only the scores above their floor) of each attribute
     options
         -- missing --
     thresholds
@@ -96,6 +114,10 @@ def get_result_selection(bool_mulitple_options: bool,
         headers that are used in tkinter treeview in order to make sure all needed values are present
     antonym_library
         set of antonyms by verbocean
+    name
+        name of the analysis step, the winning options of its fused max matrices are reported (multiple options)
+    combined_options
+        options of the combined analysis step the winning options refer to
 
     Returns
     -------
@@ -104,7 +126,8 @@ def get_result_selection(bool_mulitple_options: bool,
     """
     if bool_mulitple_options:
         repair_selection_dict = _get_result_selection_multiple_options(all_sim_matrices, options, thresholds,
-                                                                       treeview_headers, antonym_library)
+                                                                       treeview_headers, antonym_library,
+                                                                       name, combined_options)
     else:
         repair_selection_dict = _get_result_selection_single_option(all_sim_matrices, options, thresholds,
                                                                     treeview_headers, antonym_library)
@@ -156,12 +179,16 @@ def _get_result_selection_multiple_options(all_sim_matrices,
                                            options: List[List[str]],
                                            threshold: float,
                                            treeview_headers: List[str],
-                                           antonym_library) -> Dict[int, Dict[str, Union[str, int, float]]]:
+                                           antonym_library,
+                                           step_name: str = None,
+                                           combined_options: List[List[str]] = None) -> Dict[int, Dict[str, Union[str, int, float]]]:
     """
     IMPLEMENTATION FOR MULITPLE OPTIONS
+    -> results of a fused max matrix are reported with the option that scored them highest
     """
     repair_selection_dict, repair_id = {}, 0
     for attribute, matrix_content in all_sim_matrices.items():
+        winners = attribute.winning_options.get(step_name, {}) if combined_options else {}
         for name, matrices in matrix_content.items():
             for i, matrix in enumerate(matrices):
                 relevant_indices, relevant_values = matrix_eval.get_results_from_matrix(matrix, threshold)
@@ -171,7 +198,9 @@ def _get_result_selection_multiple_options(all_sim_matrices,
 
                     # antonym distinction, if there are any antonyms and skip selection
                     antonym_set = _check_antonymy(antonym_library, value1, value2)
-                    result_values = _get_repair_values_after_sorting(attribute, sim_score, value1, value2, options, threshold, antonym_set)
+                    winner = winners.get((int(index[0]), int(index[1])))
+                    result_options = combined_options[winner] if winner is not None else options
+                    result_values = _get_repair_values_after_sorting(attribute, sim_score, value1, value2, result_options, threshold, antonym_set)
 
                     # # relevant values for selection filtering
                     # str1, str2 = value1.orig_value, value2.orig_value
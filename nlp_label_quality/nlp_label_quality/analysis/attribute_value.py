@@ -1,8 +1,12 @@
 import spacy.tokens
 
 from nlp_label_quality.analysis.label_utils import preprocess_value
-from nlp_label_quality.analysis.sim_matrix import GloVeSimMatrix, SpaCySimMatrix, OpenGloVeSimMatrix, LevenshteinSimMatrix, TfIdfSimMatrix
+from nlp_label_quality.analysis import sim_utils
+from nlp_label_quality.analysis.sim_matrix import GloVeSimMatrix, SpaCySimMatrix, OpenGloVeSimMatrix, LevenshteinSimMatrix, TfIdfSimMatrix, \
+    MinHashSimMatrix
 from nlp_label_quality.analysis.nltk_utils import pos_tag_wordnet, get_nltk_synsets, get_nltk_data
+from nlp_label_quality.analysis.matrix_storage import Matrix, Writer, expand_matrix, new_writer, score_bound, \
+    subset_matrix
 
 import numpy as np
 
@@ -23,15 +27,24 @@ class Attribute:
     """
     __id = 0
 
-    def __init__(self, attr: str, values: Dict[str, int], nlp: SpaCyModel, glove: GloVeModel) -> None:
+    def __init__(self, attr: str, values: Dict[str, int], nlp: SpaCyModel, glove: GloVeModel,
+                 session: 'AnalysisSession' = None) -> None:
         logger.info(f'Attribute instance {attr} initializing ...')
         self.id: int = Attribute.__id
         self.attr: str = attr
         self.size: int = len(values)
         self.nlp: SpacyModel = nlp
         self.glove: GloVeModel = glove
+        self.session: 'AnalysisSession' = session  # execution resources for the similarity matrices
         self.attr_values: List['AttributeValue'] = self._initialize_attributevalue_classes(values)
-        self.matrix_content: Dict[str, List[np.ndarray]] = {}
+        self.matrix_content: Dict[str, List[Matrix]] = {}
+        # fused combined steps: index of the winning option per reported pair (i, j) {dict_name: {(i, j): option}}
+        self.winning_options: Dict[str, Dict[Tuple[int, int], int]] = {}
+        # incremental mode: matrices of pair-local functions {(sim_model, function, attr_property): (matrix, valid,
+        # bound)} are kept and updated after repairs instead of being rebuilt, they are exact above bound
+        self.keep_matrices: bool = session is not None and session.incremental
+        self.matrix_cache: Dict[Tuple[str, str, str],
+                                Tuple[Matrix, np.ndarray, Union[None, float]]] = {}
         Attribute.__id += 1
 
     def _initialize_attributevalue_classes(self, values: Dict[str, int]) -> List['AttributeValue']:
@@ -50,14 +63,67 @@ class Attribute:
         """
         tic = time.perf_counter()
         attr_values = []
+        # all labels are parsed in one batch stage first, the AttributeValues are filled from the resulting docs
+        docs = self.nlp.pipe([preprocess_value(attr_value) for attr_value in values])
         # attr{values{attr_value, count}}  -> level deeper where attribute is already filtered -> {attr_value, count}
-        for attr_value, count in values.items():
-            attr_values.append(AttributeValue(self.nlp, self.glove, attr_value, count))
+        for (attr_value, count), doc in zip(values.items(), docs):
+            attr_values.append(AttributeValue(self.nlp, self.glove, attr_value, count, doc))
         toc = time.perf_counter()
         logger.info(f'AttributeValue instances were initialized in {toc - tic} seconds')
         return attr_values
 
-    def build_sim_matrix(self, dict_name: str, options: List[str]) -> None:
+    def update_values(self, values: Dict[str, int]) -> None:
+        """
+        Incremental update after a repair: repaired-away values are dropped from the AttributeValues and from the rows
+        and columns of the kept matrices, the surviving values get their new (merged) counts and only genuinely new
+        labels are parsed; their rows and columns are computed with the next matrix of the same kind
+
+        Parameters
+        ----------
+        values: Dict[str, int]
+            all values that are included under this attribute after the repair
+        """
+        tic = time.perf_counter()
+        known = {attr_value.orig_value for attr_value in self.attr_values}
+        keep = np.array([i for i, attr_value in enumerate(self.attr_values) if attr_value.orig_value in values],
+                        dtype=np.int64)
+        survivors = [self.attr_values[i] for i in keep]
+        for attr_value in survivors:
+            attr_value.count = values[attr_value.orig_value]
+        new_values = {attr_value: count for attr_value, count in values.items() if attr_value not in known}
+
+        self.attr_values = survivors + self._initialize_attributevalue_classes(new_values)
+        self.size = len(self.attr_values)
+        self.matrix_content = {}  # indices of the results of former steps are not valid anymore
+        self.winning_options = {}
+        for key, (matrix, valid, bound) in self.matrix_cache.items():
+            matrix = subset_matrix(matrix, keep, len(new_values))
+            valid = np.concatenate([valid[keep], np.zeros(len(new_values), dtype=bool)])
+            self.matrix_cache[key] = (matrix, valid, bound)
+        toc = time.perf_counter()
+        logger.info(f'Attribute {self.attr} updated in {toc - tic} seconds: {len(known) - len(keep)} values removed, '
+                    f'{len(new_values)} values added')
+
+    def _get_previous_matrix(self, key: Tuple[str, str, str],
+                             bound: float = None) -> Union[None, Tuple[Matrix, np.ndarray]]:
+        """
+        Kept matrix that can be completed for the given bound (pruned pairs of a blocked matrix and pairs missing in a
+        sparse matrix are only known to not exceed its bound)
+        """
+        if key not in self.matrix_cache:
+            return None
+        matrix, valid, cached_bound = self.matrix_cache[key]
+        if cached_bound is not None and (bound is None or bound < cached_bound):
+            return None
+        return matrix, valid
+
+    def _keep_matrix(self, key: Tuple[str, str, str], sim_model: str, matrix: Matrix,
+                     bound: float = None) -> None:
+        if self.keep_matrices and sim_model in ('open', 'spacy', 'leven'):  # pair-local functions only
+            self.matrix_cache[key] = (matrix, np.ones(self.size, dtype=bool), bound)
+
+    def build_sim_matrix(self, dict_name: str, options: List[str], min_score: float = None,
+                         floor: float = None) -> None:
         """
         IMPLEMENTATION FOR SINGLE OPTIONS
         Initialize sim_matrices as a list containting multiple classes of different Similarity matrix classes
@@ -68,18 +134,18 @@ class Attribute:
             key for dict to get correct similarity_matrices back for different analysis purposes
         options: List[List[str]]
             list of options [model, name, attribute to look for, function]
+        min_score: float
+            threshold of the analysis step, pairs that provably cannot exceed it may be skipped (stay 0)
+        floor: float
+            only the scores above it are kept (SparseScores), dense matrices if None
         """
         matrices = []
 
-        sim_model, name, attr_property, function = options
-        attr_content = self._get_content(attr_property)
-
-        similarity_matrix_class = self._select_sim_matrix(sim_model, name, attr_content, function)
-        matrices.append(similarity_matrix_class.sim_matrix)  # only append the matrix itself
+        matrices.append(self._build_option_matrix(options, min_score, floor))  # only append the matrix itself
 
         self.matrix_content[dict_name] = matrices  # save the matrices within the instance
 
-    def build_sim_matrices(self, dict_name: str, options: List[List[str]]) -> None:
+    def build_sim_matrices(self, dict_name: str, options: List[List[str]], floor: float = None) -> None:
         """
         IMPLEMENTATION FOR MULITPLE OPTIONS
         Initialize sim_matrices as a list containting multiple classes of different Similarity matrix classes
@@ -90,17 +156,198 @@ class Attribute:
             key for dict to get correct similarity_matrices back for different analysis purposes
         options: List[List[str]]
             list of options [model, name, attribute to look for, function]
+        floor: float
+            only the scores above it are kept (SparseScores), dense matrices if None
         """
         matrices = []
 
         for i in range(len(options)):
-            sim_model, name, attr_property, function = options[i]
+            matrices.append(self._build_option_matrix(options[i], floor=floor))  # only append the matrix itself
+
+        self.matrix_content[dict_name] = matrices  # save the matrices within the instance
+
+    def _build_option_matrix(self, options: List[str], min_score: float = None, floor: float = None) -> Matrix:
+        """
+        Similarity matrix of one option; symmetric pair-local functions only score the unique contents of the values
+        (see _group_content) and broadcast the scores to the values afterwards
+        """
+        sim_model, name, attr_property, function = options
+        attr_content = self._get_content(attr_property)
+        key = (sim_model, function, attr_property)
+        bound = score_bound(min_score, floor)
+
+        groups = None
+        if self._dedupe_content(sim_model, function) and self._get_previous_matrix(key, bound) is None:
+            groups = self._group_content(sim_model, function, attr_content, attr_property)
+        if groups is not None:
+            unique_content, group_ids, group_scores = groups
+            similarity_matrix_class = self._select_sim_matrix(sim_model, name, unique_content, function, min_score,
+                                                              attr_property, floor)
+            matrix = expand_matrix(similarity_matrix_class.sim_matrix, group_ids, group_scores,
+                                   self._new_writer(True, floor))
+        else:
+            similarity_matrix_class = self._select_sim_matrix(sim_model, name, attr_content, function, min_score,
+                                                              attr_property, floor)
+            matrix = similarity_matrix_class.sim_matrix
+        self._keep_matrix(key, sim_model, matrix, bound)
+        return matrix
+
+    def _dedupe_content(self, sim_model: str, function: str) -> bool:
+        """
+        Only symmetric pair-local functions can score unique contents (tfidf and glove weights depend on the whole
+        content, levenshtein filter conditions depend on the query); identical strings are minhash candidates anyway
+        """
+        if self.session is None or not self.session.dedupe_content:
+            return False
+        if sim_model == 'minhash':
+            return True
+        elif sim_model == 'open':
+            return sim_utils._check_symmetry(self.glove, function)
+        elif sim_model == 'spacy':
+            return sim_utils._check_symmetry(self.nlp, function)
+        return False
+
+    def _group_content(self, sim_model: str, function: str, attr_content: Union[List[str], List[List[str]]],
+                       attr_property: str) -> Union[None, Tuple[Union[List[str], List[List[str]]], np.ndarray,
+                                                                  np.ndarray]]:
+        """
+        Group the values by identical content (e.g. values that only differ in case, underscores or dropped tokens)
+
+        Parameters
+        ----------
+        sim_model: str
+            model of the option (minhash, open or spacy)
+        function: str
+            function of the option, it scores two values of the same content
+        attr_content: Union[List[str], List[List[str]]]
+            content of every value
+        attr_property: str
+            property the content was taken from (logging purposes)
+
+        Returns
+        -------
+        groups: Union[None, Tuple[Union[List[str], List[List[str]]], np.ndarray, np.ndarray]]
+            unique contents in order of their first value, unique content of every value and score of two values with
+            the same content (see _same_content_scores); None if all contents are different
+        """
+        content_ids = {}
+        group_ids = np.array([content_ids.setdefault(tuple(content) if isinstance(content, list) else content,
+                                                     len(content_ids)) for content in attr_content], dtype=np.int64)
+        if len(content_ids) == len(attr_content):
+            return None
+        first_values = np.unique(group_ids, return_index=True)[1]
+        unique_content = [attr_content[i] for i in first_values]
+        group_scores = self._same_content_scores(sim_model, function, unique_content, group_ids)
+        logger.info(f'Attribute {self.attr}: {len(unique_content)} unique {attr_property} of {len(attr_content)} '
+                    f'values are scored')
+        return unique_content, group_ids, group_scores
+
+    def _same_content_scores(self, sim_model: str, function: str, unique_content: Union[List[str], List[List[str]]],
+                             group_ids: np.ndarray) -> np.ndarray:
+        """
+        Score of two values with the same content per unique content: f(x, x) of the option's function (e.g. 0 for
+        difference and min functions), only computed for contents shared by several values; identical token sets are
+        minhash candidates with Jaccard similarity 1.0
+        """
+        if sim_model == 'minhash':
+            return np.array([1.0 if len(content) else 0.0 for content in unique_content])
+        model = self.glove if sim_model == 'open' else self.nlp
+        shared = np.flatnonzero(np.bincount(group_ids, minlength=len(unique_content)) > 1)
+        shared_content = [unique_content[i] for i in shared]
+        indices = np.arange(len(shared_content))
+        group_scores = np.zeros(len(unique_content))
+        group_scores[shared] = sim_utils.calc_sim_pairs(shared_content, indices, indices,
+                                                        sim_utils._check_function(model, function),
+                                                        sim_utils._check_matrix_engine(model, function, shared_content))
+        return group_scores
+
+    def _new_writer(self, symmetric: bool, floor: float = None) -> Writer:
+        storage = {} if self.session is None else self.session.matrix_storage(self.size)
+        return new_writer(self.size, symmetric, True, floor, **storage)
+
+    def build_max_matrix(self, dict_name: str, options: List[List[str]], floor: float = None,
+                         threshold: float = None) -> None:
+        """
+        IMPLEMENTATION FOR MULITPLE OPTIONS (fused)
+        Compute the element-wise maximum over all options row by row without building the matrix of every option, the
+        option with the highest score is kept for the pairs above threshold
+
+        Parameters
+        ----------
+        dict_name: str
+            key for dict to get correct similarity_matrices back for different analysis purposes
+        options: List[List[str]]
+            list of options [model, name, attribute to look for, function]
+        floor: float
+            only the scores above it are kept (SparseScores), dense matrix if None
+        threshold: float
+            threshold of the combined step, the winning options are recorded for the pairs above it
+        """
+        row_functions = []
+        for sim_model, name, attr_property, function in options:
             attr_content = self._get_content(attr_property)
+            row_functions.append(self._select_row_function(sim_model, attr_content, function, floor))
 
-            similarity_matrix_class = self._select_sim_matrix(sim_model, name, attr_content, function)
-            matrices.append(similarity_matrix_class.sim_matrix)  # only append the matrix itself
+        matrix, winners = sim_utils.calc_max_matrix(dict_name, self.size, row_functions, self._new_writer(False, floor),
+                                                    threshold)
 
-        self.matrix_content[dict_name] = matrices  # save the matrices within the instance
+        self.matrix_content[dict_name] = [matrix]
+        self.winning_options[dict_name] = winners
+
+    def get_nearest_values(self, options: List[str], k: int = 5, min_score: float = None,
+                           row_batch: int = 256) -> List[List[Tuple['AttributeValue', float]]]:
+        """
+        k most similar values of every value under one option, the similarity rows are computed batch by batch and
+        only the best k of every row are kept (no similarity matrix)
+
+        Parameters
+        ----------
+        options: List[str]
+            option [model, name, attribute to look for, function]
+        k: int
+            number of neighbours per value
+        min_score: float
+            only neighbours scoring above it are returned (levenshtein rows are blocked with it)
+        row_batch: int
+            number of values whose rows are computed at once
+
+        Returns
+        -------
+        nearest_values: List[List[Tuple['AttributeValue', float]]]
+            neighbours and scores by descending score for each value of attr_values (same order)
+        """
+        sim_model, name, attr_property, function = options
+        attr_content = self._get_content(attr_property)
+        calc_rows = self._select_row_function(sim_model, attr_content, function, min_score)
+        neighbours, scores = sim_utils.calc_top_k(name, len(attr_content), calc_rows, k, row_batch)
+
+        nearest_values = []
+        for value_neighbours, value_scores in zip(neighbours.tolist(), scores.tolist()):
+            nearest_values.append([(self.attr_values[j], score) for j, score in zip(value_neighbours, value_scores)
+                                   if min_score is None or score > min_score])
+        return nearest_values
+
+    def _select_row_function(self, argument: str,
+                             attr_content: Union[List[str], List[List[str]]],
+                             function: str,
+                             min_score: float = None) -> sim_utils.RowFunction:
+        """
+        Select the function computing rows of the similarity matrix, same models and functions as _select_sim_matrix
+        """
+        if argument == 'glove':
+            return GloVeSimMatrix.row_function(attr_content, self.glove)
+        elif argument == 'tfidf':
+            return TfIdfSimMatrix.row_function(attr_content)
+        elif argument in ('open', 'spacy'):
+            model = self.glove if argument == 'open' else self.nlp
+            engine = sim_utils._check_matrix_engine(model, function, attr_content)
+            return sim_utils.sim_row_function(attr_content, sim_utils._check_function(model, function), engine)
+        elif argument == 'leven':
+            return sim_utils.levenshtein_row_function(attr_content, min_score)
+        elif argument == 'minhash':
+            return sim_utils.minhash_row_function(attr_content, min_score)
+        else:
+            logger.error('Invalid option for similarity rows')
 
     def _get_content(self, attr_property: str = 'glove_tokens') -> Union[List[str], List[List[str]]]:
         """
@@ -121,7 +368,11 @@ class Attribute:
     def _select_sim_matrix(self, argument: str,
                            name: str,
                            attr_content: Union[List[str], List[List[str]]],
-                           function: str) -> Union[GloVeSimMatrix, OpenGloVeSimMatrix, TfIdfSimMatrix, SpaCySimMatrix, LevenshteinSimMatrix]:
+                           function: str,
+                           min_score: float = None,
+                           attr_property: str = None,
+                           floor: float = None) -> Union[GloVeSimMatrix, OpenGloVeSimMatrix, TfIdfSimMatrix, SpaCySimMatrix, LevenshteinSimMatrix,
+                                                         MinHashSimMatrix]:
         """
         Select functions to build SimilarityMatrix from dictionary
 
@@ -135,22 +386,38 @@ class Attribute:
             list of values with certain property for each attr_value
         function
             function string to be used later that is used for calculating the sim_matrix
+        min_score
+            threshold of the analysis step (levenshtein blocking, minhash bands)
+        attr_property
+            property the content was taken from, scores of pair-local functions are memoized under
+            (argument, function, attr_property) in the session and their kept matrix is completed if available
+        floor
+            only the scores above it are kept (SparseScores), dense matrices if None
 
         Returns
         -------
         sim_matrix
             calculated Sim_matrix
         """
+        memo_namespace = (argument, function, attr_property) if attr_property is not None else None
+        bound = score_bound(min_score, floor)
+        previous = self._get_previous_matrix(memo_namespace, bound) if memo_namespace is not None else None
         if argument == 'glove':
-            return GloVeSimMatrix(name, attr_content, self.glove, function)
+            return GloVeSimMatrix(name, attr_content, self.glove, function, session=self.session, floor=floor)
         elif argument == 'open':
-            return OpenGloVeSimMatrix(name, attr_content, self.glove, function)
+            return OpenGloVeSimMatrix(name, attr_content, self.glove, function, session=self.session,
+                                      memo_namespace=memo_namespace, previous=previous, floor=floor)
         elif argument == 'tfidf':
-            return TfIdfSimMatrix(name, attr_content, self.glove, function)
+            return TfIdfSimMatrix(name, attr_content, self.glove, function, session=self.session, floor=floor)
         elif argument == 'spacy':
-            return SpaCySimMatrix(name, attr_content, self.nlp, function)
+            return SpaCySimMatrix(name, attr_content, self.nlp, function, session=self.session,
+                                  memo_namespace=memo_namespace, previous=previous, floor=floor)
         elif argument == 'leven':
-            return LevenshteinSimMatrix(name, attr_content, '_', '_')
+            return LevenshteinSimMatrix(name, attr_content, '_', '_', session=self.session, min_score=min_score,
+                                        memo_namespace=memo_namespace, previous=previous, floor=floor)
+        elif argument == 'minhash':
+            return MinHashSimMatrix(name, attr_content, '_', '_', session=self.session, min_score=min_score,
+                                    floor=floor)
         else:
             logger.error('Invalid option for SimilarityMatrix constructor')
 
@@ -169,6 +436,8 @@ class AttributeValue:
         attribute label
     count: int
         occurence of given attr_value in event log
+    doc: Doc
+        already processed doc of the preprocessed attr_value (batch processing), parsed here if it is missing
     """
     nltk_pos_tokens: List[List[str]]
     synonyms: Dict[str, List[str]]
@@ -179,7 +448,7 @@ class AttributeValue:
     # tokens: ['Permit', 'submitted',...
     # lemmas: ['permit', 'submit',...
 
-    def __init__(self, nlp: SpaCyModel, glove: GloVeModel, attr_value: str, count: int) -> None:
+    def __init__(self, nlp: SpaCyModel, glove: GloVeModel, attr_value: str, count: int, doc: Doc = None) -> None:
         """
         Initialize each attribute value for easier work on each value
         Normal string is filtered to not contain SpaCy stopwords and words are lemmatized for better comparison
@@ -188,22 +457,22 @@ class AttributeValue:
         self.count = count
         self.processed_value: str = preprocess_value(self.orig_value)
 
-        self.init_nlp(nlp, glove)
+        self.init_nlp(nlp, glove, doc)
 
         self.id: int = AttributeValue.__id
         AttributeValue.__id += 1
 
-    def init_nlp(self, nlp: SpaCyModel, glove: GloVeModel):
+    def init_nlp(self, nlp: SpaCyModel, glove: GloVeModel, doc: Doc = None):
         """
         After syntax updates, the semantic analysis needs information for nlp analysis
         """
         tic = time.perf_counter()
         # prep for spacy
-        self.doc = nlp.model(self.processed_value)
+        self.doc = doc if doc is not None else nlp.model(self.processed_value)
         self.spacy_tokens: List[str] = [token.text for token in self.doc if (not token.is_stop) and (not token.is_oov)]
         self.spacy_lemmas: List[str] = [token.lemma_ if token.lemma_ != '-PRON-' else token.lower_ for token in self.doc if (not token.is_oov) and (not token.is_stop)]
         self.pos_tags: List[str] = [token.pos_ for token in self.doc]
-        self.dependencies: List[str] = [token.dep_ for token in self.doc]  # not used
+        self.dependencies: List[str] = [token.dep_ for token in self.doc]  # not used, empty without parser component
         # prep for gensim
         self.glove_tokens: List[str] = [token for token in self.processed_value.split() if token in glove.model]
         # prep for nltk
@@ -0,0 +1,140 @@
+"""
+Blocking of candidate pairs for the levenshtein similarity of sim_utils.calc_levenshtein_sim
+
+A pair can only score above a threshold if its edit distance is small enough. Two filters follow from the maximal
+distance without computing it:
+    length filter   abs(len(t1) - len(t2)) <= distance
+    q-gram filter   shared q-grams >= max(len(t1), len(t2)) - q + 1 - q * distance
+Both are necessary conditions, so every pair above the threshold is kept. The "difference" branches of the filter
+conditions (queries of len_threshold and more) compare the strings without shared words, every pair sharing a word
+stays a candidate for them; pairs without shared words compare the full strings in all branches.
+"""
+import numpy as np
+
+from collections import Counter
+from typing import Dict, List, Tuple, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+LEVSIM_ALPHA, LEVSIM_BETA = 1.8, 5.0  # defaults of gensim levsim
+
+
+def levsim_max_distances(max_length: int, min_score: float) -> np.ndarray:
+    """
+    Largest edit distance per string length that still gives a levsim score above min_score
+    -> levsim = alpha * (1 - distance / length) ** beta, evaluated with the same expression to avoid rounding issues
+
+    Parameters
+    ----------
+    max_length
+        largest length (maximum of both string lengths) that is needed
+    min_score
+        scores have to be strictly greater
+
+    Returns
+    -------
+    max_distances
+        array indexed by length, -1 if no distance reaches the score
+    """
+    max_distances = np.full(max_length + 1, -1, dtype=np.int64)
+    if min_score < 1.0:
+        max_distances[0] = 0  # levsim of two empty strings is 1.0
+    ratio = 1.0 - (max(min_score, 0.0) / LEVSIM_ALPHA) ** (1.0 / LEVSIM_BETA) if min_score < LEVSIM_ALPHA else 0.0
+    for length in range(1, max_length + 1):
+        distance = min(int(ratio * length) + 1, length)
+        while distance >= 0 and not LEVSIM_ALPHA * (1.0 - distance * 1.0 / length) ** LEVSIM_BETA > min_score:
+            distance -= 1
+        max_distances[length] = distance
+    return max_distances
+
+
+def as_string_and_words(value: Union[str, List[str]]) -> Tuple[str, List[str]]:
+    """
+    String that levsim compares and the words that are stripped by difference_of_str_both / difference_of_list_both
+    """
+    if isinstance(value, list):
+        return ' '.join(value), value
+    return value, value.split(' ')
+
+
+class QGramIndex:
+    """
+    Inverted q-gram and word index of the content of one levenshtein similarity matrix
+
+    Parameters
+    ----------
+    content
+        strings or token lists (compared as joined strings)
+    q
+        length of the q-grams
+    len_threshold
+        query length from which on the difference branches are used (same as in calc_levenshtein_sim)
+    """
+
+    def __init__(self, content: Union[List[str], List[List[str]]], q: int = 2, len_threshold: int = 17) -> None:
+        self.q = q
+        self.len_threshold = len_threshold
+        self.size = len(content)
+        strings_words = [as_string_and_words(value) for value in content]
+        self.lengths = np.array([len(string) for string, _ in strings_words], dtype=np.int64)
+
+        grams: Dict[str, Tuple[List[int], List[int]]] = {}
+        words: Dict[str, List[int]] = {}
+        for i, (string, value_words) in enumerate(strings_words):
+            for gram, count in self._profile(string).items():
+                ids, counts = grams.setdefault(gram, ([], []))
+                ids.append(i)
+                counts.append(count)
+            for word in set(value_words):
+                words.setdefault(word, []).append(i)
+        self.grams = {gram: (np.array(ids, dtype=np.int64), np.array(counts, dtype=np.int64))
+                      for gram, (ids, counts) in grams.items()}
+        self.words = {word: np.array(ids, dtype=np.int64) for word, ids in words.items()}
+        self._max_distances = {}
+
+    def _profile(self, string: str) -> Counter:
+        return Counter(string[i:i + self.q] for i in range(len(string) - self.q + 1))
+
+    def _get_max_distances(self, min_score: float, max_length: int) -> np.ndarray:
+        max_distances = self._max_distances.get(min_score)
+        if max_distances is None or len(max_distances) <= max_length:
+            max_distances = levsim_max_distances(max(max_length, int(self.lengths.max(initial=0))), min_score)
+            self._max_distances[min_score] = max_distances
+        return max_distances
+
+    def candidates(self, query: Union[str, List[str]], min_score: float) -> np.ndarray:
+        """
+        Indices of all values that can score above min_score with the query (query as t1 of calc_levenshtein_sim)
+
+        Parameters
+        ----------
+        query
+            value to compare, string or token list like the content
+        min_score
+            threshold the results have to exceed
+
+        Returns
+        -------
+        candidates
+            sorted indices into content
+        """
+        string, query_words = as_string_and_words(query)
+        length = len(string)
+        max_lengths = np.maximum(self.lengths, length)
+        max_distances = self._get_max_distances(min_score, length)[max_lengths]
+
+        shared_grams = np.zeros(self.size, dtype=np.int64)
+        for gram, count in self._profile(string).items():
+            if gram in self.grams:
+                ids, counts = self.grams[gram]
+                shared_grams[ids] += np.minimum(counts, count)
+        possible = ((max_distances >= 0)
+                    & (np.abs(self.lengths - length) <= max_distances)
+                    & (shared_grams >= max_lengths - self.q + 1 - self.q * max_distances))
+
+        if len(query) >= self.len_threshold:  # difference branches compare the strings without shared words
+            for word in set(query_words):
+                if word in self.words:
+                    possible[self.words[word]] = True
+        return np.flatnonzero(possible)
@@ -0,0 +1,187 @@
+"""
+Persistent embedding store for GloVe vectors
+
+The plain text GloVe file is converted only once into a gensim KeyedVectors store (pickled vocabulary and separate
+.npy arrays for the raw and the normalised vectors) next to the text file. A small json file keeps the checksum of
+the source so that a changed text file triggers a new conversion. All later runs map the arrays read-only into memory,
+which makes startup nearly instant and lets several processes share the same physical pages.
+"""
+from gensim.test.utils import get_tmpfile
+from gensim.models import KeyedVectors
+from gensim.scripts.glove2word2vec import glove2word2vec
+
+from typing import Dict, Union
+import hashlib
+import json
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_STORE_SUFFIX = '.kv'
+_META_SUFFIX = '.json'
+_STORE_VERSION = 1
+
+
+def get_store_file(model_file: str) -> str:
+    """
+    Return filepath of the store belonging to the given text file, e.g. data/glove.6B.100d.kv
+
+    Parameters
+    ----------
+    model_file
+        filepath of the GloVe text file
+
+    Returns
+    -------
+    store_file
+        filepath of the pickled vocabulary, the vectors are saved as <store_file>.vectors.npy
+    """
+    return os.path.splitext(model_file)[0] + _STORE_SUFFIX
+
+
+def compute_checksum(filepath: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute sha256 checksum of a file without reading it into memory at once
+
+    Parameters
+    ----------
+    filepath
+        file to be hashed
+    chunk_size
+        bytes that are read per iteration
+
+    Returns
+    -------
+    checksum
+        hex digest of the file content
+    """
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _get_file_stamp(filepath: str) -> Dict[str, Union[int, float]]:
+    stat = os.stat(filepath)
+    return {'source_size': stat.st_size, 'source_mtime': stat.st_mtime}
+
+
+def _read_meta(store_file: str) -> Union[None, Dict[str, Union[int, float, str]]]:
+    try:
+        with open(store_file + _META_SUFFIX) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_meta(store_file: str, meta: Dict[str, Union[int, float, str]]) -> None:
+    with open(store_file + _META_SUFFIX, 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def is_store_valid(model_file: str, store_file: str) -> bool:
+    """
+    Check if the store exists and still belongs to the given text file
+    -> cheap comparison of size and modification time first, checksum only if the stamp changed
+
+    Parameters
+    ----------
+    model_file
+        filepath of the GloVe text file
+    store_file
+        filepath of the converted store
+
+    Returns
+    -------
+    valid
+        True if the store can be used instead of parsing the text file
+    """
+    meta = _read_meta(store_file)
+    if meta is None or meta.get('version') != _STORE_VERSION or not os.path.isfile(store_file):
+        return False
+    if not os.path.isfile(model_file):  # text file was removed after conversion, store is the only source left
+        return True
+    stamp = _get_file_stamp(model_file)
+    if all(meta.get(key) == value for key, value in stamp.items()):
+        return True
+    # file was touched or copied, only the content decides
+    if meta.get('source_sha256') == compute_checksum(model_file):
+        meta.update(stamp)
+        _write_meta(store_file, meta)
+        return True
+    logger.info(f'Checksum of {model_file} changed, embedding store {store_file} is outdated.')
+    return False
+
+
+def convert_glove_to_store(model_file: str, store_file: str) -> None:
+    """
+    One-time conversion of the GloVe text file into a store with pickled vocabulary and .npy vectors
+
+    Parameters
+    ----------
+    model_file
+        filepath of the GloVe text file
+    store_file
+        filepath of the store that is written
+    """
+    tic = time.perf_counter()
+    tmp_file = get_tmpfile('glove.word2vec.txt')
+    try:
+        _ = glove2word2vec(model_file, tmp_file)
+        model = KeyedVectors.load_word2vec_format(tmp_file, binary=False)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    model.init_sims()  # normalised vectors are stored as well, so most_similar does not copy them again later
+    model.save(store_file, ignore=[])
+    meta = {'version': _STORE_VERSION,
+            'source': os.path.basename(model_file),
+            'source_sha256': compute_checksum(model_file),
+            'shape': list(model.vectors.shape)}
+    meta.update(_get_file_stamp(model_file))
+    _write_meta(store_file, meta)  # written last, an interrupted conversion is never seen as valid
+    toc = time.perf_counter()
+    logger.info(f'GloVe model converted into embedding store {store_file} in {toc - tic:0.4f} seconds')
+
+
+def load_store(store_file: str) -> KeyedVectors:
+    """
+    Open converted store read-only through mmap
+
+    Parameters
+    ----------
+    store_file
+        filepath of the converted store
+
+    Returns
+    -------
+    model
+        KeyedVectors whose vectors are backed by the memory-mapped .npy files
+    """
+    return KeyedVectors.load(store_file, mmap='r')
+
+
+def load_glove_model(model_file: str) -> KeyedVectors:
+    """
+    Return GloVe model from its embedding store, the store is created first if it is missing or outdated
+
+    Parameters
+    ----------
+    model_file
+        filepath of the GloVe text file
+
+    Returns
+    -------
+    model
+        memory-mapped KeyedVectors (not trainable)
+    """
+    store_file = get_store_file(model_file)
+    if not is_store_valid(model_file, store_file):
+        if not os.path.isfile(model_file):
+            raise FileNotFoundError(model_file)
+        logger.info(f'Embedding store {store_file} missing, converting {model_file} once ...')
+        convert_glove_to_store(model_file, store_file)
+    return load_store(store_file)
@@ -0,0 +1,346 @@
+"""
+Bit-parallel levenshtein similarity (Myers / Hyyrö) for many string pairs at once
+
+Every pattern is encoded as match bit-vectors per character (Peq, 64 positions per uint64 word). One column of the
+dynamic programming matrix is a pair of vertical delta vectors (Pv, Mv), a text character updates it with a few bit
+operations; patterns longer than 64 characters use several words with carries for the addition and the shifts.
+All pairs of a batch are updated together with NumPy, so a query is scored against all values of an attribute (and
+all queries of a block against their candidates) in one call instead of one levsim call per pair.
+"""
+from nlp_label_quality.analysis.blocking import LEVSIM_ALPHA, LEVSIM_BETA, as_string_and_words
+
+import numpy as np
+
+from typing import Dict, List, Tuple, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+_WORD = 64
+_ONE = np.uint64(1)
+_HIGH = np.uint64(_WORD - 1)
+
+
+def levsim_from_distances(distances: np.ndarray, lengths1: np.ndarray, lengths2: np.ndarray,
+                          alpha: float = LEVSIM_ALPHA, beta: float = LEVSIM_BETA) -> np.ndarray:
+    """
+    Vectorized gensim levsim: alpha * (1 - distance / max_length) ** beta, 1.0 for two empty strings
+    """
+    max_lengths = np.maximum(lengths1, lengths2).astype(np.float64)
+    ratio = np.divide(distances * 1.0, max_lengths, out=np.zeros_like(max_lengths), where=max_lengths > 0)
+    return np.where(max_lengths > 0, alpha * (1.0 - ratio) ** beta, 1.0)
+
+
+def _pad(flat: np.ndarray, lengths: np.ndarray, fill: int) -> np.ndarray:
+    """
+    Split the concatenation of several sequences into the rows of a padded matrix
+    """
+    padded = np.full((len(lengths), int(lengths.max(initial=0))), fill, dtype=flat.dtype)
+    padded[np.arange(padded.shape[1]) < lengths[:, None]] = flat
+    return padded
+
+
+class CharEncoder:
+    """
+    Maps characters to dense codes, characters outside of the alphabet get the code size
+
+    Parameters
+    ----------
+    strings
+        strings that define the alphabet
+    """
+
+    def __init__(self, strings: List[str]) -> None:
+        self.alphabet = np.unique(self._code_points(''.join(strings)))
+        self.size = len(self.alphabet)
+
+    @staticmethod
+    def _code_points(text: str) -> np.ndarray:
+        return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+
+    def encode(self, text: str) -> np.ndarray:
+        code_points = self._code_points(text)
+        codes = np.minimum(np.searchsorted(self.alphabet, code_points), max(self.size - 1, 0))
+        known = self.alphabet[codes] == code_points if self.size else np.zeros(len(code_points), dtype=bool)
+        return np.where(known, codes, self.size).astype(np.int32)
+
+    def encode_many(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Codes of several texts padded to the longest one (padding is never read) and the text lengths
+        """
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        return _pad(self.encode(''.join(texts)), lengths, self.size), lengths
+
+
+class LevenshteinKernel:
+    """
+    Encoded patterns for bit-parallel edit distances
+
+    Parameters
+    ----------
+    codes
+        padded character codes of the patterns, see CharEncoder.encode_many
+    lengths
+        length of each pattern
+    size
+        alphabet size, codes >= size never match
+    """
+
+    def __init__(self, codes: np.ndarray, lengths: np.ndarray, size: int) -> None:
+        self.lengths = lengths
+        self.words = max(1, -(-int(lengths.max(initial=0)) // _WORD))
+        self.peq = np.zeros((len(lengths), self.words, size + 1), dtype=np.uint64)
+
+        pattern_ids, positions = np.nonzero(np.arange(codes.shape[1]) < lengths[:, None])
+        chars = codes[pattern_ids, positions]
+        known = chars < size
+        pattern_ids, positions, chars = pattern_ids[known], positions[known], chars[known]
+        # every position sets its own bit, so the sum of the bits per (pattern, word, char) is their bitwise or
+        cells = (pattern_ids * self.words + positions // _WORD) * (size + 1) + chars
+        order = np.argsort(cells, kind='stable')
+        cells, bits = cells[order], np.left_shift(_ONE, (positions[order] % _WORD).astype(np.uint64))
+        if len(cells):
+            starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+            self.peq.reshape(-1)[cells[starts]] = np.add.reduceat(bits, starts)
+
+    def distances(self,
+                  pattern_ids: np.ndarray,
+                  text_codes: np.ndarray,
+                  text_lengths: np.ndarray) -> np.ndarray:
+        """
+        Edit distances of pairs (pattern, text)
+
+        Parameters
+        ----------
+        pattern_ids
+            pattern of each pair, shape (P,)
+        text_codes
+            encoded text of each pair, shape (P, max text length)
+        text_lengths
+            length of each text, shape (P,)
+
+        Returns
+        -------
+        distances
+            edit distance per pair
+        """
+        pattern_ids = np.asarray(pattern_ids, dtype=np.int64)
+        text_lengths = np.asarray(text_lengths, dtype=np.int64)
+        pairs = len(pattern_ids)
+        if not pairs:
+            return np.zeros(0, dtype=np.int64)
+        # longest texts first, the pairs that are still active at a text position are always a prefix
+        order = np.argsort(-text_lengths, kind='stable')
+        pattern_ids, text_codes, text_lengths = pattern_ids[order], text_codes[order], text_lengths[order]
+        pattern_lengths = self.lengths[pattern_ids]
+        last_word = np.maximum(pattern_lengths - 1, 0) // _WORD
+        last_bit = (np.maximum(pattern_lengths - 1, 0) % _WORD).astype(np.uint64)
+        words = int(last_word.max()) + 1
+
+        pv = np.full((pairs, words), np.iinfo(np.uint64).max, dtype=np.uint64)
+        mv = np.zeros((pairs, words), dtype=np.uint64)
+        score = pattern_lengths.copy()
+        active_counts = np.searchsorted(-text_lengths, -np.arange(text_lengths[0]), side='left')
+
+        for position, active in enumerate(active_counts):
+            ids, chars = pattern_ids[:active], text_codes[:active, position]
+            carry = np.zeros(active, dtype=np.uint64)
+            ph_in = np.ones(active, dtype=np.uint64)  # top row of the global distance grows by one per character
+            mh_in = np.zeros(active, dtype=np.uint64)
+            for word in range(words):
+                eq = self.peq[ids, word, chars]
+                pv_word, mv_word = pv[:active, word], mv[:active, word]
+                xv = eq | mv_word
+                masked = eq & pv_word
+                added = masked + pv_word
+                added_carry = added + carry
+                carry = ((added < masked) | (added_carry < added)).astype(np.uint64)
+                xh = (added_carry ^ pv_word) | eq
+                ph = mv_word | ~(xh | pv_word)
+                mh = pv_word & xh
+                at_last = last_word[:active] == word
+                if words == 1 or at_last.any():
+                    bit = last_bit[:active]
+                    delta = ((ph >> bit) & _ONE).astype(np.int64) - ((mh >> bit) & _ONE).astype(np.int64)
+                    score[:active] += delta if words == 1 else np.where(at_last, delta, 0)
+                ph_out, mh_out = ph >> _HIGH, mh >> _HIGH
+                ph = (ph << _ONE) | ph_in
+                mh = (mh << _ONE) | mh_in
+                ph_in, mh_in = ph_out, mh_out
+                pv[:active, word] = mh | ~(xv | ph)
+                mv[:active, word] = ph & xv
+
+        score = np.where(pattern_lengths == 0, text_lengths, score)  # empty patterns have no bit to read
+        distances = np.empty(pairs, dtype=np.int64)
+        distances[order] = score
+        return distances
+
+
+class _TokenTable:
+    """
+    Values as sequences of word ids, the words that difference_of_str_both / difference_of_list_both compare
+    """
+
+    def __init__(self, word_lists: List[List[str]], vocabulary: Dict[str, int]) -> None:
+        self.counts = np.array([len(words) for words in word_lists], dtype=np.int64)
+        self.starts = np.cumsum(self.counts) - self.counts
+        self.word_ids = np.array([vocabulary.setdefault(word, len(vocabulary))
+                                  for words in word_lists for word in words], dtype=np.int64)
+        self.keys = np.unique(_word_keys(np.repeat(np.arange(len(word_lists)), self.counts), self.word_ids))
+
+
+def _word_keys(value_ids: np.ndarray, word_ids: np.ndarray) -> np.ndarray:
+    return (value_ids.astype(np.int64) << 32) | word_ids
+
+
+def _contains(sorted_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    if not len(sorted_keys):
+        return np.zeros(len(keys), dtype=bool)
+    return sorted_keys[np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)] == keys
+
+
+class LevenshteinScorer:
+    """
+    Levenshtein similarity of queries against the values of content, computed by the bit-parallel kernel
+
+    The filter conditions of sim_utils.calc_levenshtein_sim are kept (t1 is the query, t2 a value of content):
+        1. len(t1) < len_threshold                                -> levsim of the full strings
+        2. abs(len(t1) - len(fixed_t1)) < len(t1) / 2             -> levsim of the strings without shared words
+        3. abs(len(fixed_t1) - len(fixed_t2)) <= 3                -> levsim of the strings without shared words
+        4. otherwise                                              -> minimum of both
+    and every score is capped at 1.0. Lengths are counted in characters for str and in tokens for List[str] queries,
+    token lists are compared as joined strings. Only pairs sharing a word have "difference" strings that differ from
+    the full strings; they are assembled from word ids and scored in a second kernel call.
+
+    Parameters
+    ----------
+    content
+        values the queries are compared to
+    len_threshold
+        term length to which only full results are calculated
+    pair_batch
+        number of pairs per kernel call (bounds the memory of the text codes)
+    """
+
+    def __init__(self,
+                 content: Union[List[str], List[List[str]]],
+                 len_threshold: int = 17,
+                 pair_batch: int = 65536) -> None:
+        self.len_threshold = len_threshold
+        self.pair_batch = pair_batch
+        strings_words = [as_string_and_words(value) for value in content]
+        self.encoder = CharEncoder([string for string, _ in strings_words] + [' '])
+        self.space = int(self.encoder.encode(' ')[0])
+        self.kernel = LevenshteinKernel(*self.encoder.encode_many([string for string, _ in strings_words]),
+                                        self.encoder.size)
+        self.value_lengths = np.array([len(value) for value in content], dtype=np.int64)
+        self.vocabulary: Dict[str, int] = {}
+        self.tokens = _TokenTable([words for _, words in strings_words], self.vocabulary)
+
+    def _word_table(self) -> Tuple[np.ndarray, np.ndarray]:
+        words = sorted(self.vocabulary, key=self.vocabulary.get)
+        return self.encoder.encode_many(words)
+
+    def _difference_strings(self,
+                            tokens: _TokenTable,
+                            ids: np.ndarray,
+                            other_tokens: _TokenTable,
+                            other_ids: np.ndarray,
+                            word_codes: np.ndarray,
+                            word_lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Joined words of the values ids that are not words of the values other_ids (difference_of_list per pair)
+
+        Returns
+        -------
+        codes, lengths, token_counts
+            padded character codes and length of the difference strings, number of their words
+        """
+        pairs = len(ids)
+        counts = tokens.counts[ids]
+        token_pairs = np.repeat(np.arange(pairs), counts)
+        token_ranks = np.arange(len(token_pairs)) - np.repeat(np.cumsum(counts) - counts, counts)
+        words = tokens.word_ids[np.repeat(tokens.starts[ids], counts) + token_ranks]
+        kept = ~_contains(other_tokens.keys, _word_keys(other_ids[token_pairs], words))
+        token_pairs, words = token_pairs[kept], words[kept]
+
+        token_counts = np.bincount(token_pairs, minlength=pairs)
+        ranks = np.arange(len(words)) - np.repeat(np.cumsum(token_counts) - token_counts, token_counts)
+        separated = (ranks > 0).astype(np.int64)  # a space in front of every word but the first one
+        char_lengths = word_lengths[words]
+        token_lengths = char_lengths + separated
+        token_starts = np.cumsum(token_lengths) - token_lengths  # in the concatenation of all strings
+        flat = np.empty(int(token_lengths.sum()), dtype=word_codes.dtype)
+        flat[token_starts[separated == 1]] = self.space
+        char_tokens = np.repeat(np.arange(len(words)), char_lengths)
+        char_ranks = np.arange(len(char_tokens)) - np.repeat(np.cumsum(char_lengths) - char_lengths, char_lengths)
+        flat[token_starts[char_tokens] + separated[char_tokens] + char_ranks] = word_codes[words[char_tokens],
+                                                                                           char_ranks]
+        lengths = np.bincount(token_pairs, weights=token_lengths, minlength=pairs).astype(np.int64)
+        return _pad(flat, lengths, self.encoder.size), lengths, token_counts
+
+    def scores(self,
+               queries: Union[List[str], List[List[str]]],
+               query_ids: np.ndarray,
+               value_ids: np.ndarray) -> np.ndarray:
+        """
+        Levenshtein similarity of the pairs (queries[query_ids[k]], content[value_ids[k]])
+
+        Parameters
+        ----------
+        queries
+            base terms to be compared (t1)
+        query_ids
+            query of each pair
+        value_ids
+            index into content of each pair
+
+        Returns
+        -------
+        scores
+            similarity per pair
+        """
+        query_ids = np.asarray(query_ids, dtype=np.int64)
+        value_ids = np.asarray(value_ids, dtype=np.int64)
+        strings_words = [as_string_and_words(query) for query in queries]
+        query_codes, query_string_lengths = self.encoder.encode_many([string for string, _ in strings_words])
+        query_tokens = _TokenTable([words for _, words in strings_words], self.vocabulary)
+        query_lengths = np.array([len(query) for query in queries], dtype=np.int64)
+        query_lists = np.array([isinstance(query, list) for query in queries], dtype=bool)
+        word_codes, word_lengths = self._word_table()
+
+        scores = np.empty(len(query_ids))
+        for start in range(0, len(query_ids), self.pair_batch):
+            qids = query_ids[start:start + self.pair_batch]
+            vids = value_ids[start:start + self.pair_batch]
+            distances = self.kernel.distances(vids, query_codes[qids], query_string_lengths[qids])
+            result_real = levsim_from_distances(distances, query_string_lengths[qids], self.kernel.lengths[vids])
+
+            lengths1 = query_lengths[qids]
+            fixed_lengths1, fixed_lengths2 = lengths1.copy(), self.value_lengths[vids]
+            result_diff = result_real.copy()  # without shared words the different strings are the full strings
+            long_pairs = np.flatnonzero(lengths1 >= self.len_threshold)
+            if len(long_pairs):
+                codes1, string_lengths1, token_counts1 = self._difference_strings(
+                    query_tokens, qids[long_pairs], self.tokens, vids[long_pairs], word_codes, word_lengths)
+                sharing = token_counts1 < query_tokens.counts[qids[long_pairs]]
+                shared_pairs = long_pairs[sharing]
+                codes1, string_lengths1, token_counts1 = \
+                    codes1[sharing], string_lengths1[sharing], token_counts1[sharing]
+                codes2, string_lengths2, token_counts2 = self._difference_strings(
+                    self.tokens, vids[shared_pairs], query_tokens, qids[shared_pairs], word_codes, word_lengths)
+                if len(shared_pairs):
+                    fixed_kernel = LevenshteinKernel(codes2, string_lengths2, self.encoder.size)
+                    distances = fixed_kernel.distances(np.arange(len(shared_pairs)), codes1, string_lengths1)
+                    result_diff[shared_pairs] = levsim_from_distances(distances, string_lengths1, string_lengths2)
+                    lists = query_lists[qids[shared_pairs]]
+                    fixed_lengths1[shared_pairs] = np.where(lists, token_counts1, string_lengths1)
+                    fixed_lengths2[shared_pairs] = np.where(lists, token_counts2, string_lengths2)
+
+            # filter results
+            use_diff = ((np.abs(lengths1 - fixed_lengths1) < lengths1 / 2)  # if more than half the letters are fixed
+                        | (np.abs(fixed_lengths1 - fixed_lengths2) <= 3))  # difference compare length of fixed_values
+            appending = np.where(lengths1 < self.len_threshold, result_real,  # if the string is short itself
+                                 np.where(use_diff, result_diff, np.minimum(result_real, result_diff)))
+            scores[start:start + self.pair_batch] = np.minimum(appending, 1.0)  # values above 1.0 are decreased to 1
+        return scores
@@ -0,0 +1,469 @@
+"""
+Vectorized engines that compute similarity matrices in bulk instead of calling a similarity function per pair
+
+Every engine prepares the content of one attribute once and returns arbitrary blocks of the similarity matrix,
+so that the full matrix, single rows or tiles can be computed with the same code
+"""
+import numpy as np
+from scipy import sparse
+
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Hashable, List, Tuple, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+_BATCH_ENTRIES = 1 << 24  # embedded entries of the token sharing pairs evaluated at once
+
+
+class MatrixEngine(ABC):
+    """
+    Abstract base class for bulk similarity computation
+
+    Parameters
+    ----------
+    content
+        content to compare similarity for
+    """
+
+    def __init__(self, content: List[List[str]]) -> None:
+        self.content = content
+        self.size = len(content)
+
+    @abstractmethod
+    def block(self, rows: slice, cols: slice) -> np.ndarray:
+        """
+        Return similarity scores of content[rows] (queries) against content[cols]
+        """
+        pass
+
+    def matrix(self) -> np.ndarray:
+        return self.block(slice(0, self.size), slice(0, self.size))
+
+    def write_rows(self, writer: 'Writer', upper: bool = True,
+                   tile_size: int = 1024) -> 'Matrix':
+        """
+        Stream the matrix row tile by row tile into a writer (see matrix_storage)
+
+        Parameters
+        ----------
+        writer
+            assembles a dense matrix or keeps the scores above its floor only
+        upper
+            compute only the upper triangle (diagonal included), all pairs otherwise
+        tile_size
+            number of rows per computed block
+
+        Returns
+        -------
+        sim_matrix
+            result of the writer
+        """
+        for start in range(0, self.size, tile_size):
+            stop = min(start + tile_size, self.size)
+            cols = slice(start if upper else 0, self.size)
+            writer.write_block(slice(start, stop), cols, self.block(slice(start, stop), cols))
+        return writer.result()
+
+
+class TokenBasis(ABC):
+    """
+    Vectors of the tokens of an attribute vocabulary; a sum of token vectors is given by its weights over the tokens
+    (sparse row) and embedded into the form its dot products are computed on
+
+    Attributes
+    ----------
+    width
+        number of columns of an embedded row (bounds the memory of batches)
+    """
+    width: int
+
+    @abstractmethod
+    def embed(self, weights: sparse.csr_matrix) -> Any:
+        pass
+
+    @abstractmethod
+    def dots(self, embedded1: Any, embedded2: Any) -> np.ndarray:
+        """
+        Dot products of all pairs, shape (len(embedded1), len(embedded2))
+        """
+        pass
+
+    @abstractmethod
+    def pair_dots(self, embedded1: Any, embedded2: Any) -> np.ndarray:
+        """
+        Dot products of the rows embedded1[k] and embedded2[k]
+        """
+        pass
+
+    @abstractmethod
+    def scale(self, embedded: Any, factors: np.ndarray) -> Any:
+        pass
+
+    def norms(self, embedded: Any) -> np.ndarray:
+        return np.sqrt(np.maximum(self.pair_dots(embedded, embedded), 0.0))
+
+    def unit(self, embedded: Any) -> Any:
+        """
+        Rows scaled to unit norm, rows without norm become zero
+        """
+        norms = self.norms(embedded)
+        return self.scale(embedded, np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0))
+
+
+class VectorBasis(TokenBasis):
+    """
+    Float vectors of the tokens, sums are embedded as dense vectors
+
+    Parameters
+    ----------
+    vectors
+        one vector per token, shape (n_tokens, dim)
+    """
+
+    def __init__(self, vectors: np.ndarray) -> None:
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.width = self.vectors.shape[1]
+
+    def embed(self, weights: sparse.csr_matrix) -> np.ndarray:
+        return np.asarray(weights @ self.vectors, dtype=np.float32).reshape(weights.shape[0], self.width)
+
+    def dots(self, embedded1: np.ndarray, embedded2: np.ndarray) -> np.ndarray:
+        return embedded1 @ embedded2.T
+
+    def pair_dots(self, embedded1: np.ndarray, embedded2: np.ndarray) -> np.ndarray:
+        return np.einsum('ij,ij->i', embedded1, embedded2)
+
+    def scale(self, embedded: np.ndarray, factors: np.ndarray) -> np.ndarray:
+        return embedded * factors[:, None].astype(np.float32)
+
+    def norms(self, embedded: np.ndarray) -> np.ndarray:
+        return np.linalg.norm(embedded, axis=1)
+
+
+class GramBasis(TokenBasis):
+    """
+    Token vectors known only by their inner products (e.g. quantized codes multiplied with integer accumulation, see
+    QuantizedVectors.gram): sums stay sparse weights and dot(w1, w2) = w1 G w2^T, no float vector is expanded
+
+    Parameters
+    ----------
+    gram
+        inner products of the basis vectors, shape (n_rows, n_rows)
+    mapping
+        weights of every token over the basis vectors (tokens made of several vectors), identity if None
+    """
+
+    def __init__(self, gram: np.ndarray, mapping: sparse.csr_matrix = None) -> None:
+        self.gram = gram
+        self.mapping = mapping
+        self.width = len(gram)
+
+    def embed(self, weights: sparse.csr_matrix) -> sparse.csr_matrix:
+        if self.mapping is not None:
+            weights = weights @ self.mapping
+        return sparse.csr_matrix(weights, dtype=np.float32)
+
+    def dots(self, embedded1: sparse.csr_matrix, embedded2: sparse.csr_matrix) -> np.ndarray:
+        return np.asarray(embedded2 @ np.asarray(embedded1 @ self.gram).T).T
+
+    def pair_dots(self, embedded1: sparse.csr_matrix, embedded2: sparse.csr_matrix) -> np.ndarray:
+        return np.asarray(embedded2.multiply(np.asarray(embedded1 @ self.gram)).sum(axis=1)).ravel()
+
+    def scale(self, embedded: sparse.csr_matrix, factors: np.ndarray) -> sparse.csr_matrix:
+        return sparse.csr_matrix(sparse.diags(factors.astype(np.float32)) @ embedded)
+
+
+def token_counts(content: List[List[str]]) -> Tuple[List[str], sparse.csr_matrix]:
+    """
+    Vocabulary of the content (order of first occurrence) and the token counts of every value over it
+    """
+    vocabulary = {}
+    indptr, indices = [0], []
+    for tokens in content:
+        indices.extend(vocabulary.setdefault(token, len(vocabulary)) for token in tokens)
+        indptr.append(len(indices))
+    counts = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                               shape=(len(content), len(vocabulary)))
+    counts.sum_duplicates()  # repeated tokens become counts
+    return list(vocabulary), counts
+
+
+class MeanVectorEngine(MatrixEngine):
+    """
+    Cosine similarity between the mean vectors of token lists (equals KeyedVectors.n_similarity)
+    -> every mean vector (in the direction of the token sum) is computed and normalised once in the form of the token
+    basis, a block of the matrix is a single product; rows with empty content stay zero
+
+    Parameters
+    ----------
+    content
+        token lists to compare similarity for
+    get_basis
+        returns the token basis (e.g. VectorBasis of the stacked vectors) of the vocabulary of the content
+    """
+
+    def __init__(self, content: List[List[str]], get_basis: Callable[[List[str]], TokenBasis]) -> None:
+        super().__init__(content)
+        vocabulary, counts = token_counts(content)
+        self.basis = get_basis(vocabulary)
+        self.unit_vectors = self.basis.unit(self.basis.embed(counts))
+
+    def block(self, rows: slice, cols: slice) -> np.ndarray:
+        return self.basis.dots(self.unit_vectors[rows], self.unit_vectors[cols])
+
+
+class TokenSetEngine(MatrixEngine):
+    """
+    Bulk version of the list functions of nlp_models.Model that strip shared tokens before embedding
+    (calc_similarity_difference_list and the calc_combine_*_list functions built on top of it)
+
+    Every value is a row of token counts over the attribute vocabulary. The number of tokens two values share is a
+    sparse matrix product of counts and token presence, so pairs without shared tokens keep their full similarity;
+    only for the pairs sharing tokens the remaining ("non-shared") token sums are derived from the per-token vectors
+    with sparse algebra, batch by batch. The scores equal the per-pair functions.
+
+    Parameters
+    ----------
+    content
+        token lists to compare similarity for
+    get_basis
+        returns the token basis of the vocabulary of the content (tokens without vector are zero vectors)
+    function
+        name of the per-pair function that is reproduced
+    identical_is_one
+        identical token lists score 1.0 even without vectors (behaviour of spacy Doc.similarity)
+    pair_batch
+        maximal number of token sharing pairs that are evaluated at once (fewer for wide bases)
+    """
+    functions = ('calc_similarity_list', 'calc_similarity_difference_list', 'calc_combine_filter_list',
+                 'calc_combine_max_list', 'calc_combine_min_list', 'calc_combine_avg_list')
+    len_threshold = 4  # same threshold as Model.calc_combine_filter_list
+
+    def __init__(self, content: List[List[str]],
+                 get_basis: Callable[[List[str]], TokenBasis],
+                 function: str,
+                 identical_is_one: bool = False,
+                 pair_batch: int = 1 << 16) -> None:
+        super().__init__(content)
+        if function not in self.functions:
+            raise ValueError(f'TokenSetEngine cannot reproduce {function!r}')
+        self.function = function
+        self.identical_is_one = identical_is_one
+        self.pair_batch = pair_batch
+
+        keys = {}
+        vocabulary, self.counts = token_counts(content)
+        self.presence = self.counts.sign()
+        self.lengths = np.array([len(tokens) for tokens in content], dtype=np.int64)
+        self.keys = np.array([keys.setdefault(tuple(tokens), len(keys)) for tokens in content], dtype=np.int64)
+
+        self.basis = get_basis(vocabulary)
+        self.unit_vectors = self.basis.unit(self.basis.embed(self.counts))
+
+    def full_block(self, rows: slice, cols: slice) -> np.ndarray:
+        """
+        calc_similarity_list: cosine of the token sums (mean vectors point in the same direction)
+        """
+        block = self.basis.dots(self.unit_vectors[rows], self.unit_vectors[cols])
+        if self.identical_is_one:
+            identical = (self.keys[rows][:, None] == self.keys[cols][None, :]) & (self.lengths[rows][:, None] > 0)
+            block[identical] = 1.0
+        return block
+
+    def _shared_counts(self, rows: slice, cols: slice) -> Tuple[sparse.csr_matrix, sparse.csr_matrix]:
+        """
+        Returns
+        -------
+        shared_row, shared_col
+            tokens of the row value found in the column value and vice versa (repeated tokens count multiple times)
+        """
+        shared_row = (self.counts[rows] @ self.presence[cols].T).tocsr()
+        shared_col = (self.presence[rows] @ self.counts[cols].T).tocsr()
+        return shared_row, shared_col
+
+    def difference_block(self, rows: slice, cols: slice, full: np.ndarray,
+                         shared_row: sparse.csr_matrix, shared_col: sparse.csr_matrix) -> np.ndarray:
+        """
+        calc_similarity_difference_list: pairs without shared tokens keep the full similarity,
+        for all others the sums of the remaining tokens are compared
+        """
+        # identical lists share all tokens, their stripped lists are scored below like all other token sharing pairs
+        if self.identical_is_one:
+            diff = self.basis.dots(self.unit_vectors[rows], self.unit_vectors[cols])
+        else:
+            diff = full.copy()
+        pair_rows, pair_cols = shared_row.nonzero()
+        if not len(pair_rows):
+            return diff
+        row_offset, col_offset = rows.start or 0, cols.start or 0
+        remaining_row = self.lengths[pair_rows + row_offset] - np.asarray(shared_row[pair_rows, pair_cols]).ravel()
+        remaining_col = self.lengths[pair_cols + col_offset] - np.asarray(shared_col[pair_rows, pair_cols]).ravel()
+        pair_batch = max(1, min(self.pair_batch, _BATCH_ENTRIES // max(self.basis.width, 1)))
+        for start in range(0, len(pair_rows), pair_batch):
+            batch = slice(start, start + pair_batch)
+            i, j = pair_rows[batch] + row_offset, pair_cols[batch] + col_offset
+            counts_i, counts_j = self.counts[i], self.counts[j]
+            sums_i = self.basis.embed(sparse.csr_matrix(counts_i - counts_i.multiply(self.presence[j])))
+            sums_j = self.basis.embed(sparse.csr_matrix(counts_j - counts_j.multiply(self.presence[i])))
+            norms = self.basis.norms(sums_i) * self.basis.norms(sums_j)
+            dots = self.basis.pair_dots(sums_i, sums_j)
+            valid = (norms > 0) & (remaining_row[batch] > 0) & (remaining_col[batch] > 0)
+            diff[pair_rows[batch], pair_cols[batch]] = np.divide(dots, norms, out=np.zeros_like(dots), where=valid)
+        return diff
+
+    def block(self, rows: slice, cols: slice) -> np.ndarray:
+        rows = slice(*rows.indices(self.size))
+        cols = slice(*cols.indices(self.size))
+        full = self.full_block(rows, cols)
+        if self.function == 'calc_similarity_list':
+            return full
+        shared_row, shared_col = self._shared_counts(rows, cols)
+        diff = self.difference_block(rows, cols, full, shared_row, shared_col)
+        if self.function == 'calc_similarity_difference_list':
+            block = diff
+        elif self.function == 'calc_combine_max_list':
+            block = np.maximum(full, diff)
+        elif self.function == 'calc_combine_min_list':
+            block = np.minimum(full, diff)
+        elif self.function == 'calc_combine_avg_list':
+            block = (full + diff) / 2
+        else:
+            block = self._filter_block(rows, cols, full, diff, shared_row, shared_col)
+        # the per-pair functions are never called for empty lists, those pairs are 0
+        empty = (self.lengths[rows] == 0)[:, None] | (self.lengths[cols] == 0)[None, :]
+        block[empty] = 0.0
+        return block
+
+    def _filter_block(self, rows: slice, cols: slice, full: np.ndarray, diff: np.ndarray,
+                      shared_row: sparse.csr_matrix, shared_col: sparse.csr_matrix) -> np.ndarray:
+        """
+        calc_combine_filter_list: conditions on list lengths decide between full, diff and their minimum
+        (asymmetric, the row value is list1)
+        """
+        len_row = self.lengths[rows][:, None]
+        len_col = self.lengths[cols][None, :]
+        fixed_row = len_row - shared_row.toarray()
+        fixed_col = len_col - shared_col.toarray()
+        condition1 = (len_row < self.len_threshold) & (len_col < self.len_threshold)
+        condition2 = np.abs(len_row - fixed_row) < len_row / 2
+        condition3 = np.abs(fixed_row - fixed_col) < 3
+        return np.where(condition1, full,
+                        np.where(condition2 | condition3, diff, np.minimum(full, diff)))
+
+
+class DocVectorEngine(MatrixEngine):
+    """
+    Cosine similarity of precomputed document vectors (equals spacy Doc.similarity)
+    -> identical documents score 1.0 even without vectors, documents without vector norm score 0.0
+
+    Parameters
+    ----------
+    content
+        content the documents were built from, empty content scores 0.0
+    vectors
+        document vectors of shape (len(content), dim), any positive multiple of the vector (e.g. the token sum) works;
+        with a basis the documents embedded in it (e.g. sparse weights of a GramBasis)
+    keys
+        identity of the documents (e.g. tuple of token ids), equal keys mark identical documents
+    basis
+        token basis the vectors are embedded in, dense float vectors if None
+    """
+
+    def __init__(self, content: List[Any], vectors: Any, keys: List[Hashable], basis: TokenBasis = None) -> None:
+        super().__init__(content)
+        if basis is None:
+            vectors = np.asarray(vectors, dtype=np.float32).reshape(self.size, -1)
+            basis = VectorBasis(np.zeros((0, vectors.shape[1]), dtype=np.float32))
+        self.basis = basis
+        self.unit_vectors = basis.unit(vectors)
+        ids = {}
+        self.keys = np.array([ids.setdefault(key, len(ids)) if value else -1 for key, value in zip(keys, content)],
+                             dtype=np.int64)
+
+    def block(self, rows: slice, cols: slice) -> np.ndarray:
+        block = self.basis.dots(self.unit_vectors[rows], self.unit_vectors[cols])
+        keys_row, keys_col = self.keys[rows][:, None], self.keys[cols][None, :]
+        block[(keys_row == keys_col) & (keys_row >= 0)] = 1.0
+        return block
+
+
+class SparseCosineEngine(MatrixEngine):
+    """
+    Cosine similarity of sparse weighted document vectors (e.g. tf-idf weighted bag-of-words), soft cosine similarity
+    with a term similarity matrix S (equals gensim SoftCosineSimilarity)
+    -> the vectors are normalised once (by sqrt(d S d^T) for soft cosine), a block of the matrix is the single sparse
+    product D[rows] S D[cols]^T; documents without weights score 0.0
+
+    Parameters
+    ----------
+    content
+        content the documents were built from
+    vectors
+        sparse document vectors D of shape (len(content), n_terms)
+    term_similarity
+        symmetric sparse term similarity matrix S of shape (n_terms, n_terms), plain cosine similarity if None
+    """
+
+    def __init__(self, content: List[Any], vectors: sparse.spmatrix, term_similarity: sparse.spmatrix = None) -> None:
+        super().__init__(content)
+        vectors = sparse.csr_matrix(vectors, dtype=np.float32)
+        if term_similarity is None:
+            weighted = vectors
+        else:
+            weighted = vectors @ sparse.csr_matrix(term_similarity, dtype=np.float32)
+        norms = np.sqrt(np.maximum(np.asarray(weighted.multiply(vectors).sum(axis=1)).ravel(), 0))
+        inverse_norms = sparse.diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0))
+        self.unit_vectors = (inverse_norms @ vectors).tocsr()
+        self.query_vectors = (inverse_norms @ weighted).tocsr()
+        self.soft = term_similarity is not None
+
+    def sparse_block(self, rows: slice, cols: slice) -> sparse.coo_matrix:
+        """
+        Block of the similarity matrix as sparse product, only pairs sharing a term are stored
+        """
+        block = (self.query_vectors[rows] @ self.unit_vectors[cols].T).tocoo()
+        if self.soft:
+            np.clip(block.data, -1.0, 1.0, out=block.data)
+        return block
+
+    def block(self, rows: slice, cols: slice) -> np.ndarray:
+        return self.sparse_block(rows, cols).toarray()
+
+    def write_rows(self, writer: 'Writer', upper: bool = True,
+                   tile_size: int = 4096) -> 'Matrix':
+        """
+        Stream the stored pairs of the sparse product into a writer, tile_size rows per product (a single product for
+        smaller content), see MatrixEngine.write_rows
+        """
+        for start in range(0, self.size, tile_size):
+            stop = min(start + tile_size, self.size)
+            col_start = start if upper else 0
+            block = self.sparse_block(slice(start, stop), slice(col_start, self.size))
+            writer.write_pairs(block.row.astype(np.int64) + start, block.col.astype(np.int64) + col_start, block.data)
+        return writer.result()
+
+
+def clear_lower_triangle(matrix: np.ndarray, tile_size: int = 1024) -> None:
+    """
+    Set all elements below the diagonal to zero in-place, tile by tile (no index arrays of the full matrix)
+    """
+    size = len(matrix)
+    for start in range(0, size, tile_size):
+        stop = min(start + tile_size, size)
+        matrix[stop:, start:stop] = 0
+        diagonal_tile = matrix[start:stop, start:stop]
+        diagonal_tile[np.tril_indices(stop - start, -1)] = 0
+
+
+def mirror_upper_triangle(matrix: np.ndarray, tile_size: int = 1024) -> None:
+    """
+    Copy the upper triangle to the lower triangle in-place, so that a symmetric matrix is complete again
+    """
+    size = len(matrix)
+    for start in range(0, size, tile_size):
+        stop = min(start + tile_size, size)
+        matrix[stop:, start:stop] = matrix[start:stop, stop:].T
+        diagonal_tile = matrix[start:stop, start:stop]
+        lower = np.tril_indices(stop - start, -1)
+        diagonal_tile[lower] = diagonal_tile.T[lower]
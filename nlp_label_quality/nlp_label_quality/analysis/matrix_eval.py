@@ -1,5 +1,7 @@
 import numpy as np
 
+from nlp_label_quality.analysis.matrix_storage import Matrix, PackedTriangle, SparseScores
+
 import logging
 import warnings
 from typing import Dict, List, Tuple
@@ -105,24 +107,27 @@ def get_max_indices_above_threshold(a, threshold):
     return var[:len_indices]
 
 
-def get_results_from_matrix(a: np.ndarray, threshold: float) -> Tuple[np.ndarray, List[float]]:
+def get_results_from_matrix(a: Matrix, threshold: float) -> Tuple[np.ndarray, List[float]]:
     """
     Return max values and corresponding indices
+    -> only the scores of the upper triangle (diagonal excluded) above threshold are selected and sorted, dense
+    matrices (memory-mapped ones included) are scanned tile by tile without a copy of the matrix
 
     Parameters
     ----------
-    a: np.ndarray
-        matrix of which the maximum should be found
+    a: Matrix
+        dense, packed or sparse matrix (scores above a floor <= threshold) of which the maximum should be found
     threshold: float
         minimal value each matrix element needs to have to be looked into
 
     Returns
     -------
     max_indices, max_values: Tuple[np.ndarray, List[float]]
-        relevant indices; corresponding values
-    """
-    upper_triangle = np.triu(a)  # filter only upper triangle
-    round_and_diagonal_zero(upper_triangle)
-    max_indices = get_max_indices_above_threshold(upper_triangle, threshold)
-    max_values = get_value_list_by_indices(a, max_indices)
-    return max_indices, max_values
+        relevant indices sorted by descending value (ties row by row); corresponding values
+    """
+    if not isinstance(a, (SparseScores, PackedTriangle)):
+        a = SparseScores.from_matrix(a, threshold)
+    rows, cols, scores = a.above(threshold)  # row by row
+    order = np.argsort(-scores, kind='stable')
+    max_indices = np.stack([rows[order], cols[order]], axis=1).astype(np.int64)
+    return max_indices, list(scores[order])
@@ -0,0 +1,633 @@
+"""
+Storage of similarity matrices
+
+The results of an analysis step are only taken from the upper triangle (diagonal excluded) above a threshold. Instead
+of assembling a matrix from lists, the SimMatrix classes stream their blocks and pairs into a writer that fills a
+preallocated, typed buffer in-place:
+
+- DenseWriter: classic n x n matrix
+- PackedWriter: upper triangle packed row by row into n (n + 1) / 2 scores (PackedTriangle)
+- SparseWriter: only the scores above a floor (SparseScores), memory scales with the number of candidate pairs
+
+Scores are stored as float32 by default (float16 optional), similarity scores do not need more precision. Dense and
+packed buffers of large attributes can be memory-mapped to temporary files in a scratch directory (out-of-core), all
+functions of this module process them block by block; a file is removed together with its buffer.
+"""
+import numpy as np
+from scipy import sparse
+
+from nlp_label_quality.analysis.matrix_engine import mirror_upper_triangle, clear_lower_triangle
+
+from typing import List, Tuple, Union
+import logging
+import os
+import tempfile
+import weakref
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DTYPE = np.float32
+BLOCK_SCORES = 2 ** 24  # scores per block when buffers are processed block by block
+
+
+class SparseScores:
+    """
+    Scores above floor of the upper triangle (diagonal excluded) of a size x size similarity matrix in COO format,
+    sorted row by row; all other pairs are only known to not exceed floor
+
+    Parameters
+    ----------
+    size
+        number of values (rows and columns) of the matrix
+    rows
+        row (query) of each stored score
+    cols
+        column of each stored score, rows[k] < cols[k]
+    scores
+        stored scores, all above floor
+    floor
+        threshold the stored scores exceed
+    dtype
+        dtype of the stored scores
+    """
+
+    def __init__(self, size: int, rows: np.ndarray, cols: np.ndarray, scores: np.ndarray, floor: float,
+                 dtype: np.dtype = DEFAULT_DTYPE) -> None:
+        order = np.argsort(_pair_keys(rows, cols, size), kind='stable')
+        self.size = size
+        self.floor = floor
+        self.rows = np.asarray(rows, dtype=np.int32)[order]
+        self.cols = np.asarray(cols, dtype=np.int32)[order]
+        self.scores = np.asarray(scores, dtype=dtype)[order]
+
+    @classmethod
+    def empty(cls, size: int, floor: float, dtype: np.dtype = DEFAULT_DTYPE) -> 'SparseScores':
+        return cls(size, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0), floor, dtype)
+
+    @classmethod
+    def from_matrix(cls, matrix: Union[np.ndarray, 'PackedTriangle'], floor: float,
+                    tile_size: int = 1024) -> 'SparseScores':
+        """
+        Scores above floor of a dense or packed matrix
+        """
+        if isinstance(matrix, PackedTriangle):
+            return cls(matrix.size, *matrix.above(floor), floor, matrix.dtype)
+        writer = SparseWriter(len(matrix), floor, matrix.dtype)
+        for start in range(0, len(matrix), tile_size):
+            stop = min(start + tile_size, len(matrix))
+            writer.write_block(slice(start, stop), slice(start, len(matrix)), matrix[start:stop, start:])
+        return writer.result()
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.size, self.size
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.scores.dtype
+
+    @property
+    def nnz(self) -> int:
+        return len(self.scores)
+
+    @property
+    def keys(self) -> np.ndarray:
+        return _pair_keys(self.rows, self.cols, self.size)
+
+    def values(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """
+        Scores of the pairs (rows[k], cols[k]), 0 for all pairs that are not stored
+        """
+        keys = _pair_keys(rows, cols, self.size)
+        if not self.nnz:
+            return np.zeros(len(keys), dtype=self.dtype)
+        stored = self.keys
+        positions = np.minimum(np.searchsorted(stored, keys), self.nnz - 1)
+        return np.where(stored[positions] == keys, self.scores[positions], 0).astype(self.dtype)
+
+    def above(self, threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Rows, cols and scores of all stored pairs that exceed threshold (row by row)
+        """
+        if threshold < self.floor:
+            logger.warning(f'Scores between {threshold} and the floor {self.floor} are not stored')
+        selected = self.scores > threshold
+        return self.rows[selected], self.cols[selected], self.scores[selected]
+
+    def take(self, keep: np.ndarray, size: int) -> 'SparseScores':
+        """
+        Scores of the values keep (new indices 0..len(keep) - 1 in the same order) in a matrix of the given size,
+        pairs of all other values are dropped
+        """
+        new_index = np.full(self.size, -1, dtype=np.int64)
+        new_index[keep] = np.arange(len(keep))
+        rows, cols = new_index[self.rows], new_index[self.cols]
+        kept = (rows >= 0) & (cols >= 0)
+        return SparseScores(size, rows[kept], cols[kept], self.scores[kept], self.floor, self.dtype)
+
+    def with_pairs(self, rows: np.ndarray, cols: np.ndarray, scores: np.ndarray) -> 'SparseScores':
+        """
+        Copy in which the scores of the pairs (rows[k], cols[k]) are replaced
+        """
+        writer = SparseWriter(self.size, self.floor, self.dtype)
+        writer.write_pairs(rows, cols, scores)
+        new = writer.result()
+        replaced = np.isin(self.keys, _pair_keys(rows, cols, self.size))
+        return SparseScores(self.size, np.concatenate([self.rows[~replaced], new.rows]),
+                            np.concatenate([self.cols[~replaced], new.cols]),
+                            np.concatenate([self.scores[~replaced], new.scores]), self.floor, self.dtype)
+
+    def maximum(self, other: 'SparseScores') -> 'SparseScores':
+        """
+        Element-wise maximum, pairs missing in one of both matrices do not exceed its floor
+        """
+        keys = np.concatenate([self.keys, other.keys])
+        scores = np.concatenate([self.scores, other.scores])
+        order = np.lexsort((-scores, keys))  # highest score first within every pair
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = keys[order][1:] != keys[order][:-1]
+        order = order[first]
+        rows, cols = np.divmod(keys[order], self.size)
+        return SparseScores(self.size, rows, cols, scores[order], max(self.floor, other.floor), scores.dtype)
+
+    def to_csr(self) -> sparse.csr_matrix:
+        return sparse.csr_matrix((self.scores, (self.rows, self.cols)), shape=self.shape)
+
+    def __repr__(self) -> str:
+        return f'SparseScores(size={self.size}, nnz={self.nnz}, floor={self.floor}, dtype={self.dtype})'
+
+
+class PackedTriangle:
+    """
+    Upper triangle (diagonal included) of a size x size similarity matrix, packed row by row into one buffer of
+    size * (size + 1) / 2 scores; the lower triangle is the mirror (symmetric) or zero
+
+    Parameters
+    ----------
+    size
+        number of values (rows and columns) of the matrix
+    symmetric
+        pairs below the diagonal are read from their mirrored pair, otherwise they are 0
+    dtype
+        dtype of the buffer
+    data
+        packed scores, zeros if None
+    """
+
+    def __init__(self, size: int, symmetric: bool = True, dtype: np.dtype = DEFAULT_DTYPE,
+                 data: np.ndarray = None) -> None:
+        self.size = size
+        self.symmetric = symmetric
+        row_ids = np.arange(size, dtype=np.int64)
+        self.offsets = row_ids * size - row_ids * (row_ids - 1) // 2  # position of the diagonal element of each row
+        self.data = np.zeros(size * (size + 1) // 2, dtype=dtype) if data is None else data
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.size, self.size
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.data.dtype
+
+    def _positions(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """
+        Buffer positions of the pairs, -1 for pairs below the diagonal of asymmetric matrices
+        """
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        lower = rows > cols
+        if self.symmetric:
+            rows, cols = np.where(lower, cols, rows), np.where(lower, rows, cols)
+            return self.offsets[rows] + cols - rows
+        return np.where(lower, -1, self.offsets[rows] + cols - rows)
+
+    def values(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        positions = self._positions(rows, cols)
+        return np.where(positions >= 0, self.data[np.maximum(positions, 0)], 0).astype(self.dtype)
+
+    def set_pairs(self, rows: np.ndarray, cols: np.ndarray, scores: np.ndarray) -> None:
+        """
+        Write the scores of the pairs in-place, pairs below the diagonal of asymmetric matrices are dropped
+        """
+        positions = self._positions(rows, cols)
+        stored = positions >= 0
+        self.data[positions[stored]] = np.asarray(scores)[stored]
+
+    def set_block(self, rows: slice, cols: slice, block: np.ndarray) -> None:
+        """
+        Write the part of a block on and above the diagonal in-place, row by row
+        """
+        row_start, col_start = rows.start or 0, cols.start or 0
+        col_stop = col_start + block.shape[1]
+        for k, i in enumerate(range(row_start, row_start + block.shape[0])):
+            start = max(i, col_start)
+            if start < col_stop:
+                self.data[self.offsets[i] + start - i:self.offsets[i] + col_stop - i] = block[k, start - col_start:]
+
+    def row(self, i: int) -> np.ndarray:
+        """
+        Complete row i of the matrix
+        """
+        row = np.zeros(self.size, dtype=self.dtype)
+        row[i:] = self.data[self.offsets[i]:self.offsets[i] + self.size - i]
+        if self.symmetric:
+            row[:i] = self.data[self.offsets[:i] + i - np.arange(i)]
+        return row
+
+    def above(self, threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Rows, cols and scores of all pairs above the diagonal that exceed threshold (row by row)
+        """
+        found = []
+        for start in range(0, len(self.data), BLOCK_SCORES):
+            positions = np.flatnonzero(self.data[start:start + BLOCK_SCORES] > threshold) + start
+            rows = np.searchsorted(self.offsets, positions, side='right') - 1
+            cols = positions - self.offsets[rows] + rows
+            off_diagonal = rows < cols
+            found.append((rows[off_diagonal], cols[off_diagonal], self.data[positions[off_diagonal]]))
+        if not found:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=self.dtype)
+        return tuple(np.concatenate(parts) for parts in zip(*found))
+
+    def take(self, keep: np.ndarray, size: int) -> 'PackedTriangle':
+        """
+        Scores of the values keep (new indices 0..len(keep) - 1 in the same order) in a matrix of the given size
+        """
+        packed = PackedTriangle(size, self.symmetric, self.dtype,
+                                scratch_buffer(size * (size + 1) // 2, self.dtype, scratch_dir_of(self)))
+        keep = np.asarray(keep, dtype=np.int64)
+        for i, old in enumerate(keep):
+            start = packed.offsets[i]
+            packed.data[start:start + len(keep) - i] = self.data[self.offsets[old] + keep[i:] - old]
+        return packed
+
+    def maximum(self, other: 'PackedTriangle') -> 'PackedTriangle':
+        data = scratch_buffer(len(self.data), np.result_type(self.dtype, other.dtype),
+                              scratch_dir_of(self) or scratch_dir_of(other))
+        for start in range(0, len(data), BLOCK_SCORES):
+            block = slice(start, start + BLOCK_SCORES)
+            np.maximum(self.data[block], other.data[block], out=data[block])
+        return PackedTriangle(self.size, self.symmetric and other.symmetric, data=data)
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        """
+        Dense block of the rows start to stop
+        """
+        block = np.zeros((stop - start, self.size), dtype=self.dtype)
+        for k, i in enumerate(range(start, stop)):
+            block[k] = self.row(i)
+        return block
+
+    def toarray(self) -> np.ndarray:
+        matrix = np.zeros(self.shape, dtype=self.dtype)
+        for i in range(self.size):
+            matrix[i, i:] = self.data[self.offsets[i]:self.offsets[i] + self.size - i]
+        if self.symmetric:
+            mirror_upper_triangle(matrix)
+        return matrix
+
+    def __repr__(self) -> str:
+        return f'PackedTriangle(size={self.size}, symmetric={self.symmetric}, dtype={self.dtype})'
+
+
+class DenseWriter:
+    """
+    Assembles streamed blocks and pairs into a preallocated dense matrix
+
+    Parameters
+    ----------
+    size
+        number of values (rows and columns) of the matrix
+    symmetric
+        the upper triangle is mirrored to the lower one, otherwise the lower triangle is cleared (upper only)
+    upper
+        only the upper triangle (diagonal included) is written, all pairs otherwise
+    dtype
+        dtype of the matrix
+    scratch_dir
+        the matrix is memory-mapped to a temporary file in this directory, in memory if None
+    """
+
+    def __init__(self, size: int, symmetric: bool = True, upper: bool = True, dtype: np.dtype = DEFAULT_DTYPE,
+                 scratch_dir: str = None) -> None:
+        self.symmetric = symmetric
+        self.upper = upper
+        self.matrix = scratch_buffer((size, size), dtype, scratch_dir)
+
+    def write_block(self, rows: slice, cols: slice, block: np.ndarray) -> None:
+        self.matrix[rows, cols] = block
+
+    def write_pairs(self, rows: np.ndarray, cols: np.ndarray, scores: np.ndarray) -> None:
+        self.matrix[rows, cols] = scores
+
+    def result(self) -> np.ndarray:
+        if self.upper:
+            if self.symmetric:
+                mirror_upper_triangle(self.matrix)
+            else:
+                clear_lower_triangle(self.matrix)
+        return self.matrix
+
+
+class PackedWriter:
+    """
+    Writes streamed blocks and pairs of the upper triangle into a PackedTriangle
+
+    Parameters
+    ----------
+    size
+        number of values (rows and columns) of the matrix
+    symmetric
+        the lower triangle is the mirror of the upper one, otherwise it is zero
+    dtype
+        dtype of the buffer
+    scratch_dir
+        the buffer is memory-mapped to a temporary file in this directory, in memory if None
+    """
+
+    def __init__(self, size: int, symmetric: bool = True, dtype: np.dtype = DEFAULT_DTYPE,
+                 scratch_dir: str = None) -> None:
+        self.packed = PackedTriangle(size, symmetric, dtype, scratch_buffer(size * (size + 1) // 2, dtype, scratch_dir))
+
+    def write_block(self, rows: slice, cols: slice, block: np.ndarray) -> None:
+        self.packed.set_block(rows, cols, block)
+
+    def write_pairs(self, rows: np.ndarray, cols: np.ndarray, scores: np.ndarray) -> None:
+        upper = np.asarray(rows) <= np.asarray(cols)
+        self.packed.set_pairs(np.asarray(rows)[upper], np.asarray(cols)[upper], np.asarray(scores)[upper])
+
+    def result(self) -> PackedTriangle:
+        return self.packed
+
+
+class SparseWriter:
+    """
+    Keeps only the streamed scores above floor of the upper triangle (diagonal excluded)
+
+    Parameters
+    ----------
+    size
+        number of values (rows and columns) of the matrix
+    floor
+        lowest threshold the results will be filtered with
+    dtype
+        dtype of the stored scores
+    """
+
+    def __init__(self, size: int, floor: float, dtype: np.dtype = DEFAULT_DTYPE) -> None:
+        self.size = size
+        self.floor = floor
+        self.dtype = dtype
+        self._rows: List[np.ndarray] = []
+        self._cols: List[np.ndarray] = []
+        self._scores: List[np.ndarray] = []
+
+    def write_block(self, rows: slice, cols: slice, block: np.ndarray) -> None:
+        block_rows, block_cols = np.nonzero(block > self.floor)
+        scores = block[block_rows, block_cols]
+        block_rows += rows.start or 0
+        block_cols += cols.start or 0
+        self.write_pairs(block_rows, block_cols, scores)
+
+    def write_pairs(self, rows: np.ndarray, cols: np.ndarray, scores: np.ndarray) -> None:
+        selected = (rows < cols) & (scores > self.floor)
+        self._rows.append(rows[selected].astype(np.int32))
+        self._cols.append(cols[selected].astype(np.int32))
+        self._scores.append(np.asarray(scores)[selected].astype(self.dtype))
+
+    def result(self) -> SparseScores:
+        if not self._rows:
+            return SparseScores.empty(self.size, self.floor, self.dtype)
+        return SparseScores(self.size, np.concatenate(self._rows), np.concatenate(self._cols),
+                            np.concatenate(self._scores), self.floor, self.dtype)
+
+
+Matrix = Union[np.ndarray, PackedTriangle, SparseScores]
+Writer = Union[DenseWriter, PackedWriter, SparseWriter]
+
+
+def new_writer(size: int,
+               symmetric: bool = True,
+               upper: bool = True,
+               floor: float = None,
+               dtype: np.dtype = DEFAULT_DTYPE,
+               packed: bool = False,
+               scratch_dir: str = None) -> Writer:
+    """
+    Writer for a similarity matrix
+
+    Parameters
+    ----------
+    size
+        number of values (rows and columns) of the matrix
+    symmetric
+        the lower triangle is the mirror of the upper one
+    upper
+        only the upper triangle (diagonal included) is written
+    floor
+        only the scores above it are kept (SparseWriter)
+    dtype
+        dtype of the scores
+    packed
+        pack the upper triangle (PackedWriter), only used if only the upper triangle is written
+    scratch_dir
+        dense and packed buffers are memory-mapped to temporary files in this directory, in memory if None
+
+    Returns
+    -------
+    writer
+        SparseWriter with a floor, otherwise PackedWriter or DenseWriter
+    """
+    if floor is not None:
+        return SparseWriter(size, floor, dtype)
+    packed = packed and upper
+    n_scores = size * (size + 1) // 2 if packed else size * size
+    location = f'memory-mapped in {scratch_dir}' if scratch_dir is not None else 'in memory'
+    logger.info(f'Similarity matrix of {size} values needs {n_scores * np.dtype(dtype).itemsize / 2 ** 20:0.1f} MiB '
+                f'({location})')
+    if packed:
+        return PackedWriter(size, symmetric, dtype, scratch_dir)
+    return DenseWriter(size, symmetric, upper, dtype, scratch_dir)
+
+
+def scratch_buffer(shape: Union[int, Tuple[int, ...]], dtype: np.dtype = DEFAULT_DTYPE,
+                   scratch_dir: str = None) -> np.ndarray:
+    """
+    Zero-initialised buffer, memory-mapped to a temporary file in scratch_dir if given; the file is removed as soon as
+    the buffer is garbage collected (or at exit)
+    """
+    if scratch_dir is None:
+        return np.zeros(shape, dtype=dtype)
+    handle, path = tempfile.mkstemp(prefix='sim_matrix_', suffix='.dat', dir=scratch_dir)
+    os.close(handle)
+    buffer = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+    weakref.finalize(buffer, _remove_scratch_file, path)
+    return buffer
+
+
+def scratch_dir_of(matrix: Matrix) -> Union[None, str]:
+    """
+    Scratch directory of a memory-mapped dense or packed matrix, None for matrices in memory
+    """
+    buffer = matrix.data if isinstance(matrix, PackedTriangle) else matrix
+    if isinstance(buffer, np.memmap) and buffer.filename is not None:
+        return os.path.dirname(buffer.filename)
+    return None
+
+
+def _remove_scratch_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:  # still mapped (Windows) or already removed with the scratch directory
+        pass
+
+
+def score_bound(min_score: float = None, floor: float = None) -> Union[None, float]:
+    """
+    Threshold up to which a matrix is exact (scores of pruned or not stored pairs do not exceed it), None if all
+    scores are exact
+    """
+    bounds = [bound for bound in (min_score, floor) if bound is not None]
+    return max(bounds) if bounds else None
+
+
+def pair_values(matrix: Matrix, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """
+    Scores of the pairs (rows[k], cols[k]) of a dense, packed or sparse matrix
+    """
+    if isinstance(matrix, (SparseScores, PackedTriangle)):
+        return matrix.values(rows, cols)
+    return matrix[rows, cols]
+
+
+def update_pairs(matrix: Matrix, rows: np.ndarray, cols: np.ndarray, scores: np.ndarray, symmetric: bool) -> Matrix:
+    """
+    Matrix with the scores of the pairs (rows[k], cols[k]) replaced, dense and packed matrices are updated in-place
+    """
+    if isinstance(matrix, SparseScores):
+        return matrix.with_pairs(rows, cols, scores)
+    if isinstance(matrix, PackedTriangle):
+        matrix.set_pairs(rows, cols, scores)
+        return matrix
+    matrix[rows, cols] = scores
+    if symmetric:
+        matrix[cols, rows] = scores
+    return matrix
+
+
+def subset_matrix(matrix: Matrix, keep: np.ndarray, added: int) -> Matrix:
+    """
+    Matrix of the values keep followed by added new values whose pairs are 0 (not stored)
+    """
+    if isinstance(matrix, (SparseScores, PackedTriangle)):
+        return matrix.take(keep, len(keep) + added)
+    keep = np.asarray(keep, dtype=np.int64)
+    result = scratch_buffer((len(keep) + added,) * 2, matrix.dtype, scratch_dir_of(matrix))
+    tile_size = max(BLOCK_SCORES // max(len(matrix), 1), 1)
+    for start in range(0, len(keep), tile_size):
+        rows = keep[start:start + tile_size]
+        result[start:start + len(rows), :len(keep)] = matrix[rows][:, keep]
+    return result
+
+
+def expand_matrix(matrix: Matrix, group_ids: np.ndarray, group_scores: np.ndarray, writer: Writer) -> Matrix:
+    """
+    Symmetric matrix of all values from the matrix of their unique contents: the pair (i, j) scores like the pair of
+    their contents (group_ids[i], group_ids[j]), values of the same content score group_scores of their content
+
+    Parameters
+    ----------
+    matrix
+        symmetric similarity matrix of the unique contents (dense, packed or SparseScores)
+    group_ids
+        unique content of every value
+    group_scores
+        score of two values with the same content per unique content
+    writer
+        assembles the matrix of all values
+
+    Returns
+    -------
+    sim_matrix
+        result of the writer
+    """
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    size = len(group_ids)
+    if isinstance(matrix, SparseScores):
+        members = np.argsort(group_ids, kind='stable')  # values grouped by content in ascending order
+        counts = np.bincount(group_ids, minlength=len(group_scores))
+        starts = np.cumsum(counts) - counts
+        # pairs of values of two different contents
+        writer.write_pairs(*_member_pairs(members, starts, counts, matrix.rows, matrix.cols, matrix.scores))
+        # pairs of values of the same content
+        groups = np.flatnonzero(counts > 1)
+        writer.write_pairs(*_member_pairs(members, starts, counts, groups, groups, group_scores[groups]))
+        return writer.result()
+    tile_size = max(BLOCK_SCORES // max(size, 1), 1)
+    for start in range(0, size, tile_size):
+        stop = min(start + tile_size, size)
+        row_ids = group_ids[start:stop]
+        if isinstance(matrix, PackedTriangle):
+            unique_rows = np.stack([matrix.row(i) for i in row_ids]) if len(row_ids) else np.zeros((0, matrix.size))
+        else:
+            unique_rows = matrix[row_ids]
+        block = np.asarray(unique_rows)[:, group_ids]
+        same = row_ids[:, None] == group_ids[None, :]
+        block[same] = np.broadcast_to(group_scores[row_ids][:, None], same.shape)[same]
+        writer.write_block(slice(start, stop), slice(0, size), block)
+    return writer.result()
+
+
+def _member_pairs(members: np.ndarray, starts: np.ndarray, counts: np.ndarray, groups_a: np.ndarray,
+                  groups_b: np.ndarray, scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    All pairs (i, j), i < j, of a value i of groups_a[k] and a value j of groups_b[k] with scores[k]; within a group
+    (groups_a[k] == groups_b[k]) every pair of its values once
+    """
+    groups_a, groups_b = np.asarray(groups_a, dtype=np.int64), np.asarray(groups_b, dtype=np.int64)
+    counts_a, counts_b = counts[groups_a], counts[groups_b]
+    n_pairs = counts_a * counts_b
+    pair_group = np.repeat(np.arange(len(groups_a)), n_pairs)
+    within = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    rows = members[starts[groups_a][pair_group] + within // counts_b[pair_group]]
+    cols = members[starts[groups_b][pair_group] + within % counts_b[pair_group]]
+    # same group: both orders and the pairs of a value with itself are generated, the pairs below keep one order
+    selected = rows != cols
+    selected &= (groups_a[pair_group] != groups_b[pair_group]) | (rows < cols)
+    rows, cols, pair_group = rows[selected], cols[selected], pair_group[selected]
+    return np.minimum(rows, cols), np.maximum(rows, cols), np.asarray(scores)[pair_group]
+
+
+def max_matrix(matrices: List[Matrix], size: int) -> Matrix:
+    """
+    Element-wise maximum of dense, packed or sparse matrices; sparse as soon as one of them is sparse, packed if all
+    of them are packed
+    """
+    if len(matrices) == 1:
+        return matrices[0]
+    floors = [matrix.floor for matrix in matrices if isinstance(matrix, SparseScores)]
+    if floors:
+        result = SparseScores.empty(size, max(floors))
+        for matrix in matrices:
+            if not isinstance(matrix, SparseScores):
+                matrix = SparseScores.from_matrix(matrix, max(floors))
+            result = result.maximum(matrix)
+        return result
+    if all(isinstance(matrix, PackedTriangle) for matrix in matrices):
+        result = matrices[0]
+        for matrix in matrices[1:]:
+            result = result.maximum(matrix)
+        return result
+    scratch_dir = next((scratch_dir_of(matrix) for matrix in matrices if scratch_dir_of(matrix)), None)
+    result = scratch_buffer((size, size), np.result_type(*[matrix.dtype for matrix in matrices]), scratch_dir)
+    tile_size = max(BLOCK_SCORES // max(size, 1), 1)
+    for start in range(0, size, tile_size):
+        stop = min(start + tile_size, size)
+        for matrix in matrices:
+            block = matrix.rows(start, stop) if isinstance(matrix, PackedTriangle) else matrix[start:stop]
+            np.maximum(result[start:stop], block, out=result[start:stop])
+    return result
+
+
+def _pair_keys(rows: np.ndarray, cols: np.ndarray, size: int) -> np.ndarray:
+    return np.asarray(rows, dtype=np.int64) * size + np.asarray(cols, dtype=np.int64)
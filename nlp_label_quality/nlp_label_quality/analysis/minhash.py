@@ -0,0 +1,194 @@
+"""
+MinHash locality-sensitive hashing of character shingles for near-duplicate values
+
+Every value is the set of its character shingles (q-grams of the string, token lists are joined). The MinHash
+signature estimates the jaccard similarity of two sets: each of its hashes collides with probability jaccard(A, B).
+The signature is cut into bands of rows_per_band hashes; two values are a candidate pair if all hashes of at least one
+band are equal, i.e. with probability 1 - (1 - j ** rows_per_band) ** n_bands. Only candidate pairs are verified with
+their exact jaccard similarity, so an attribute is scored in ~O(n) instead of comparing all n^2 pairs; pairs that are
+no candidate are not guaranteed to be found (recall of the bands at the threshold, see lsh_parameters).
+"""
+import numpy as np
+from scipy import sparse
+
+from typing import Dict, Iterator, List, Tuple, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+_PRIME = (1 << 31) - 1  # hashes (a * x + b) mod prime of the shingle ids
+_BLOCK_HASHES = 2 ** 24  # hashes per block of signatures
+_BLOCK_ENTRIES = 2 ** 22  # bucket entries expanded at once for the candidates
+
+
+def lsh_parameters(threshold: float, num_perm: int = 128, recall: float = 0.95) -> Tuple[int, int]:
+    """
+    Bands for a signature of num_perm hashes: as many hashes per band as possible (fewer false positives) while pairs
+    of the threshold still become candidates with the given probability
+
+    Parameters
+    ----------
+    threshold
+        jaccard similarity the pairs of interest exceed
+    num_perm
+        maximal number of hashes of the signature
+    recall
+        probability of a pair with jaccard similarity threshold to become a candidate
+
+    Returns
+    -------
+    n_bands, rows_per_band
+        banding of the signature (n_bands * rows_per_band <= num_perm)
+    """
+    threshold = min(max(threshold, 0.0), 1.0)
+    for rows_per_band in range(num_perm, 1, -1):
+        n_bands = num_perm // rows_per_band
+        if 1.0 - (1.0 - threshold ** rows_per_band) ** n_bands >= recall:
+            return n_bands, rows_per_band
+    return num_perm, 1
+
+
+def as_string(value: Union[str, List[str]]) -> str:
+    return ' '.join(value) if isinstance(value, list) else value
+
+
+class MinHashIndex:
+    """
+    Shingle sets, MinHash signatures and LSH buckets of the content of one similarity matrix
+
+    Parameters
+    ----------
+    content
+        strings or token lists (shingled as joined strings)
+    threshold
+        jaccard similarity the relevant pairs exceed, the bands are chosen for it (see lsh_parameters)
+    num_perm
+        maximal number of hashes per signature
+    shingle_size
+        length of the character shingles, shorter strings are a single shingle
+    seed
+        seed of the hash functions (same candidates for the same content)
+    """
+
+    def __init__(self, content: Union[List[str], List[List[str]]], threshold: float = 0.5, num_perm: int = 128,
+                 shingle_size: int = 3, seed: int = 1) -> None:
+        self.size = len(content)
+        self.shingle_size = shingle_size
+        self.shingles = self._shingle_matrix([as_string(value) for value in content])
+        self.set_sizes = np.diff(self.shingles.indptr)
+        self.n_bands, self.rows_per_band = lsh_parameters(threshold, num_perm)
+        signatures = self._signatures(self.n_bands * self.rows_per_band, seed)
+        self.buckets = self._band_buckets(signatures)
+        # bucket entries of all values sorted by bucket, members of a bucket are a contiguous range
+        flat_buckets = self.buckets.ravel()
+        order = np.argsort(flat_buckets, kind='stable')
+        self.sorted_buckets = flat_buckets[order]
+        self.sorted_values = order // self.n_bands
+
+    def _shingle_matrix(self, strings: List[str]) -> sparse.csr_matrix:
+        """
+        Binary matrix (values x shingles) of the shingle sets
+        """
+        vocabulary: Dict[str, int] = {}
+        indices, indptr = [], [0]
+        for string in strings:
+            if len(string) < self.shingle_size:
+                shingles = {string} if string else set()
+            else:
+                shingles = {string[i:i + self.shingle_size] for i in range(len(string) - self.shingle_size + 1)}
+            indices.extend(sorted(vocabulary.setdefault(shingle, len(vocabulary)) for shingle in sorted(shingles)))
+            indptr.append(len(indices))
+        indices = np.array(indices, dtype=np.int64)
+        return sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, np.array(indptr)),
+                                 shape=(len(strings), max(len(vocabulary), 1)))
+
+    def _signatures(self, num_perm: int, seed: int) -> np.ndarray:
+        """
+        MinHash signatures (values x num_perm), computed block of values by block of values; values without shingles
+        keep the maximal hash
+        """
+        rng = np.random.RandomState(seed)
+        a = rng.randint(1, _PRIME, size=num_perm).astype(np.int64)
+        b = rng.randint(0, _PRIME, size=num_perm).astype(np.int64)
+        signatures = np.full((self.size, num_perm), _PRIME, dtype=np.int64)
+        indptr, ids = self.shingles.indptr, self.shingles.indices.astype(np.int64) + 1
+        filled = np.flatnonzero(self.set_sizes > 0)
+        start = 0
+        while start < len(filled):
+            stop = start + 1
+            first_shingle = indptr[filled[start]]
+            while stop < len(filled) and (indptr[filled[stop] + 1] - first_shingle) * num_perm <= _BLOCK_HASHES:
+                stop += 1
+            values = filled[start:stop]
+            offset = indptr[values[0]]
+            hashes = (ids[offset:indptr[values[-1] + 1]][:, None] * a[None, :] + b[None, :]) % _PRIME
+            signatures[values] = np.minimum.reduceat(hashes, indptr[values] - offset, axis=0)
+            start = stop
+        return signatures
+
+    def _band_buckets(self, signatures: np.ndarray) -> np.ndarray:
+        """
+        Bucket of every value in every band (values x n_bands), ids are unique over all bands; -1 without shingles
+        -> the hashes of a band are combined into one 64 bit key, colliding keys only add candidates (all candidates
+        are verified)
+        """
+        buckets = np.full((self.size, self.n_bands), -1, dtype=np.int64)
+        filled = self.set_sizes > 0
+        multipliers = np.random.RandomState(self.rows_per_band).randint(1, 2 ** 62, self.rows_per_band, dtype=np.int64)
+        multipliers = multipliers.astype(np.uint64) * np.uint64(2) + np.uint64(1)  # odd, products wrap modulo 2 ** 64
+        n_buckets = 0
+        for band in range(self.n_bands):
+            band_hashes = signatures[filled, band * self.rows_per_band:(band + 1) * self.rows_per_band]
+            if not len(band_hashes):
+                break
+            keys = (band_hashes.astype(np.uint64) * multipliers[None, :]).sum(axis=1, dtype=np.uint64)
+            _, inverse = np.unique(keys, return_inverse=True)
+            inverse = inverse.ravel()
+            buckets[filled, band] = inverse + n_buckets
+            n_buckets += int(inverse.max()) + 1
+        return buckets
+
+    def candidates(self, rows: slice) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Candidate pairs of the values of rows (queries) with all values, the values themselves included; the queries
+        are split so that the bucket members expanded at once stay bounded (large buckets of near-duplicates)
+
+        Parameters
+        ----------
+        rows
+            queries
+
+        Returns
+        -------
+        query_ids, value_ids
+            per batch of queries the pairs (query_ids[k], value_ids[k]) sharing at least one bucket, every pair once
+        """
+        query_buckets = self.buckets[rows]
+        start = rows.start or 0
+        lows = np.searchsorted(self.sorted_buckets, query_buckets, side='left')
+        highs = np.searchsorted(self.sorted_buckets, query_buckets, side='right')
+        counts = np.where(query_buckets >= 0, highs - lows, 0)
+        entries = np.cumsum(counts.sum(axis=1))
+        first = 0
+        while first < len(counts):
+            # at least one query per batch
+            last = max(int(np.searchsorted(entries, entries[first] - counts[first].sum() + _BLOCK_ENTRIES,
+                                           side='right')), first + 1)
+            yield self._expand(start + first, lows[first:last].ravel(), counts[first:last].ravel())
+            first = last
+
+    def _expand(self, first_query: int, lows: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        entry = np.repeat(np.arange(len(counts)), counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        query_ids = entry // self.n_bands
+        value_ids = self.sorted_values[lows[entry] + within]
+        keys = np.unique(query_ids * self.size + value_ids)
+        return keys // self.size + first_query, keys % self.size
+
+    def jaccard(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """
+        Exact jaccard similarity of the shingle sets of the pairs (rows[k], cols[k]), 0.0 without shingles
+        """
+        shared = np.asarray(self.shingles[rows].multiply(self.shingles[cols]).sum(axis=1)).ravel()
+        union = self.set_sizes[rows] + self.set_sizes[cols] - shared
+        return np.divide(shared, union, out=np.zeros(len(shared)), where=union > 0)
@@ -1,19 +1,31 @@
 import gensim.models.keyedvectors
 from gensim.test.utils import get_tmpfile
 from gensim.models import KeyedVectors, WordEmbeddingSimilarityIndex
+from gensim.models.keyedvectors import Vocab
+from gensim.corpora import Dictionary
+from gensim.similarities import SparseTermSimilarityMatrix
 from gensim.scripts.glove2word2vec import glove2word2vec
 
 import spacy
 
 import numpy as np
+from scipy import sparse
 from statistics import mean
+from collections import OrderedDict
 
 from nlp_label_quality.analysis.label_utils import difference_of_list_both, difference_of_str_both
+from nlp_label_quality.analysis import embedding_store
+from nlp_label_quality.analysis.quantization import QuantizedVectors, QuantizedKeyedVectors
+from nlp_label_quality.analysis.matrix_engine import (MatrixEngine, MeanVectorEngine, TokenSetEngine, DocVectorEngine,
+                                                      TokenBasis, VectorBasis)
 
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Union, Tuple
+from typing import List, Dict, Any, Union, Tuple, Iterable, Iterator
 import logging
+import os
+import tempfile
 import time
+import weakref
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -23,6 +35,42 @@ _glove_file = 'data/glove.6B.100d.txt'  # 400k vectors, 100dim
 _spacy_file_sm = 'en_core_web_sm'  # no word vectors included, so not recommended
 _spacy_file_md = 'en_core_web_md'  # 685k keys, 20k unique vectors (300 dimensions)
 
+# Pipeline profiles: components of the en_core_web models and the components every AttributeValue property needs
+# (tokens, stop/OOV flags and vectors are lexical and need no component, the lemmatizer uses the POS of the tagger)
+SPACY_COMPONENTS = ('tagger', 'parser', 'ner')
+SPACY_PROPERTY_COMPONENTS = {'processed_value': [],
+                             'glove_tokens': [],
+                             'spacy_tokens': [],
+                             'spacy_lemmas': ['tagger'],
+                             'pos_tags': ['tagger'],
+                             'dependencies': ['parser']}
+SPACY_BASE_PROPERTIES = ['spacy_tokens', 'spacy_lemmas', 'pos_tags']  # always read (nltk data, antonym check)
+SPACY_PROFILES = {'full': list(SPACY_COMPONENTS),
+                  'analysis': ['tagger'],
+                  'tokenizer': []}
+
+
+def select_spacy_components(analysis_options: List[Union[List[str], List[List[str]]]]) -> List[str]:
+    """
+    Return the spacy components that are needed for the properties the analysis_options compare
+
+    Parameters
+    ----------
+    analysis_options
+        options as defined in TkDataModel, [model, name, attribute property, function] or a list of them
+
+    Returns
+    -------
+    components
+        pipeline components to be loaded, in pipeline order
+    """
+    properties = set(SPACY_BASE_PROPERTIES)
+    for options in analysis_options:
+        for option in (options if isinstance(options[0], list) else [options]):
+            properties.add(option[2])
+    required = {component for prop in properties for component in SPACY_PROPERTY_COMPONENTS.get(prop, [])}
+    return [component for component in SPACY_COMPONENTS if component in required]
+
 
 class Model(ABC):
     """
@@ -35,6 +83,9 @@ class Model(ABC):
         name of model
     """
 
+    # similarity functions whose result depends on the order of the arguments (conditions on the first one)
+    asymmetric_functions: Tuple[str, ...] = ('calc_combine_filter_list',)
+
     def __init__(self, name: str) -> None:
         self.name = name
         logger.info(f'{self.name!r} model initializing ...')
@@ -78,6 +129,13 @@ class Model(ABC):
         #     print(f'{full_sim}, {diff_sim}, {list1}, {list2}, {appending}, {condition}')
         return appending
 
+    def get_matrix_engine(self, function: str, content: List[List[str]]) -> Union[None, MatrixEngine]:
+        """
+        Return a vectorized engine that computes the whole matrix for the given function at once,
+        None if the function can only be evaluated pair by pair
+        """
+        return None
+
     def calc_combine_max_list(self, list1, list2) -> float:
         return max(self._prep_list_elements(list1, list2))
 
@@ -123,30 +181,95 @@ class Model(ABC):
         pass
 
 
+def _keyed_vectors(words: List[str], vectors: np.ndarray, counts: List[int] = None) -> KeyedVectors:
+    """
+    KeyedVectors of the given tokens and vectors (rows in the order of words)
+    """
+    keyed_vectors = KeyedVectors(vectors.shape[1])
+    keyed_vectors.index2word = list(words)
+    keyed_vectors.vectors = vectors
+    counts = counts if counts is not None else [1] * len(words)
+    keyed_vectors.vocab = {word: Vocab(index=i, count=count) for i, (word, count) in enumerate(zip(words, counts))}
+    return keyed_vectors
+
+
 class GloVeModel(Model):
     """
     GloVe model (based on Word2Vec)
     """
 
-    # model: None / gensim.models.keyedvectors.Word2VecKeyedVectors
-    # similarity_index: Any
+    # model: None / gensim.models.keyedvectors.Word2VecKeyedVectors / QuantizedKeyedVectors (active vectors)
+    # full_model: None / gensim.models.keyedvectors.Word2VecKeyedVectors (all loaded vectors, released while quantized
+    #     unless memory-mapped)
+    # quantized_model: None / QuantizedKeyedVectors (all loaded vectors in the quantized backend)
+    # subset_model: None / Word2VecKeyedVectors / QuantizedKeyedVectors (session subset of the loaded vectors)
+    # similarity_index: WordEmbeddingSimilarityIndex of neighbour_model (built on first use)
+    # term_similarity_cache: OrderedDict, LRU cache {vocabulary: (terms, term similarity matrix)}
 
     def __init__(self, name: str = 'glove',
-                 model_file: str = _glove_file) -> None:
+                 model_file: str = _glove_file,
+                 use_store: bool = True,
+                 quantization: str = None,
+                 term_cache_size: int = 16) -> None:
         """
         Parameters
         ----------
         name: str
             name of model (logging purposes)
         model_file: str
-            filepath for pre-trained model
+            filepath for pre-trained model, None if the vectors are set afterwards (see from_vectors)
+        use_store: bool
+            text files are converted once into a memory-mapped embedding store and loaded from there afterwards
+        quantization: str
+            None for full precision, 'float16' or 'int8' for the quantized vector backend
+        term_cache_size: int
+            number of term similarity matrices that are kept for reuse (least recently used ones are evicted)
         """
         super().__init__(name)
-        self._load_model(model_file)
+        self.model_file = model_file
+        self.use_store = use_store
+        self.quantization = quantization
+        self.model = None
+        self.full_model = None
+        self.quantized_model = None
+        self.subset_model = None
+        self.subset_words = None
+        self.term_cache_size = term_cache_size
+        self.term_similarity_cache = OrderedDict()
+        self._similarity_index = None
+        if model_file is not None:
+            self._load_model(model_file)
 
     def __repr__(self):
         return 'SpaCy model'
 
+    @classmethod
+    def from_vectors(cls, words: List[str], vectors: np.ndarray, name: str = 'glove',
+                     quantization: str = None) -> 'GloVeModel':
+        """
+        GloVe model of given vectors without loading a model file (e.g. the session subset in a worker process)
+
+        Parameters
+        ----------
+        words: List[str]
+            tokens of the vectors, in the order of the rows
+        vectors: np.ndarray
+            one vector per token
+        name: str
+            name of model (logging purposes)
+        quantization: str
+            None for full precision, 'float16' or 'int8' for the quantized vector backend
+
+        Returns
+        -------
+        glove: GloVeModel
+            model whose full vocabulary are the given vectors
+        """
+        glove = cls(name, model_file=None, use_store=False, quantization=quantization)
+        glove.full_model = _keyed_vectors(words, vectors)
+        glove._activate_model()
+        return glove
+
     def _load_model(self, model_file: str):
         """
         Load GloVe model from file_location
@@ -163,12 +286,8 @@ class GloVeModel(Model):
         """
         try:
             tic = time.perf_counter()
-            binary = self.check_if_binary(model_file)
-            if not binary:
-                glove_file, model_file = model_file, get_tmpfile('glove.word2vec.txt')
-                _ = glove2word2vec(glove_file, model_file)
-            self.model = KeyedVectors.load_word2vec_format(model_file, binary=binary)
-            self.similarity_index = WordEmbeddingSimilarityIndex(self.model)
+            self.full_model = self._read_model(model_file)
+            self._activate_model()
             toc = time.perf_counter()
             logger.info(f'GloVe model loaded in {toc - tic:0.4f} seconds')
         except FileNotFoundError:
@@ -176,6 +295,195 @@ class GloVeModel(Model):
         except:
             logger.exception('Test')
 
+    def _read_model(self, model_file: str) -> KeyedVectors:
+        binary = self.check_if_binary(model_file)
+        if not binary and self.use_store:
+            return embedding_store.load_glove_model(model_file)
+        if not binary:
+            glove_file, model_file = model_file, get_tmpfile('glove.word2vec.txt')
+            _ = glove2word2vec(glove_file, model_file)
+        return KeyedVectors.load_word2vec_format(model_file, binary=binary)
+
+    def _get_full_model(self) -> KeyedVectors:
+        """
+        Full precision vectors, read from the model file again if they were released for the quantized backend
+        """
+        if self.full_model is None:
+            logger.info(f'Full precision GloVe vectors are read again from {self.model_file}')
+            self.full_model = self._read_model(self.model_file)
+        return self.full_model
+
+    def _release_full_model(self) -> None:
+        """
+        Drop the full precision vectors while the quantized backend is active; memory-mapped vectors (embedding store)
+        only occupy memory when they are read and are kept, vectors without a model file cannot be read again
+        """
+        vectors = self.full_model.vectors
+        if isinstance(vectors, np.memmap):
+            logger.info(f'Full precision GloVe vectors stay memory-mapped ({vectors.nbytes} bytes on disk)')
+        elif self.model_file is None:
+            logger.info(f'Full precision GloVe vectors are kept ({vectors.nbytes} bytes), there is no model file to '
+                        f'read them again')
+        else:
+            self.full_model = None
+            logger.info(f'Full precision GloVe vectors released ({vectors.nbytes} bytes)')
+
+    @property
+    def neighbour_model(self) -> Union[KeyedVectors, QuantizedKeyedVectors]:
+        """
+        All loaded vectors in the active backend, neighbour searches are not restricted to the session subset
+        """
+        return self.quantized_model if self.quantization else self.full_model
+
+    def restrict_to_vocabulary(self, tokens: Iterable[str], topn: int = 0) -> None:
+        """
+        Session mode: only the vectors of the given tokens (and optionally their top-N neighbours) stay active,
+        all membership tests and similarity calls afterwards run against this small subset; neighbour searches
+        (similarity_index, find_most_similar) keep using all loaded vectors (neighbour_model), so their results do not
+        change
+
+        Parameters
+        ----------
+        tokens: Iterable[str]
+            tokens found in the values of the selected attributes
+        topn: int
+            number of nearest neighbours per token that are added to the subset as well
+        """
+        tic = time.perf_counter()
+        neighbour_model = self.neighbour_model
+        words = set(token for token in tokens if token in neighbour_model.vocab)
+        if topn > 0:
+            for word in list(words):
+                words.update(neighbour for neighbour, _ in neighbour_model.most_similar(word, topn=topn))
+        indices = sorted(neighbour_model.vocab[word].index for word in words)  # keep original order of the vectors
+        self.subset_words = [neighbour_model.index2word[index] for index in indices]
+        self._activate_model()
+        toc = time.perf_counter()
+        logger.info(f'GloVe vectors restricted to {len(self.subset_words)} of {len(neighbour_model.index2word)} tokens '
+                    f'in {toc - tic:0.4f} seconds')
+
+    def reset_vocabulary(self) -> None:
+        """
+        Activate the full vocabulary again after restrict_to_vocabulary
+        """
+        self.subset_words = None
+        self._activate_model()
+
+    def set_quantization(self, quantization: Union[None, str]) -> None:
+        """
+        Switch between full precision (None) and the quantized vector backend ('float16' or 'int8'); the quantized
+        table replaces the full precision one (see _release_full_model), switching back reads it again
+        """
+        if quantization != self.quantization:
+            self._similarity_index = None  # neighbours and term similarities belong to the previous backend
+            self.term_similarity_cache.clear()
+        self.quantization = quantization
+        self._activate_model()
+
+    def _activate_model(self) -> None:
+        """
+        Derive the active model from the loaded vectors: full or session subset, optionally quantized
+        """
+        if self.quantization:
+            if self.quantized_model is None or self.quantized_model.quantized.mode != self.quantization:
+                self.quantized_model = QuantizedKeyedVectors(self._get_full_model(), self.quantization)
+                logger.info(f'GloVe vectors quantized to {self.quantization} ({self.quantized_model.nbytes} bytes)')
+                self._release_full_model()
+            base_model = self.quantized_model
+        else:
+            self.quantized_model = None
+            base_model = self._get_full_model()
+        if self.subset_words is None:
+            self.subset_model = None
+        elif self.quantization:
+            self.subset_model = base_model.subset(self.subset_words)
+        else:
+            indices = [base_model.vocab[word].index for word in self.subset_words]
+            self.subset_model = _keyed_vectors(self.subset_words,
+                                               np.array(base_model.vectors[indices], dtype=base_model.vectors.dtype),
+                                               [base_model.vocab[word].count for word in self.subset_words])
+        self.model = self.subset_model if self.subset_model is not None else base_model
+
+    def get_subset_vectors(self) -> Tuple[List[str], np.ndarray]:
+        """
+        Words and (dequantized) vectors of the session subset, e.g. to rebuild it in a worker process
+        """
+        if isinstance(self.subset_model, QuantizedKeyedVectors):
+            quantized = self.subset_model.quantized
+            return self.subset_model.index2word, quantized.dequantize(np.arange(len(quantized)))
+        return self.subset_model.index2word, self.subset_model.vectors
+
+    @property
+    def similarity_index(self) -> WordEmbeddingSimilarityIndex:
+        """
+        Term similarity index of all loaded vectors, built on first use (only soft-cosine similarities need it)
+        -> neighbours are searched in the full vocabulary (neighbour_model), independent of the session subset
+        """
+        if self._similarity_index is None:
+            self._similarity_index = WordEmbeddingSimilarityIndex(self.neighbour_model)
+        return self._similarity_index
+
+    def get_term_similarity_matrix(self, dictionary: Dictionary) -> SparseTermSimilarityMatrix:
+        """
+        Return the term similarity matrix for the terms of a dictionary, reused from an LRU cache if the same terms were
+        requested before (e.g. repeated soft-cosine analyses after a repair), the index does not change with the session
+        subset
+        -> the matrix is built in the ids of the requesting dictionary, as gensim fills the rows greedily (nonzero_limit)
+        in id order; a cached matrix requested with the same terms in another id order is permuted to it
+
+        Parameters
+        ----------
+        dictionary: Dictionary
+            mapping between terms and ids of the documents that are compared
+
+        Returns
+        -------
+        similarity_matrix: SparseTermSimilarityMatrix
+            term similarities in the ids of dictionary
+        """
+        key = frozenset(dictionary.token2id)
+        ordered_terms = [term for term, _ in sorted(dictionary.token2id.items(), key=lambda item: item[1])]
+        if key in self.term_similarity_cache:
+            self.term_similarity_cache.move_to_end(key)
+            terms, matrix = self.term_similarity_cache[key]
+            logger.info(f'Term similarity matrix of {len(terms)} terms reused from cache')
+        else:
+            tic = time.perf_counter()
+            terms = ordered_terms
+            matrix = SparseTermSimilarityMatrix(self.similarity_index, dictionary).matrix.tocsc()
+            self.term_similarity_cache[key] = (terms, matrix)
+            if len(self.term_similarity_cache) > self.term_cache_size:
+                self.term_similarity_cache.popitem(last=False)
+            toc = time.perf_counter()
+            logger.info(f'Term similarity matrix of {len(terms)} terms built in {toc - tic:0.4f} seconds')
+        if terms != ordered_terms:
+            term_ids = {term: i for i, term in enumerate(terms)}
+            permutation = [term_ids[term] for term in ordered_terms]
+            matrix = matrix[permutation][:, permutation].tocsc()
+        return SparseTermSimilarityMatrix(matrix)
+
+    def get_matrix_engine(self, function: str, content: List[List[str]]) -> Union[None, MatrixEngine]:
+        """
+        calc_similarity_list is n_similarity, i.e. the cosine of normalised mean vectors, which is a single matrix
+        product once every mean vector is known; the difference and combine functions strip shared tokens first,
+        which is done with sparse token algebra for all pairs at once
+        """
+        if function == 'calc_similarity_list':
+            return MeanVectorEngine(content, self.get_token_basis)
+        if function in TokenSetEngine.functions:
+            return TokenSetEngine(content, self.get_token_basis, function)
+        return None
+
+    def get_token_basis(self, tokens: List[str]) -> TokenBasis:
+        """
+        Vectors of the tokens for the bulk engines, quantized vectors are compared on their codes
+        """
+        if isinstance(self.model, QuantizedKeyedVectors):
+            return self.model.token_basis(tokens)
+        if not tokens:
+            return VectorBasis(np.zeros((0, self.model.vector_size), dtype=np.float32))
+        return VectorBasis(self.model[tokens])
+
     @staticmethod
     def check_if_binary(filepath: str) -> bool:
         if filepath.endswith('.txt'):
@@ -263,7 +571,7 @@ class GloVeModel(Model):
 
     def find_most_similar(self, value_list: list, depth: int = 10):
         """
-        Find similar words from a given value_list
+        Find similar words from a given value_list (searched in all loaded vectors, not only the session subset)
 
         Parameters
         ----------
@@ -280,20 +588,33 @@ class GloVeModel(Model):
         tic = time.perf_counter()
         similar_words = {}
         for i in value_list:
-            similar_words[i] = self.model.most_similar(str(i), topn=depth)
+            similar_words[i] = self.neighbour_model.most_similar(str(i), topn=depth)
         toc = time.perf_counter()
         logger.info(f'The \'find_similar_words\' process found similar words in {toc - tic} seconds')
         return similar_words
 
 
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        logger.warning(f'Temporary file {path} could not be removed')
+
+
 class SpaCyModel(Model):
     """
     SpaCy functions for preprocessing and model
     """
     model: spacy.lang
+    quantized_vectors: Union[None, QuantizedVectors]
+    doc_vectors: Dict[str, Tuple[Union[None, np.ndarray], Tuple[int, ...]]]
 
     def __init__(self, name: str = 'spacy',
-                 model_file: str = 'en_core_web_md'):
+                 model_file: str = 'en_core_web_md',
+                 quantization: str = None,
+                 batch_size: int = 1000,
+                 n_process: int = 1,
+                 profile: Union[str, List[str]] = 'full'):
         """
         Parameters
         ----------
@@ -301,9 +622,222 @@ class SpaCyModel(Model):
             name of model (logging purposes)
         model_file: str
             filepath for pre-trained model
+        quantization: str
+            None for full precision, 'float16' or 'int8' for the quantized vector backend
+        batch_size: int
+            number of texts per batch when documents are processed with nlp.pipe
+        n_process: int
+            number of processes for parsing with the full pipeline, 1 parses in the main process, -1 uses all cores
+            (every process is a fork of the caller, e.g. of the whole Tk application)
+        profile: Union[str, List[str]]
+            name of SPACY_PROFILES or list of components to load, all other components are neither loaded nor run
         """
         super().__init__(name)
+        self.model_file = model_file
+        self.quantized_vectors = None
+        self.doc_vectors = {}
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.components = SPACY_PROFILES[profile] if isinstance(profile, str) else list(profile)
         self._load_model(model_file)
+        self.set_quantization(quantization)
+
+    def set_quantization(self, quantization: Union[None, str]) -> None:
+        """
+        Switch between spaCy's own vectors (None) and the quantized vector backend ('float16' or 'int8')
+        -> the pipeline itself still reads the full precision table (static vectors of tok2vec, token.vector), so it is
+        moved into a memory-mapped file while the quantized backend is active instead of being dropped
+        """
+        self.quantization = quantization
+        if quantization:
+            self.quantized_vectors = QuantizedVectors(self.model.vocab.vectors.data, quantization)
+            logger.info(f'SpaCy vectors quantized to {quantization} ({self.quantized_vectors.nbytes} bytes)')
+            self._map_vectors()
+        else:
+            self.quantized_vectors = None
+            self._unmap_vectors()
+        self.clear_doc_vectors()  # cached vectors belong to the previous backend
+
+    def _map_vectors(self) -> None:
+        """
+        Replace the in-memory vector table by a read-only memory-mapped copy, pages are only loaded when they are read
+        """
+        vectors = self.model.vocab.vectors
+        if isinstance(vectors.data, np.memmap) or not isinstance(vectors.data, np.ndarray):
+            return
+        fd, path = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        np.save(path, vectors.data)
+        nbytes = vectors.data.nbytes
+        vectors.data = np.load(path, mmap_mode='r')
+        weakref.finalize(vectors.data, _remove_file, path)  # removed as soon as the table is restored
+        logger.info(f'Full precision spaCy vectors moved to a memory-mapped file ({nbytes} bytes)')
+
+    def _unmap_vectors(self) -> None:
+        """
+        Load a memory-mapped vector table (see _map_vectors) back into memory
+        """
+        vectors = self.model.vocab.vectors
+        if isinstance(vectors.data, np.memmap):
+            vectors.data = np.array(vectors.data)
+            logger.info(f'Full precision spaCy vectors loaded into memory ({vectors.data.nbytes} bytes)')
+
+    def pipe(self, texts: List[str]) -> Iterator[spacy.tokens.Doc]:
+        """
+        Process texts with the full pipeline in batches, in order of the input
+        -> worker processes are only started if there is more than one batch, otherwise the startup dominates
+
+        Parameters
+        ----------
+        texts
+            texts to be processed
+
+        Returns
+        -------
+        docs
+            processed documents
+        """
+        n_process = self.n_process if len(texts) > self.batch_size else 1
+        logger.info(f'Processing {len(texts)} texts with nlp.pipe (batch_size={self.batch_size}, n_process={n_process})')
+        return self.model.pipe(texts, batch_size=self.batch_size, n_process=n_process)
+
+    def _vector_rows(self, orths: Tuple[int, ...]) -> List[int]:
+        """
+        Rows of the lexical token vectors in the vector table, OOV tokens have none
+        """
+        key2row = self.model.vocab.vectors.key2row
+        return [key2row[orth] for orth in orths if orth in key2row]
+
+    def _sum_vector(self, orths: Tuple[int, ...]) -> Union[None, np.ndarray]:
+        """
+        Sum of the lexical token vectors (OOV tokens are zero), points in the same direction as Doc.vector;
+        None with quantized vectors, which are compared on their codes (see _row_weights)
+        """
+        if self.quantized_vectors is not None:
+            return None
+        vectors = self.model.vocab.vectors
+        rows = self._vector_rows(orths)
+        if not rows:
+            return np.zeros(vectors.shape[1], dtype=np.float32)
+        return vectors.data[rows].sum(axis=0, dtype=np.float32)
+
+    def _row_weights(self, orth_lists: List[Tuple[int, ...]]) -> Tuple[sparse.csr_matrix, np.ndarray]:
+        """
+        Token sums as counts over the distinct vector rows they use
+
+        Returns
+        -------
+        weights, rows
+            counts of shape (len(orth_lists), len(rows)) and the rows of the vector table
+        """
+        columns, indptr, indices = {}, [0], []
+        for orths in orth_lists:
+            indices.extend(columns.setdefault(row, len(columns)) for row in self._vector_rows(orths))
+            indptr.append(len(indices))
+        weights = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                                    shape=(len(orth_lists), len(columns)))
+        weights.sum_duplicates()
+        return weights, np.array(list(columns), dtype=np.int64)
+
+    def cache_doc_vectors(self, texts: Iterable[str]) -> None:
+        """
+        Add the document vectors of all distinct texts that are not cached yet in one nlp.pipe pass
+        -> vectors are lexical attributes, therefore no pipeline component has to run
+
+        Parameters
+        ----------
+        texts
+            texts to be cached, duplicates are processed once
+        """
+        new_texts = [text for text in dict.fromkeys(texts) if text not in self.doc_vectors]
+        if not new_texts:
+            return
+        tic = time.perf_counter()
+        docs = self.model.pipe(new_texts, batch_size=self.batch_size, disable=self.model.pipe_names)
+        for text, doc in zip(new_texts, docs):
+            orths = tuple(token.orth for token in doc)
+            self.doc_vectors[text] = (self._sum_vector(orths), orths)
+        toc = time.perf_counter()
+        logger.info(f'{len(new_texts)} document vectors cached in {toc - tic:0.4f} seconds '
+                    f'({len(self.doc_vectors)} cached in total)')
+
+    def get_doc_vector(self, text: str) -> Tuple[np.ndarray, Tuple[int, ...]]:
+        """
+        Returns
+        -------
+        vector, orths
+            sum of the token vectors (None with quantized vectors) and the token ids of the document
+        """
+        if text not in self.doc_vectors:
+            self.cache_doc_vectors([text])
+        return self.doc_vectors[text]
+
+    def clear_doc_vectors(self) -> None:
+        self.doc_vectors = {}
+
+    def _calc_cached_similarity_str(self, str1: str, str2: str) -> float:
+        """
+        Same result as Doc.similarity, but the document vectors come from the cache
+        """
+        vector1, orths1 = self.get_doc_vector(str1)
+        vector2, orths2 = self.get_doc_vector(str2)
+        if orths1 == orths2:
+            return 1.0  # spacy treats identical documents as identical even without vectors
+        if self.quantized_vectors is not None:
+            return self.quantized_vectors.mean_cosine(self._vector_rows(orths1), self._vector_rows(orths2))
+        norm = np.linalg.norm(vector1) * np.linalg.norm(vector2)
+        if norm == 0:
+            return 0.0
+        return float(np.dot(vector1, vector2) / norm)
+
+    def get_token_basis(self, tokens: List[str]) -> TokenBasis:
+        """
+        Vectors of single tokens for the bulk engines (see get_token_vectors), quantized vectors are compared on their
+        codes with every token as weights over the rows of its lexemes
+        """
+        if self.quantized_vectors is None:
+            return VectorBasis(self.get_token_vectors(tokens))
+        self.cache_doc_vectors(tokens)
+        weights, rows = self._row_weights([self.doc_vectors[token][1] for token in tokens])
+        return self.quantized_vectors.token_basis(rows, weights)
+
+    def get_token_vectors(self, tokens: List[str]) -> np.ndarray:
+        """
+        Stacked vectors of single tokens, a token string is tokenized like in a joined document (usually one token)
+        and OOV tokens are zero vectors -> their sum gives the direction of Doc.vector
+        """
+        self.cache_doc_vectors(tokens)
+        token_vectors = np.zeros((len(tokens), self.model.vocab.vectors.shape[1]), dtype=np.float32)
+        for i, token in enumerate(tokens):
+            token_vectors[i] = self.doc_vectors[token][0]
+        return token_vectors
+
+    def get_matrix_engine(self, function: str, content: Union[List[str], List[List[str]]]) -> Union[None, MatrixEngine]:
+        """
+        All list functions compare the (joined) documents by their vectors, which are sums of lexical token vectors;
+        identical documents keep the 1.0 of Doc.similarity. Plain similarities come from the cached document vectors,
+        the difference and combine functions from the cached token vectors.
+        """
+        if function in ('calc_similarity_list', 'calc_similarity_str'):
+            texts = [' '.join(value) if isinstance(value, list) else value for value in content]
+            self.cache_doc_vectors(text for text in texts if text)
+            if self.quantized_vectors is not None:
+                keys = [self.doc_vectors[text][1] if text else None for text in texts]
+                weights, rows = self._row_weights([orths if orths is not None else () for orths in keys])
+                basis = self.quantized_vectors.token_basis(rows)
+                return DocVectorEngine(content, basis.embed(weights), keys, basis)
+            vectors = np.zeros((len(texts), self.model.vocab.vectors.shape[1]), dtype=np.float32)
+            keys = []
+            for i, text in enumerate(texts):
+                if text:
+                    vectors[i], orths = self.doc_vectors[text]
+                    keys.append(orths)
+                else:
+                    keys.append(None)
+            return DocVectorEngine(content, vectors, keys)
+        if function in TokenSetEngine.functions:
+            return TokenSetEngine(content, self.get_token_basis, function, identical_is_one=True)
+        return None
 
     def _load_model(self, model_file: str) -> spacy.lang:
         """
@@ -321,9 +855,11 @@ class SpaCyModel(Model):
         """
         try:
             tic = time.perf_counter()
-            self.model = spacy.load(model_file)
+            disabled = [component for component in SPACY_COMPONENTS if component not in self.components]
+            self.model = spacy.load(model_file, disable=disabled)
             toc = time.perf_counter()
-            logger.info(f'SpaCy Model loaded in {toc - tic:0.4f} seconds')
+            logger.info(f'SpaCy Model loaded in {toc - tic:0.4f} seconds (pipeline {self.model.pipe_names}, '
+                        f'disabled {disabled})')
         except:
             logger.exception('SpaCy model could not be loaded.')
 
@@ -344,7 +880,7 @@ class SpaCyModel(Model):
             result of similarity calculation
         """
         if str1 and str2:
-            return self.model(str1).similarity(self.model(str2))
+            return self._calc_cached_similarity_str(str1, str2)
         else:
             return 0
 
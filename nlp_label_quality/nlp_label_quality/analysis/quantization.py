@@ -0,0 +1,305 @@
+"""
+Quantized vector backend for the embedding models
+
+Vectors are stored either as float16 or as int8 codes with one float32 scale per vector. Cosine scores are computed
+on the compact codes directly (int32 accumulation for int8), only the scales and norms are kept in float32. The bulk
+engines get the Gram matrix of the codes of an attribute vocabulary (token_basis), so token sums are compared without
+expanding any vector to float.
+QuantizedKeyedVectors mirrors the part of gensim's KeyedVectors interface that the analysis uses, so it can replace
+GloVeModel.model without changes in the similarity functions.
+"""
+import numpy as np
+from scipy import sparse
+
+from nlp_label_quality.analysis.matrix_engine import GramBasis, TokenBasis, VectorBasis
+
+from typing import Dict, Iterable, List, Tuple, Union
+import copy
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ('float16', 'int8')
+
+
+class QuantizedVectors:
+    """
+    Compact storage of a vector table
+
+    Parameters
+    ----------
+    vectors
+        float vectors of shape (n, dim)
+    mode
+        'float16' or 'int8' (int8 uses a symmetric per-vector scale)
+    """
+    max_gram_rows = 8192  # larger vocabularies get dequantized vectors, the Gram matrix grows with its square
+
+    def __init__(self, vectors: np.ndarray, mode: str = 'int8') -> None:
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f'Quantization mode has to be one of {QUANTIZATION_MODES} and not {mode!r}')
+        self.mode = mode
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if mode == 'float16':
+            self.codes = vectors.astype(np.float16)
+            self.scales = np.ones(len(vectors), dtype=np.float32)
+        else:
+            max_abs = np.abs(vectors).max(axis=1) if vectors.size else np.zeros(len(vectors), dtype=np.float32)
+            self.scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+            self.codes = np.rint(vectors / self.scales[:, None]).astype(np.int8)
+        self.norms = np.sqrt(self._dot_codes(self.codes, self.codes, pairwise=False)) * self.scales
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes + self.norms.nbytes
+
+    def subset(self, rows: Union[List[int], np.ndarray]) -> 'QuantizedVectors':
+        """
+        Quantized table of the given rows (codes, scales and norms are copied, nothing is quantized again)
+        """
+        subset = QuantizedVectors.__new__(QuantizedVectors)
+        subset.mode = self.mode
+        subset.codes, subset.scales, subset.norms = self.codes[rows], self.scales[rows], self.norms[rows]
+        return subset
+
+    def _dot_codes(self, codes1: np.ndarray, codes2: np.ndarray, pairwise: bool = True) -> np.ndarray:
+        """
+        Dot products of the raw codes, either all pairs (matrix) or row by row (vector)
+        """
+        accumulator = np.int32 if self.mode == 'int8' else np.float32
+        codes1, codes2 = codes1.astype(accumulator), codes2.astype(accumulator)
+        if pairwise:
+            return (codes1 @ codes2.T).astype(np.float32)
+        return np.einsum('ij,ij->i', codes1, codes2).astype(np.float32)
+
+    def dequantize(self, rows: Union[int, List[int], np.ndarray]) -> np.ndarray:
+        """
+        Return float32 approximation of the given rows
+        """
+        return self.codes[rows].astype(np.float32) * self.scales[rows][..., None]
+
+    def cosine_to_all(self, row: int, block_size: int = 1 << 16) -> np.ndarray:
+        """
+        Cosine similarity of one stored vector to all stored vectors, computed on the codes block by block
+        """
+        query = self.codes[row:row + 1]
+        dots = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), block_size):
+            dots[start:start + block_size] = self._dot_codes(self.codes[start:start + block_size], query)[:, 0]
+        dots *= self.scales * self.scales[row]
+        norms = self.norms * self.norms[row]
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+    def gram(self, rows: Union[List[int], np.ndarray]) -> np.ndarray:
+        """
+        Inner products of the given rows, accumulated on the codes (int32 for int8) and scaled afterwards
+        """
+        codes, scales = self.codes[rows], self.scales[rows]
+        return self._dot_codes(codes, codes) * scales[:, None] * scales[None, :]
+
+    def token_basis(self, rows: Union[List[int], np.ndarray], mapping: sparse.csr_matrix = None) -> TokenBasis:
+        """
+        Token basis of the given rows for the bulk engines: their Gram matrix on the codes, dequantized vectors only if
+        there are more than max_gram_rows rows
+
+        Parameters
+        ----------
+        rows
+            distinct rows of the vocabulary of an attribute
+        mapping
+            weights of every token over the rows (tokens made of several vectors), the rows themselves if None
+        """
+        if len(rows) > self.max_gram_rows:
+            logger.info(f'{len(rows)} vectors exceed the Gram matrix of {self.max_gram_rows} rows, dequantized instead')
+            vectors = self.dequantize(rows)
+            return VectorBasis(mapping @ vectors if mapping is not None else vectors)
+        return GramBasis(self.gram(rows), mapping)
+
+    def cosine_to_vector(self, vector: np.ndarray, stop: int = None, block_size: int = 1 << 16) -> np.ndarray:
+        """
+        Cosine similarity of a float vector to the stored vectors (the first stop ones, all if None), block by block
+        """
+        stop = len(self.codes) if stop is None else min(stop, len(self.codes))
+        vector = np.asarray(vector, dtype=np.float32)
+        dots = np.empty(stop, dtype=np.float32)
+        for start in range(0, stop, block_size):
+            dots[start:min(start + block_size, stop)] = self.codes[start:min(start + block_size, stop)] @ vector
+        dots *= self.scales[:stop]
+        norms = self.norms[:stop] * np.linalg.norm(vector)
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+    def mean_cosine(self, rows1: List[int], rows2: List[int]) -> float:
+        """
+        Cosine similarity between the mean vectors of two row selections, computed on the codes
+        -> dot(sum1, sum2) = s1^T (C1 C2^T) s2, the norms of the sums follow the same way
+
+        Parameters
+        ----------
+        rows1
+            rows of first selection, duplicates count multiple times
+        rows2
+            rows of second selection, duplicates count multiple times
+
+        Returns
+        -------
+        similarity
+            0.0 if one of the selections has no norm
+        """
+        if not len(rows1) or not len(rows2):
+            return 0.0
+        scales1, scales2 = self.scales[rows1], self.scales[rows2]
+        codes1, codes2 = self.codes[rows1], self.codes[rows2]
+        dot = scales1 @ self._dot_codes(codes1, codes2) @ scales2
+        norm1 = scales1 @ self._dot_codes(codes1, codes1) @ scales1
+        norm2 = scales2 @ self._dot_codes(codes2, codes2) @ scales2
+        if norm1 <= 0 or norm2 <= 0:
+            return 0.0
+        return float(dot / np.sqrt(norm1 * norm2))
+
+
+class QuantizedKeyedVectors:
+    """
+    Drop-in replacement for gensim KeyedVectors (membership, lookup, n_similarity, similarity, most_similar without
+    an approximate nearest neighbour indexer)
+
+    Parameters
+    ----------
+    keyed_vectors
+        gensim KeyedVectors to be quantized
+    mode
+        'float16' or 'int8'
+    """
+
+    def __init__(self, keyed_vectors: 'KeyedVectors', mode: str = 'int8') -> None:
+        self.vocab = keyed_vectors.vocab
+        self.index2word = keyed_vectors.index2word
+        self.vector_size = keyed_vectors.vector_size
+        self.quantized = QuantizedVectors(keyed_vectors.vectors, mode)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.vocab
+
+    def __getitem__(self, words: Union[str, Iterable[str]]) -> np.ndarray:
+        if isinstance(words, str):
+            return self.quantized.dequantize(self.vocab[words].index)
+        return self.quantized.dequantize(self._rows(words))
+
+    @property
+    def nbytes(self) -> int:
+        return self.quantized.nbytes
+
+    def _rows(self, words: Iterable[str]) -> List[int]:
+        return [self.vocab[word].index for word in words]
+
+    def subset(self, words: List[str]) -> 'QuantizedKeyedVectors':
+        """
+        Quantized vectors of the given words only (e.g. the session subset), in the order of words
+        """
+        subset = QuantizedKeyedVectors.__new__(QuantizedKeyedVectors)
+        subset.index2word = list(words)
+        subset.vocab = {}
+        for i, word in enumerate(subset.index2word):
+            subset.vocab[word] = copy.copy(self.vocab[word])
+            subset.vocab[word].index = i
+        subset.vector_size = self.vector_size
+        subset.quantized = self.quantized.subset(self._rows(words))
+        return subset
+
+    def token_basis(self, words: List[str]) -> TokenBasis:
+        """
+        Token basis of words for the bulk engines, computed on the codes (see QuantizedVectors.token_basis)
+        """
+        return self.quantized.token_basis(self._rows(words))
+
+    def similarity(self, w1: str, w2: str) -> float:
+        return self.quantized.mean_cosine(self._rows([w1]), self._rows([w2]))
+
+    def n_similarity(self, ws1: List[str], ws2: List[str]) -> float:
+        if not (len(ws1) and len(ws2)):
+            raise ZeroDivisionError('At least one of the passed list is empty.')  # same behaviour as gensim
+        return self.quantized.mean_cosine(self._rows(ws1), self._rows(ws2))
+
+    def most_similar(self,
+                     positive: Union[str, np.ndarray, List[Union[str, np.ndarray, Tuple[str, float]]]] = None,
+                     negative: Union[str, np.ndarray, List[Union[str, np.ndarray, Tuple[str, float]]]] = None,
+                     topn: int = 10,
+                     restrict_vocab: int = None,
+                     indexer: object = None) -> Union[List[Tuple[str, float]], np.ndarray]:
+        """
+        Top-N most similar words like gensim's KeyedVectors.most_similar: the query is the normalised mean of the unit
+        vectors of the positive words minus the ones of the negative words (words, vectors or (word, weight) tuples),
+        its cosine to all vectors is computed on the compact codes; the input words are not part of the result
+
+        Parameters
+        ----------
+        positive
+            words (or vectors) that contribute positively
+        negative
+            words (or vectors) that contribute negatively
+        topn
+            number of most similar words, all similarities (in vocabulary order) if None
+        restrict_vocab
+            only the first restrict_vocab vectors are searched
+        indexer
+            not supported, approximate nearest neighbour indexers need the full precision vectors
+
+        Returns
+        -------
+        similar_words
+            (word, cosine similarity) in descending order, or the array of all similarities if topn is not set
+        """
+        if indexer is not None:
+            raise ValueError('QuantizedKeyedVectors.most_similar does not support an indexer')
+        if isinstance(topn, int) and topn < 1:
+            return []
+        positive = [positive] if isinstance(positive, (str, np.ndarray)) else list(positive or [])
+        negative = [negative] if isinstance(negative, (str, np.ndarray)) else list(negative or [])
+        weighted = [(item, 1.0) if isinstance(item, (str, np.ndarray)) else item for item in positive]
+        weighted += [(item, -1.0) if isinstance(item, (str, np.ndarray)) else item for item in negative]
+        if not weighted:
+            raise ValueError('cannot compute similarity with no input')  # same behaviour as gensim
+
+        vectors, input_rows = [], set()
+        for item, weight in weighted:
+            if isinstance(item, np.ndarray):
+                vectors.append(weight * np.asarray(item, dtype=np.float32))
+                continue
+            row = self.vocab[item].index
+            input_rows.add(row)
+            norm = self.quantized.norms[row]
+            unit = self.quantized.dequantize(row) / norm if norm > 0 else self.quantized.dequantize(row)
+            vectors.append(weight * unit)
+        sims = self.quantized.cosine_to_vector(np.mean(vectors, axis=0), restrict_vocab)
+        if not topn:
+            return sims
+        n_best = min(topn + len(input_rows), len(sims))
+        best = np.argpartition(-sims, n_best - 1)[:n_best] if n_best < len(sims) else np.arange(len(sims))
+        best = best[np.argsort(-sims[best], kind='stable')]
+        return [(self.index2word[i], float(sims[i])) for i in best if i not in input_rows][:topn]
+
+
+def quantization_report(full_vectors: np.ndarray, quantized: QuantizedVectors) -> Dict[str, float]:
+    """
+    Memory and reconstruction error of a quantized table in comparison to its full precision version
+
+    Parameters
+    ----------
+    full_vectors
+        original vectors
+    quantized
+        compact version of full_vectors
+
+    Returns
+    -------
+    report
+        bytes of both versions, compression factor and maximal / mean absolute reconstruction error
+    """
+    error = np.abs(np.asarray(full_vectors, dtype=np.float32) - quantized.dequantize(np.arange(len(quantized))))
+    return {'full_bytes': int(full_vectors.nbytes),
+            'quantized_bytes': int(quantized.nbytes),
+            'compression': full_vectors.nbytes / max(quantized.nbytes, 1),
+            'max_abs_error': float(error.max()) if error.size else 0.0,
+            'mean_abs_error': float(error.mean()) if error.size else 0.0}
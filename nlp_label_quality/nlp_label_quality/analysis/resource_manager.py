@@ -0,0 +1,159 @@
+from nltk.corpus import wordnet
+
+from nlp_label_quality.analysis import analysis_utils
+from nlp_label_quality.analysis.nlp_models import GloVeModel, SpaCyModel, select_spacy_components
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, List, Tuple, Union
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _load_wordnet() -> Any:
+    """
+    WordNet is a LazyCorpusLoader, the first lookup reads the corpus files from disk
+    """
+    wordnet.synsets('test')
+    return wordnet
+
+
+def get_default_loaders(analysis_options: List[Union[List[str], List[List[str]]]] = None,
+                        spacy_processes: int = 1) -> Dict[str, Callable[[], Any]]:
+    """
+    Return loader functions for all NLP resources the analysis needs
+
+    Parameters
+    ----------
+    analysis_options
+        options of the analysis, spacy only loads the pipeline components they need (full pipeline if None)
+    spacy_processes
+        processes of spaCy's nlp.pipe (1 = main process only, -1 = all cores)
+
+    Returns
+    -------
+    loaders
+        {resource name: function returning the loaded resource}
+    """
+    profile = select_spacy_components(analysis_options) if analysis_options is not None else 'full'
+    return {'spacy': lambda: SpaCyModel('spacy', profile=profile, n_process=spacy_processes),
+            'glove': lambda: GloVeModel('glove'),
+            'wordnet': _load_wordnet,
+            'verbocean': analysis_utils.get_antonyms_from_verbocean}
+
+
+class ResourceManager:
+    """
+    ResourceManager loads the NLP resources in background workers so that loading overlaps with the time the user spends
+    on importing the log and selecting attributes; the controller awaits the resources before the analysis starts
+
+    Parameters
+    ----------
+    loaders
+        {resource name: function returning the loaded resource}, default loaders for spacy, glove, wordnet and verbocean
+    max_workers
+        number of background threads
+    """
+
+    def __init__(self, loaders: Dict[str, Callable[[], Any]] = None, max_workers: int = 4) -> None:
+        self.loaders = loaders if loaders is not None else get_default_loaders()
+        self.max_workers = max_workers
+        self._executor = None
+        self._futures: Dict[str, Future] = {}
+
+    def start(self) -> None:
+        """
+        Submit all loaders to the background workers, calling it again has no effect
+        """
+        if self._futures:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='resource')
+        for name, loader in self.loaders.items():
+            self._futures[name] = self._executor.submit(self._load, name, loader)
+        self._executor.shutdown(wait=False)  # workers finish their queue, no new tasks are accepted
+        logger.info(f'Background loading of {list(self.loaders)} started ...')
+
+    def retry(self, names: List[str]) -> None:
+        """
+        Submit the loaders of the given (failed) resources again, e.g. after a missing model was installed
+        """
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(names)), thread_name_prefix='resource')
+        for name in names:
+            self._futures[name] = executor.submit(self._load, name, self.loaders[name])
+        executor.shutdown(wait=False)
+        logger.info(f'Background loading of {names} restarted ...')
+
+    @staticmethod
+    def _load(name: str, loader: Callable[[], Any]) -> Any:
+        tic = time.perf_counter()
+        resource = loader()
+        toc = time.perf_counter()
+        logger.info(f'Resource {name!r} loaded in background in {toc - tic:0.4f} seconds')
+        return resource
+
+    def future(self, name: str) -> Future:
+        """
+        Return the future of a resource, loading is started if it has not happened yet
+        """
+        self.start()
+        return self._futures[name]
+
+    def result(self, name: str, timeout: float = None) -> Any:
+        """
+        Return loaded resource and block until it is available
+
+        Parameters
+        ----------
+        name
+            name of resource
+        timeout
+            seconds to wait at most, None waits until the resource is loaded
+
+        Returns
+        -------
+        resource
+            loaded resource, exceptions of the loader are raised here
+        """
+        return self.future(name).result(timeout)
+
+    def is_ready(self, name: str) -> bool:
+        return bool(self._futures) and self._futures[name].done()
+
+    def all_ready(self) -> bool:
+        return bool(self._futures) and all(future.done() for future in self._futures.values())
+
+    def get_failed(self) -> List[str]:
+        return [name for name, future in self._futures.items() if future.done() and future.exception() is not None]
+
+    def get_errors(self) -> Dict[str, BaseException]:
+        """
+        Returns
+        -------
+        errors
+            {resource name: exception of the loader} of all failed resources
+        """
+        return {name: self._futures[name].exception() for name in self.get_failed()}
+
+    def get_progress(self) -> Tuple[int, int]:
+        """
+        Returns
+        -------
+        ready, total
+            number of finished resources and number of all resources
+        """
+        ready = sum(1 for future in self._futures.values() if future.done())
+        return ready, len(self.loaders)
+
+    def get_status(self) -> str:
+        """
+        Return readable loading state for the status bar
+        """
+        ready, total = self.get_progress()
+        failed = self.get_failed()
+        if failed:
+            return f'NLP resources could not be loaded: {failed}'
+        if self._futures and ready == total:
+            return f'NLP resources ready ({", ".join(self.loaders)})'
+        loading = [name for name in self.loaders if not self.is_ready(name)]
+        return f'Loading NLP resources in background ({ready}/{total} ready, waiting for {", ".join(loading)}) ...'
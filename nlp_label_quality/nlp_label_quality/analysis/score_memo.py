@@ -0,0 +1,260 @@
+"""
+Memo of pairwise similarity scores that is shared by all analysis steps of a session
+
+The default analysis schedule compares the same labels with the same model and function several times (e.g. four
+levenshtein steps on processed_value); after a repair most labels are unchanged. Scores of pair-local similarity
+functions only depend on both values, so they are kept across the steps and only the missing pairs are computed.
+"""
+import numpy as np
+
+from nlp_label_quality.analysis.matrix_storage import Matrix, Writer, pair_values
+
+from typing import Callable, Dict, Hashable, List, Tuple, Union
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+MemoNamespace = Tuple[str, str, str]  # (sim_model, function, attr_property)
+
+
+class _PairStore:
+    """
+    Scores of the pairs of one namespace as arrays sorted by pair key (id_a << 32 | id_b of the value ids)
+
+    scores are NaN for pruned pairs whose score is only known to not exceed bounds; stamps are the memo clock of the
+    last matrix that used the pair (least recently used pairs are evicted)
+    """
+
+    def __init__(self) -> None:
+        self.ids: Dict[Hashable, int] = {}
+        self.keys = np.empty(0, dtype=np.int64)
+        self.scores = np.empty(0, dtype=np.float64)
+        self.bounds = np.empty(0, dtype=np.float32)
+        self.stamps = np.empty(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def value_ids(self, values: List[Hashable]) -> np.ndarray:
+        ids = self.ids
+        return np.array([ids.setdefault(value, len(ids)) for value in values], dtype=np.int64)
+
+    def find(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return positions, found
+
+    def keep(self, kept: np.ndarray) -> None:
+        self.keys, self.scores = self.keys[kept], self.scores[kept]
+        self.bounds, self.stamps = self.bounds[kept], self.stamps[kept]
+
+
+class ScoreMemo:
+    """
+    LRU memo of similarity scores keyed by (sim_model, function, attr_property, value_a, value_b)
+
+    Values are mapped to ids per namespace and the pairs are kept in sorted arrays, so that all pairs of a matrix are
+    looked up and stored vectorised. Pairs that levenshtein blocking pruned at a threshold are stored as NaN with the
+    threshold as bound (their score is only known to not exceed it); they count as hits for steps with the same or a
+    higher threshold. Matrices with more pairs than the memory cap are computed without the memo (they would evict
+    everything stored before and themselves).
+
+    Parameters
+    ----------
+    max_pairs
+        memory cap in stored pairs (roughly 30 bytes each), the pairs of the least recently used matrices are evicted
+        beyond it
+    max_missing
+        fraction of missing pairs up to which only the missing pairs are computed, above it the whole matrix is
+        computed the regular way (tiles, engines) and stored
+    """
+
+    def __init__(self, max_pairs: int = 1000000, max_missing: float = 0.5) -> None:
+        self.max_pairs = max_pairs
+        self.max_missing = max_missing
+        self._stores: Dict[MemoNamespace, _PairStore] = {}
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+
+    def __len__(self) -> int:
+        return sum(len(store) for store in self._stores.values())
+
+    @staticmethod
+    def _hashable(value: Union[str, List[str]]) -> Hashable:
+        return tuple(value) if isinstance(value, list) else value
+
+    @staticmethod
+    def _pair_keys(ids: np.ndarray, rows: np.ndarray, cols: np.ndarray, symmetric: bool) -> np.ndarray:
+        ids_a, ids_b = ids[rows], ids[cols]
+        if symmetric:  # both orders of a symmetric function share one entry
+            ids_a, ids_b = np.minimum(ids_a, ids_b), np.maximum(ids_a, ids_b)
+        return (ids_a << 32) | ids_b
+
+    def get_many(self,
+                 namespace: MemoNamespace,
+                 ids: np.ndarray,
+                 rows: np.ndarray,
+                 cols: np.ndarray,
+                 symmetric: bool,
+                 min_score: float = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up the scores of the pairs (ids[rows[k]], ids[cols[k]]) of value ids
+
+        Returns
+        -------
+        scores, found
+            stored scores (0 for pruned pairs) and whether the pair was found
+        """
+        scores = np.zeros(len(rows))
+        store = self._stores.get(namespace)
+        if store is None or not len(store):
+            found = np.zeros(len(rows), dtype=bool)
+        else:
+            positions, found = store.find(self._pair_keys(ids, rows, cols, symmetric))
+            stored = store.scores[positions[found]]
+            pruned = np.isnan(stored)
+            if min_score is None:
+                usable = ~pruned
+            else:  # pruned pair, only known to not exceed its bound
+                usable = ~pruned | (store.bounds[positions[found]] <= min_score)
+            hit = np.flatnonzero(found)[usable]
+            found[:] = False
+            found[hit] = True
+            scores[hit] = np.where(pruned[usable], 0.0, stored[usable])
+            store.stamps[positions[hit]] = self._clock
+        hits = int(found.sum())
+        self.hits += hits
+        self.misses += len(rows) - hits
+        return scores, found
+
+    def put_many(self,
+                 namespace: MemoNamespace,
+                 ids: np.ndarray,
+                 rows: np.ndarray,
+                 cols: np.ndarray,
+                 scores: np.ndarray,
+                 symmetric: bool,
+                 min_score: float = None) -> None:
+        """
+        Store the scores of the pairs (ids[rows[k]], ids[cols[k]]) of value ids, zeros of a blocked computation
+        (min_score) are stored as pruned pairs
+        """
+        store = self._stores.setdefault(namespace, _PairStore())
+        keys, first = np.unique(self._pair_keys(ids, rows, cols, symmetric), return_index=True)
+        scores = np.asarray(scores, dtype=np.float64)[first]
+        bounds = np.full(len(keys), np.nan, dtype=np.float32)
+        if min_score is not None and min_score > 0:
+            pruned = scores == 0.0
+            scores[pruned] = np.nan
+            bounds[pruned] = min_score
+        positions, found = store.find(keys)
+        # pairs pruned at a higher threshold are replaced by their score
+        store.scores[positions[found]] = scores[found]
+        store.bounds[positions[found]] = bounds[found]
+        store.stamps[positions[found]] = self._clock
+        new = ~found
+        if np.any(new):
+            merged_keys = np.concatenate([store.keys, keys[new]])
+            order = np.argsort(merged_keys, kind='stable')
+            store.keys = merged_keys[order]
+            store.scores = np.concatenate([store.scores, scores[new]])[order]
+            store.bounds = np.concatenate([store.bounds, bounds[new]])[order]
+            store.stamps = np.concatenate([store.stamps, np.full(int(new.sum()), self._clock, dtype=np.int64)])[order]
+        self._evict()
+
+    def _evict(self) -> None:
+        """
+        Drop the pairs of the least recently used matrices (whole clock stamps) until at most max_pairs are stored
+        """
+        excess = len(self) - self.max_pairs
+        if excess <= 0:
+            return
+        stamps, counts = np.unique(np.concatenate([store.stamps for store in self._stores.values()]),
+                                   return_counts=True)
+        oldest = stamps[min(int(np.searchsorted(np.cumsum(counts), excess)), len(stamps) - 1)]
+        for store in self._stores.values():
+            kept = store.stamps > oldest
+            self.evictions += len(kept) - int(kept.sum())
+            store.keep(kept)
+
+    def get_sim_matrix(self,
+                       name: str,
+                       namespace: MemoNamespace,
+                       content: Union[List[str], List[List[str]]],
+                       calc_matrix: Callable[[], Matrix],
+                       calc_pairs: Callable[[np.ndarray, np.ndarray], np.ndarray],
+                       writer: Writer,
+                       symmetric: bool = True,
+                       full: bool = False,
+                       min_score: float = None) -> Matrix:
+        """
+        Similarity matrix of content with all stored pairs taken from the memo
+
+        Parameters
+        ----------
+        name
+            name of matrix (logging purposes)
+        namespace
+            (sim_model, function, attr_property) of the matrix
+        content
+            content to compare similarity for
+        calc_matrix
+            computes the whole matrix the regular way
+        calc_pairs
+            computes the scores of the pairs (content[rows[k]], content[cols[k]])
+        writer
+            assembles the matrix from the pairs (dense or the scores above its floor only)
+        symmetric
+            only the upper triangle is looked up and mirrored
+        full
+            all pairs of asymmetric functions are needed, otherwise the upper triangle only
+        min_score
+            threshold up to which the matrix is exact (blocked levenshtein computation, floor of a sparse matrix)
+
+        Returns
+        -------
+        sim_matrix
+            same matrix as calc_matrix
+        """
+        tic = time.perf_counter()
+        size = len(content)
+        upper = symmetric or not full
+        n_pairs = size * (size + 1) // 2 if upper else size * size
+        if n_pairs > self.max_pairs:
+            self.skipped += 1
+            logger.info(f'Score memo {namespace} for {name}: {n_pairs} pairs exceed the memo of {self.max_pairs} '
+                        f'pairs, computed without it')
+            return calc_matrix()
+        self._clock += 1
+        store = self._stores.setdefault(namespace, _PairStore())
+        ids = store.value_ids([self._hashable(value) for value in content])
+        if upper:
+            rows, cols = np.triu_indices(size)
+        else:
+            rows, cols = np.divmod(np.arange(size * size), size)
+        scores, found = self.get_many(namespace, ids, rows, cols, symmetric, min_score)
+        missing = np.flatnonzero(~found)
+
+        if len(missing) > self.max_missing * len(rows):
+            sim_matrix = calc_matrix()
+            scores = pair_values(sim_matrix, rows[missing], cols[missing])
+            self.put_many(namespace, ids, rows[missing], cols[missing], scores, symmetric, min_score)
+        else:
+            if len(missing):
+                scores[missing] = calc_pairs(rows[missing], cols[missing])
+                self.put_many(namespace, ids, rows[missing], cols[missing], scores[missing], symmetric, min_score)
+            writer.write_pairs(rows, cols, scores)
+            sim_matrix = writer.result()
+        toc = time.perf_counter()
+        logger.info(f'Score memo {namespace} for {name}: {len(rows) - len(missing)} hits, {len(missing)} misses in '
+                    f'{toc - tic:0.4f} seconds (session: {self.hits} hits, {self.misses} misses, {len(self)} pairs '
+                    f'stored, {self.evictions} evicted, {self.skipped} matrices too large)')
+        return sim_matrix
+
+    def clear(self) -> None:
+        self._stores.clear()
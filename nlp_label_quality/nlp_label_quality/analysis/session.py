@@ -0,0 +1,159 @@
+"""
+State of one analysis session that outlives the single analysis steps
+"""
+from nlp_label_quality.analysis.attribute_value import Attribute
+from nlp_label_quality.analysis.nlp_models import GloVeModel, SpaCyModel
+from nlp_label_quality.analysis.score_memo import ScoreMemo
+from nlp_label_quality.analysis.tiled_executor import TiledExecutor
+
+import numpy as np
+
+from typing import Any, Dict, List, Union
+import logging
+import os
+import shutil
+import tempfile
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisSession:
+    """
+    AnalysisSession bundles the models and the execution resources that are shared by all analysis steps of a log
+
+    Parameters
+    ----------
+    nlp
+        spacy Model
+    glove
+        KeyedVectors model
+    max_workers
+        number of worker processes for tiled similarity matrices, None uses all cores, 1 computes in the main process
+    tile_size
+        number of rows and columns per tile
+    min_tiled_size
+        attributes with fewer values are computed in the main process
+    memo_pairs
+        memory cap of the score memo shared by the analysis steps (stored pairs), 0 disables it; matrices with
+        more pairs are computed without the memo
+    incremental
+        keep the Attributes and their matrices between the analysis steps and only update them after repairs
+    sparse_results
+        similarity matrices only keep the scores above the threshold of their step (SparseScores) instead of n x n
+    matrix_dtype
+        dtype of the stored scores ('float32', 'float16' halves the memory again at ~3 significant digits)
+    packed_matrices
+        dense matrices only store their upper triangle packed row by row (PackedTriangle)
+    fused_max
+        combined steps compute the max matrix of their options row by row instead of one matrix per option
+    scratch_dir
+        dense and packed matrices of large attributes are memory-mapped to temporary files in a directory created
+        within scratch_dir (removed when the session is closed), all matrices stay in memory if None
+    memmap_min_size
+        attributes with fewer values keep their matrices in memory
+    dedupe_content
+        symmetric pair-local similarities only score the unique contents of the values, values of the same content
+        are perfect matches
+    """
+
+    def __init__(self,
+                 nlp: SpaCyModel,
+                 glove: GloVeModel,
+                 max_workers: Union[None, int] = 1,
+                 tile_size: int = 256,
+                 min_tiled_size: int = 1000,
+                 memo_pairs: int = 1000000,
+                 incremental: bool = True,
+                 sparse_results: bool = True,
+                 matrix_dtype: str = 'float32',
+                 packed_matrices: bool = False,
+                 fused_max: bool = True,
+                 scratch_dir: str = None,
+                 memmap_min_size: int = 20000,
+                 dedupe_content: bool = True) -> None:
+        self.nlp = nlp
+        self.glove = glove
+        self.executor = TiledExecutor({'spacy': nlp, 'glove': glove}, max_workers, tile_size, min_tiled_size)
+        self.memo = ScoreMemo(memo_pairs) if memo_pairs else None
+        self.incremental = incremental
+        self.sparse_results = sparse_results
+        self.matrix_dtype = np.dtype(matrix_dtype)
+        self.packed_matrices = packed_matrices
+        self.fused_max = fused_max
+        self.scratch_dir = scratch_dir
+        self.memmap_min_size = memmap_min_size
+        self.dedupe_content = dedupe_content
+        self._scratch_path: Union[None, str] = None
+        self._remove_scratch = None
+        self.attributes: Dict[str, Attribute] = {}
+
+    def get_executor(self, size: int) -> Union[None, TiledExecutor]:
+        """
+        Return the tiled executor if a matrix of the given size should be computed in the worker processes
+        """
+        return self.executor if self.executor.should_tile(size) else None
+
+    def matrix_storage(self, size: int) -> Dict[str, Any]:
+        """
+        Storage of the dense and packed similarity matrices of an attribute with the given number of values (keyword
+        arguments of matrix_storage.new_writer)
+        """
+        return {'dtype': self.matrix_dtype, 'packed': self.packed_matrices, 'scratch_dir': self._get_scratch_path(size)}
+
+    def _get_scratch_path(self, size: int) -> Union[None, str]:
+        """
+        Temporary directory of the memory-mapped matrices, created on first use and removed at the latest at exit
+        """
+        if self.scratch_dir is None or size < self.memmap_min_size:
+            return None
+        if self._scratch_path is None:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+            self._scratch_path = tempfile.mkdtemp(prefix='nlp_label_quality_', dir=self.scratch_dir)
+            self._remove_scratch = weakref.finalize(self, shutil.rmtree, self._scratch_path, ignore_errors=True)
+            logger.info(f'Large similarity matrices are memory-mapped in {self._scratch_path}')
+        return self._scratch_path
+
+    def get_attributes(self, attribute_content: Dict[str, Dict[str, int]]) -> List[Attribute]:
+        """
+        Attributes of the current content; in incremental mode the Attributes of the former step are updated with
+        the changes of a repair instead of being rebuilt
+
+        Parameters
+        ----------
+        attribute_content
+            content to be analyzed {attr1: {'attr_value1': count, ...}, attr2: ...}
+
+        Returns
+        -------
+        attributes
+            one Attribute per attribute of the content
+        """
+        attributes = []
+        for attr, values in attribute_content.items():
+            attribute = self.attributes.get(attr) if self.incremental else None
+            if attribute is None:
+                attribute = Attribute(attr, values, self.nlp, self.glove, self)
+            else:
+                attribute.update_values(values)
+            attributes.append(attribute)
+        self.attributes = {attribute.attr: attribute for attribute in attributes} if self.incremental else {}
+        return attributes
+
+    def reset_log(self) -> None:
+        """
+        Forget all Attributes and memoized scores (a new log is analysed with differently restricted models)
+        """
+        self.attributes = {}
+        if self.memo is not None:
+            self.memo.clear()
+
+    def close(self) -> None:
+        """
+        Stop all worker processes of the session and remove the memory-mapped matrices
+        """
+        self.executor.shutdown()
+        self.attributes = {}
+        if self._remove_scratch is not None:
+            self._remove_scratch()
+            self._scratch_path, self._remove_scratch = None, None
@@ -5,11 +5,12 @@ from gensim.similarities import SparseTermSimilarityMatrix, MatrixSimilarity, Le
 import numpy as np
 
 from nlp_label_quality.analysis.nlp_models import GloVeModel, SpaCyModel
+from nlp_label_quality.analysis.matrix_storage import Matrix, Writer, new_writer, score_bound, update_pairs
 
 from . import sim_utils
 from abc import ABC, abstractmethod
 
-from typing import List, Dict, Union
+from typing import Callable, List, Dict, Tuple, Union
 import time
 import logging
 import warnings
@@ -22,13 +23,75 @@ logger.setLevel(logging.ERROR)
 class SimMatrix(ABC):
     """
     Abstract Base class for SimMatrix to ensure that all implementations have the same functionality
+
+    Only the upper triangle is computed; for symmetric similarities it is mirrored to a full matrix, for asymmetric ones
+    the lower triangle stays zero unless full is set (all results are taken from the upper triangle anyway)
+
+    Matrices of pair-local functions with a memo_namespace (sim_model, function, attr_property) take the scores of
+    already compared pairs from the score memo of the session; with a previous matrix of the same values (incremental
+    mode after a repair) only the pairs of its stale rows and columns are computed
+
+    With a floor the rows are streamed into a SparseWriter and sim_matrix is SparseScores of the upper triangle above
+    the floor (results of thresholds >= floor are the same as from the dense matrix); otherwise the scores are written
+    into a preallocated buffer of the session's dtype (float32 by default), packed if the session packs matrices
     """
+    symmetric: bool = True
 
-    def __init__(self, name: str, content: List[List[str]]) -> None:
+    def __init__(self, name: str, content: List[List[str]], full: bool = False,
+                 session: 'AnalysisSession' = None, memo_namespace: Tuple[str, str, str] = None,
+                 previous: Tuple[Matrix, np.ndarray] = None, floor: float = None) -> None:
         self.name = name
         self.content = content
+        self.full = full
+        self.session = session
+        self.memo_namespace = memo_namespace
+        self.previous = previous  # (matrix, valid) -> valid[i] is False for new values whose pairs are missing
+        self.floor = floor
         self.sim_matrix = None
 
+    def _new_writer(self) -> Writer:
+        storage = {} if self.session is None else self.session.matrix_storage(len(self.content))
+        return new_writer(len(self.content), self.symmetric, self.symmetric or not self.full, self.floor, **storage)
+
+    def _get_executor(self) -> Union[None, 'TiledExecutor']:
+        """
+        Tiled executor of the session if this matrix is large enough to be computed in worker processes
+        """
+        return self.session.get_executor(len(self.content)) if self.session is not None else None
+
+    def _calc_memoized(self,
+                       calc_matrix: Callable[[], Matrix],
+                       calc_pairs: Callable[[np.ndarray, np.ndarray], np.ndarray],
+                       min_score: float = None) -> Matrix:
+        """
+        Matrix from the previous matrix or the score memo of the session, only missing pairs are computed;
+        calc_matrix without both
+        """
+        if self.previous is not None:
+            sim_matrix, valid = self.previous
+            if np.count_nonzero(~valid) <= len(valid) // 2:
+                return self._calc_incremental(sim_matrix, valid, calc_pairs)
+        memo = self.session.memo if self.session is not None and self.memo_namespace is not None else None
+        if memo is None:
+            return calc_matrix()
+        return memo.get_sim_matrix(self.name, self.memo_namespace, self.content, calc_matrix, calc_pairs,
+                                   self._new_writer(), self.symmetric, self.full, score_bound(min_score, self.floor))
+
+    def _calc_incremental(self,
+                          sim_matrix: Matrix,
+                          valid: np.ndarray,
+                          calc_pairs: Callable[[np.ndarray, np.ndarray], np.ndarray]) -> Matrix:
+        """
+        Complete the previous matrix (dense and packed ones in-place), only the pairs with a stale value are computed
+        """
+        tic = time.perf_counter()
+        rows, cols = stale_pairs(valid, upper=self.symmetric or not self.full)
+        sim_matrix = update_pairs(sim_matrix, rows, cols, calc_pairs(rows, cols), self.symmetric)
+        toc = time.perf_counter()
+        logger.info(f'Similarity matrix {self.name}: {len(rows)} pairs of {np.count_nonzero(~valid)} stale values '
+                    f'computed in {toc - tic} seconds')
+        return sim_matrix
+
     def log_info(self, time: float) -> None:
         logger.info(f'Similarity matrix {self.name}, {self.content} in {time} seconds -> result:\n{self.sim_matrix}')
 
@@ -38,139 +101,239 @@ class SimMatrix(ABC):
 
 
 class GloVeSimMatrix(SimMatrix):
-    def __init__(self, name: str, content: List[List[str]], glove: GloVeModel, _: str) -> None:
+    """
+    GloVeSimMatrix based on soft cosine similarity, the term similarities depend on the dictionary of the whole content
+    (not kept in the score memo)
+    -> all bag-of-words are one sparse matrix D, the similarity matrix is D S D^T normalised by the soft norms and is
+    computed row_block rows at a time
+    """
+    def __init__(self, name: str, content: List[List[str]], glove: GloVeModel, _: str, full: bool = False,
+                 session: 'AnalysisSession' = None, floor: float = None, row_block: int = 4096) -> None:
         tic = time.perf_counter()
-        super().__init__(name, content)
+        super().__init__(name, content, full, session, floor=floor)
         self.glove = glove
+        self.row_block = row_block
         self.sim_matrix = self._calc_sim_matrix()
 
         toc = time.perf_counter()
         self.log_info((toc-tic))
 
-    def _calc_sim_matrix(self) -> np.ndarray:
+    def _calc_sim_matrix(self) -> Matrix:
         """
-        Calculate similarity matrix the way gensim intended
+        Calculate the soft cosine similarity matrix of gensim in bulk, block of rows by block of rows into the writer
         """
-        termsim_index = self.glove.similarity_index
-        dictionary, documents_doc2bow, tfidf = sim_utils.initialize_tfidf_content(
-            self.content)  # tfidf is not used in this implementation
-        similarity_matrix = SparseTermSimilarityMatrix(termsim_index, dictionary)
-        docsim_index = SoftCosineSimilarity(documents_doc2bow, similarity_matrix)
+        engine = sim_utils.soft_cosine_engine(self.content, self.glove)
+        return engine.write_rows(self._new_writer(), upper=True, tile_size=self.row_block)
 
-        score_list = []
-        for query in self.content:
-            sims = docsim_index[dictionary.doc2bow(query)]
-            score_list.append(sims.tolist())
-        sim_matrix = np.asarray(score_list, dtype=object)
-        return sim_matrix
+    @staticmethod
+    def row_function(content: List[List[str]], glove: GloVeModel) -> sim_utils.RowFunction:
+        """
+        Soft cosine scores of content[rows] against all values, the document matrix is built once
+        """
+        engine = sim_utils.soft_cosine_engine(content, glove)
+        return lambda rows: engine.block(rows, slice(0, len(content)))
 
 
 class OpenGloVeSimMatrix(SimMatrix):
     """
     OpenGloVeSimilarityMatrix can use any function defined in glove model
     """
-    def __init__(self, name: str, content: List[List[str]], glove: GloVeModel, function: str) -> None:
+    def __init__(self, name: str, content: List[List[str]], glove: GloVeModel, function: str, full: bool = False,
+                 session: 'AnalysisSession' = None, memo_namespace: Tuple[str, str, str] = None,
+                 previous: Tuple[Matrix, np.ndarray] = None, floor: float = None) -> None:
         tic = time.perf_counter()
-        super().__init__(name, content)
+        super().__init__(name, content, full, session, memo_namespace, previous, floor)
         self.glove = glove
+        self.function_name = function
         self.function = sim_utils._check_function(self.glove, function)
+        self.symmetric = sim_utils._check_symmetry(self.glove, function)
         self.sim_matrix = self._calc_sim_matrix()
 
         toc = time.perf_counter()
         self.log_info((toc - tic))
 
-    def _calc_sim_matrix(self) -> np.ndarray:
+    def _calc_sim_matrix(self) -> Matrix:
         """
         Returns the similarity matrix based on glove_algorithm calc_similarity_list
+        -> vectorized engine of the glove model if it supports the function, pairwise function calls otherwise;
+        large matrices are computed tile by tile in the worker processes of the session
         """
-        return sim_utils.abstract_calc_sim_matrix(self.name, self.content, self.function)
+        return self._calc_memoized(self._calc_all_pairs, self._calc_pairs)
+
+    def _calc_all_pairs(self) -> Matrix:
+        executor = self._get_executor()
+        if executor is not None:
+            return executor.compute(self.name, self.content, 'glove', self.function_name, self.symmetric, self.full,
+                                    writer=self._new_writer())
+        engine = sim_utils._check_matrix_engine(self.glove, self.function_name, self.content)
+        return sim_utils.abstract_calc_sim_matrix(self.name, self.content, self.function, engine,
+                                                  self.symmetric, self.full, self._new_writer())
+
+    def _calc_pairs(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        engine = sim_utils._check_matrix_engine(self.glove, self.function_name, self.content)
+        return sim_utils.calc_sim_pairs(self.content, rows, cols, self.function, engine)
 
 
-# TODO does not work currently
 class TfIdfSimMatrix(SimMatrix):
     """
     TfIdfSimMatrix based on term frequency-inverse document frequency
+    -> cosine similarity of the tf-idf weighted bag-of-words, all documents are one sparse matrix and the similarity
+    matrix is a sparse product (row_block rows per product); only pairs sharing a term are written
+    -> scores depend on the whole content (idf weights), so they are not kept in the score memo
     """
-    def __init__(self, name: str, content: List[List[str]], glove: GloVeModel, _: str) -> None:
+
+    def __init__(self, name: str, content: List[List[str]], glove: GloVeModel, _: str, full: bool = False,
+                 session: 'AnalysisSession' = None, floor: float = None, row_block: int = 4096) -> None:
         tic = time.perf_counter()
         # initialization and complete calculation
-        super().__init__(name, content)
+        super().__init__(name, content, full, session, floor=floor)
         self.glove = glove
+        self.row_block = row_block
         self.sim_matrix = self._calc_sim_matrix()
 
         toc = time.perf_counter()
         self.log_info((toc - tic))
 
-    def _calc_sim_matrix(self) -> np.ndarray:
-        dictionary, documents_doc2bow, tfidf = sim_utils.initialize_tfidf_content(self.content)
-        tfidf_corpus = [tfidf[document] for document in documents_doc2bow]
-
-        docsim_index = MatrixSimilarity(tfidf_corpus, num_features=len(dictionary))
-        sim_matrix = self.generate_tfidf_sim_matrix(documents_doc2bow, docsim_index)
-        return sim_matrix
+    def _calc_sim_matrix(self) -> Matrix:
+        engine = sim_utils.tfidf_engine(self.content)
+        return engine.write_rows(self._new_writer(), upper=True, tile_size=self.row_block)
 
     @staticmethod
-    def generate_tfidf_sim_matrix(documents_doc2bow: List[str], docsim_index: MatrixSimilarity) -> np.ndarray:
-        """
-        from computed cosine or soft cosine similarity generate readable sim_matrix
-
-        Parameters
-        ----------
-        documents_doc2bow
-            all documents adapted to bag-of-words
-        docsim_index
-            -- missing --
-
-        Returns
-        -------
-        sim_matrix
-            results of similarity queries
-        """
-        score_list = []
-        for query in documents_doc2bow:
-            sim_scores = docsim_index[query]
-            score_list.append(sim_scores)
-        sim_matrix = np.asarray(score_list)
-        return sim_matrix
+    def row_function(content: List[List[str]]) -> sim_utils.RowFunction:
+        """
+        Cosine scores of the tf-idf vectors of content[rows] against all values, the vectors are built once
+        """
+        engine = sim_utils.tfidf_engine(content)
+        return lambda rows: engine.block(rows, slice(0, len(content)))
 
 
 class SpaCySimMatrix(SimMatrix):
-    def __init__(self, name: str, content: List[List[str]], nlp: SpaCyModel, function: str) -> None:
+    def __init__(self, name: str, content: List[List[str]], nlp: SpaCyModel, function: str, full: bool = False,
+                 session: 'AnalysisSession' = None, memo_namespace: Tuple[str, str, str] = None,
+                 previous: Tuple[Matrix, np.ndarray] = None, floor: float = None) -> None:
         tic = time.perf_counter()
-        super().__init__(name, content)
+        super().__init__(name, content, full, session, memo_namespace, previous, floor)
         self.nlp = nlp
+        self.function_name = function
         self.function = sim_utils._check_function(self.nlp, function)
+        self.symmetric = sim_utils._check_symmetry(self.nlp, function)
         self.sim_matrix = self._calc_sim_matrix()
 
         toc = time.perf_counter()
         self.log_info((toc - tic))
 
-    def _calc_sim_matrix(self) -> np.ndarray:
+    def _calc_sim_matrix(self) -> Matrix:
         """
         Returns the similarity matrix based on glove_algorithm calc_similarity_list
+        -> vectorized engine of the spacy model if it supports the function, pairwise function calls otherwise;
+        large matrices are computed tile by tile in the worker processes of the session
 
         abstract_calc_sim_matrix(name, content, func_matrix, func_vec)
         """
-        return sim_utils.abstract_calc_sim_matrix(self.name, self.content, self.function)
+        return self._calc_memoized(self._calc_all_pairs, self._calc_pairs)
+
+    def _calc_all_pairs(self) -> Matrix:
+        executor = self._get_executor()
+        if executor is not None:
+            return executor.compute(self.name, self.content, 'spacy', self.function_name, self.symmetric, self.full,
+                                    writer=self._new_writer())
+        engine = sim_utils._check_matrix_engine(self.nlp, self.function_name, self.content)
+        return sim_utils.abstract_calc_sim_matrix(self.name, self.content, self.function, engine,
+                                                  self.symmetric, self.full, self._new_writer())
+
+    def _calc_pairs(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        engine = sim_utils._check_matrix_engine(self.nlp, self.function_name, self.content)
+        return sim_utils.calc_sim_pairs(self.content, rows, cols, self.function, engine)
 
 
 class LevenshteinSimMatrix(SimMatrix):
-    def __init__(self, name: str, content: Union[List[str], List[List[str]]], _1: str, _2: str) -> None:
+    symmetric = False  # filter conditions depend on the query
+
+    def __init__(self, name: str, content: Union[List[str], List[List[str]]], _1: str, _2: str,
+                 full: bool = False, session: 'AnalysisSession' = None, min_score: float = None,
+                 memo_namespace: Tuple[str, str, str] = None,
+                 previous: Tuple[Matrix, np.ndarray] = None, floor: float = None) -> None:
+        """
+        min_score: threshold of the analysis step, pairs that cannot exceed it are pruned by q-gram blocking and stay 0
+        (the floor of a sparse matrix if not given)
+        """
         tic = time.perf_counter()
         # initialization and complete calculation
-        super().__init__(name, content)
+        super().__init__(name, content, full, session, memo_namespace, previous, floor)
+        self.min_score = score_bound(min_score, floor)
         self.sim_matrix = self._calc_sim_matrix()
 
         toc = time.perf_counter()
         self.log_info((toc - tic))
 
-    def _calc_sim_matrix(self) -> np.ndarray:
-        score_list = []
-        for query in self.content:
-            sim_scores = sim_utils.calc_levenshtein_sim(query, self.content)
-            score_list.append(sim_scores)
-        sim_matrix = np.asarray(score_list)
-        return sim_matrix
+    def _calc_sim_matrix(self) -> Matrix:
+        return self._calc_memoized(self._calc_all_pairs, self._calc_pairs, self.min_score)
+
+    def _calc_all_pairs(self) -> Matrix:
+        executor = self._get_executor()
+        if executor is not None:
+            return executor.compute(self.name, self.content, None, '_', self.symmetric, self.full, self.min_score,
+                                    self._new_writer())
+        # upper triangle only if not full
+        return sim_utils.calc_levenshtein_matrix(self.content, self._new_writer(), self.min_score, upper=not self.full)
+
+    def _calc_pairs(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        return sim_utils.calc_levenshtein_pairs(self.content, rows, cols, self.min_score)
+
+
+class MinHashSimMatrix(SimMatrix):
+    """
+    MinHashSimMatrix based on the jaccard similarity of character shingles
+    -> only the candidate pairs of MinHash LSH bands (chosen for min_score) are verified, near-duplicates of large
+    attributes are found in ~O(n); the candidates depend on the whole content, so they are not kept in the score memo
+    """
+
+    def __init__(self, name: str, content: Union[List[str], List[List[str]]], _1: str, _2: str,
+                 full: bool = False, session: 'AnalysisSession' = None, min_score: float = None,
+                 floor: float = None) -> None:
+        """
+        min_score: threshold of the analysis step, pairs that are no candidate of the LSH bands stay 0
+        (the floor of a sparse matrix if not given)
+        """
+        tic = time.perf_counter()
+        # initialization and complete calculation
+        super().__init__(name, content, full, session, floor=floor)
+        self.min_score = score_bound(min_score, floor)
+        self.sim_matrix = self._calc_sim_matrix()
+
+        toc = time.perf_counter()
+        self.log_info((toc - tic))
+
+    def _calc_sim_matrix(self) -> Matrix:
+        return sim_utils.calc_minhash_matrix(self.content, self._new_writer(), self.min_score)
+
+
+def stale_pairs(valid: np.ndarray, upper: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    All pairs (i, j) of a matrix with at least one stale value (valid[i] or valid[j] is False)
+
+    Parameters
+    ----------
+    valid
+        False for the values whose rows and columns are missing
+    upper
+        only pairs of the upper triangle (diagonal included)
+
+    Returns
+    -------
+    rows, cols
+        indices of the pairs, every pair once
+    """
+    size = len(valid)
+    rows, cols = [], []
+    for stale in np.flatnonzero(~valid):
+        row_cols = np.arange(stale if upper else 0, size)  # complete row of the stale value
+        col_rows = np.flatnonzero(valid[:stale] if upper else valid)  # its column, rows of stale values are complete
+        rows.extend([np.full(len(row_cols), stale), col_rows])
+        cols.extend([row_cols, np.full(len(col_rows), stale)])
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows).astype(np.int64), np.concatenate(cols).astype(np.int64)
 
 
 # unit test
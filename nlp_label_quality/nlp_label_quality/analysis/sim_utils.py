@@ -1,15 +1,19 @@
+from gensim import matutils
 from gensim.corpora import Dictionary
 from gensim.models import TfidfModel
-from gensim.similarities.levenshtein import levsim
 
 import numpy as np
 
-from . import label_utils
+from nlp_label_quality.analysis.blocking import QGramIndex
+from nlp_label_quality.analysis.levenshtein_kernel import LevenshteinScorer
+from nlp_label_quality.analysis.minhash import MinHashIndex
 
 import logging
 import time
-from typing import List, Callable, Tuple, Any, Union
+from typing import List, Callable, Dict, Tuple, Any, Union
 from nlp_label_quality.analysis.nlp_models import GloVeModel, SpaCyModel
+from nlp_label_quality.analysis.matrix_engine import MatrixEngine, SparseCosineEngine
+from nlp_label_quality.analysis.matrix_storage import Matrix, Writer, new_writer
 
 logger = logging.getLogger(__name__)
 logger.disabled = False
@@ -21,9 +25,25 @@ def _check_function(model: Union[GloVeModel, SpaCyModel], function: str) -> Call
     return function
 
 
+def _check_matrix_engine(model: Union[GloVeModel, SpaCyModel],
+                         function: str,
+                         content: List[List[str]]) -> Union[None, MatrixEngine]:
+    assert isinstance(function, str), 'Function values has to be passed as a string'
+    return model.get_matrix_engine(function, content)
+
+
+def _check_symmetry(model: Union[GloVeModel, SpaCyModel], function: str) -> bool:
+    assert isinstance(function, str), 'Function values has to be passed as a string'
+    return function not in model.asymmetric_functions
+
+
 def abstract_calc_sim_matrix(name: str,
                              content: List[List[str]],
-                             func_vec: Callable[[List[str], List[str]], float]) -> np.ndarray:
+                             func_vec: Callable[[List[str], List[str]], float],
+                             func_matrix: MatrixEngine = None,
+                             symmetric: bool = True,
+                             full: bool = False,
+                             writer: Writer = None) -> Matrix:
     """
     Abstract version to calculate similarity matrix based on varying similarity functions / algorithms
 
@@ -35,18 +55,32 @@ def abstract_calc_sim_matrix(name: str,
         content to compare similarity for
     func_vec
         function for similarity_scores
+    func_matrix
+        vectorized engine for the same function, used instead of func_vec if available
+    symmetric
+        func_vec(a, b) == func_vec(b, a), only the upper triangle is computed and mirrored afterwards
+    full
+        compute every pair even for asymmetric functions, otherwise only the upper triangle (diagonal included) is
+        computed for them and the lower triangle stays zero (the results only use the upper triangle)
+    writer
+        the rows are streamed into it (e.g. SparseWriter keeps the scores above its floor only), dense matrix if None
 
     Returns
     -------
     sim_matrix
-        result of appending vectors of similarity scores
+        result of the writer
     """
     tic = time.perf_counter()
-    score_list = []
-    for query in content:
-        sim_scores = abstract_calc_sim(query, content, func_vec)
-        score_list.append(sim_scores)
-    sim_matrix = np.asarray(score_list)
+    if writer is None:
+        writer = new_writer(len(content), symmetric, upper=not full)
+    if func_matrix is not None:
+        sim_matrix = func_matrix.write_rows(writer, upper=not full)
+    else:
+        for i, query in enumerate(content):
+            start = 0 if full else i
+            sim_scores = abstract_calc_sim(query, content[start:], func_vec)
+            writer.write_block(slice(i, i + 1), slice(start, len(content)), np.asarray([sim_scores], dtype=np.float64))
+        sim_matrix = writer.result()
     toc = time.perf_counter()
     logger.info(f'SimilarityMatrix {name} has been calculated in {toc - tic} seconds')
     return sim_matrix
@@ -82,6 +116,207 @@ def abstract_calc_sim(query: List[str],
     return sim_scores
 
 
+def _group_by_query(rows: np.ndarray) -> List[np.ndarray]:
+    """
+    Indices of the pairs grouped by their query (row)
+    """
+    order = np.argsort(rows, kind='stable')
+    return [pairs for pairs in np.split(order, np.flatnonzero(np.diff(rows[order])) + 1) if len(pairs)]
+
+
+def calc_sim_pairs(content: List[List[str]],
+                   rows: np.ndarray,
+                   cols: np.ndarray,
+                   func_vec: Callable[[List[str], List[str]], float],
+                   func_matrix: MatrixEngine = None) -> np.ndarray:
+    """
+    Similarity scores of the single pairs (content[rows[k]], content[cols[k]]), e.g. the pairs missing in a memo
+
+    Parameters
+    ----------
+    content
+        content to compare similarity for
+    rows
+        query of each pair
+    cols
+        compared value of each pair
+    func_vec
+        function for similarity_scores
+    func_matrix
+        vectorized engine for the same function, used instead of func_vec if available (one block per query)
+
+    Returns
+    -------
+    scores
+        similarity per pair
+    """
+    scores = np.zeros(len(rows))
+    for pairs in _group_by_query(rows):
+        query, pair_cols = rows[pairs[0]], cols[pairs]
+        if func_matrix is not None:
+            low, high = pair_cols.min(), pair_cols.max() + 1
+            scores[pairs] = func_matrix.block(slice(query, query + 1), slice(low, high))[0, pair_cols - low]
+        else:
+            scores[pairs] = abstract_calc_sim(content[query], [content[j] for j in pair_cols], func_vec)
+    return scores
+
+
+RowFunction = Callable[[slice], np.ndarray]  # scores of content[rows] (queries) against all values
+
+
+def sim_row_function(content: List[List[str]],
+                     func_vec: Callable[[List[str], List[str]], float],
+                     func_matrix: MatrixEngine = None) -> RowFunction:
+    """
+    Row function of a similarity function, vectorized engine if available and pairwise function calls otherwise
+    """
+    if func_matrix is not None:
+        return lambda rows: func_matrix.block(rows, slice(0, len(content)))
+    return lambda rows: np.asarray([abstract_calc_sim(query, content, func_vec) for query in content[rows]],
+                                   dtype=np.float64).reshape(-1, len(content))
+
+
+def levenshtein_row_function(content: Union[List[str], List[List[str]]],
+                             min_score: float = None,
+                             len_threshold: int = 17) -> RowFunction:
+    """
+    Row function of the levenshtein similarity, scorer and blocking index are built once for all rows; with min_score
+    the pairs outside the q-gram candidates stay 0
+    """
+    index = QGramIndex(content, len_threshold=len_threshold) if min_score is not None else None
+    scorer = LevenshteinScorer(content, len_threshold)
+
+    def calc_rows(rows: slice) -> np.ndarray:
+        queries = content[rows]
+        query_ids, value_ids = _levenshtein_candidates(queries, len(content), index, min_score)
+        block = np.zeros((len(queries), len(content)), dtype=np.float32)
+        block[query_ids, value_ids] = scorer.scores(queries, query_ids, value_ids)
+        return block
+    return calc_rows
+
+
+def minhash_row_function(content: Union[List[str], List[List[str]]],
+                         min_score: float = None) -> RowFunction:
+    """
+    Row function of the jaccard similarity of character shingles, only the LSH candidates of the queries are verified
+    and all other pairs stay 0; the index is built once for all rows
+    """
+    index = MinHashIndex(content, **({} if min_score is None else {'threshold': min_score}))
+
+    def calc_rows(rows: slice) -> np.ndarray:
+        start = rows.start or 0
+        block = np.zeros((len(range(len(content))[rows]), len(content)), dtype=np.float32)
+        for query_ids, value_ids in index.candidates(rows):
+            block[query_ids - start, value_ids] = index.jaccard(query_ids, value_ids)
+        return block
+    return calc_rows
+
+
+def calc_top_k(name: str,
+               size: int,
+               calc_rows: RowFunction,
+               k: int = 5,
+               row_batch: int = 256) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    k most similar values of every value, streamed batch of rows by batch of rows with argpartition
+    -> only row_batch x size scores are held at once, the full matrix is never built
+
+    Parameters
+    ----------
+    name
+        name of the option (logging purposes)
+    size
+        number of values
+    calc_rows
+        scores of a slice of the values (queries) against all values
+    k
+        number of neighbours per value (at most size - 1, a value is not its own neighbour)
+    row_batch
+        number of queries whose rows are computed at once
+
+    Returns
+    -------
+    neighbours, scores
+        indices of the neighbours of every value and their scores, shape (size, k), by descending score
+    """
+    tic = time.perf_counter()
+    k = max(min(k, size - 1), 0)
+    neighbours = np.zeros((size, k), dtype=np.int64)
+    scores = np.zeros((size, k), dtype=np.float32)
+    if not k:
+        return neighbours, scores
+    for start in range(0, size, row_batch):
+        rows = slice(start, min(start + row_batch, size))
+        block = np.array(calc_rows(rows), dtype=np.float32)
+        block_rows = np.arange(len(block))
+        block[block_rows, start + block_rows] = -np.inf  # not its own neighbour
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        neighbours[rows] = np.take_along_axis(top, order, axis=1)
+        scores[rows] = np.take_along_axis(top_scores, order, axis=1)
+    toc = time.perf_counter()
+    logger.info(f'Top {k} neighbours of {size} values ({name}) selected in {toc - tic:0.4f} seconds')
+    return neighbours, scores
+
+
+def calc_max_matrix(name: str,
+                    size: int,
+                    row_functions: List[RowFunction],
+                    writer: Writer,
+                    threshold: float = None,
+                    row_batch: int = 256) -> Tuple[Matrix, Dict[Tuple[int, int], int]]:
+    """
+    Element-wise maximum of the similarity matrices of several options computed in one pass
+    -> every batch of rows is scored by all options and only the running maximum is written, the matrices of the
+    single options are never built
+
+    Parameters
+    ----------
+    name
+        name of the combined step (logging purposes)
+    size
+        number of values
+    row_functions
+        one row function per option, all of them over the same values
+    writer
+        assembles the maximum (upper triangle) as dense matrix or keeps the scores above its floor only
+    threshold
+        the winning option is recorded for the pairs above it, None records none
+    row_batch
+        number of values whose rows are computed at once
+
+    Returns
+    -------
+    max_matrix, winners
+        result of the writer; index of the option with the highest score per pair (i, j), i < j, above threshold
+        (the first of tied options)
+    """
+    tic = time.perf_counter()
+    winners = {}
+    for start in range(0, size, row_batch):
+        rows = slice(start, min(start + row_batch, size))
+        block, winner = None, None
+        for option, calc_rows in enumerate(row_functions):
+            scores = np.asarray(calc_rows(rows))[:, start:]
+            if block is None:
+                block, winner = np.array(scores, dtype=np.float64), np.zeros(scores.shape, dtype=np.int8)
+            else:
+                better = scores > block
+                block[better] = scores[better]
+                winner[better] = option
+        writer.write_block(rows, slice(start, size), block)
+        if threshold is not None:
+            block_rows, block_cols = np.nonzero(np.triu(block > threshold, 1))
+            pairs = zip((block_rows + start).tolist(), (block_cols + start).tolist())
+            winners.update(zip(pairs, winner[block_rows, block_cols].tolist()))
+    max_matrix = writer.result()
+    toc = time.perf_counter()
+    logger.info(f'Max matrix of {len(row_functions)} options over {size} values ({name}) computed in one pass '
+                f'in {toc - tic:0.4f} seconds')
+    return max_matrix, winners
+
+
 def initialize_tfidf_content(content: List[List[str]]) -> Tuple[Any, Any, Any]:
     """
     Initilialize content for GloVeSimMatrix and TfIdfSimMatrix and turn it into bag-of-words
@@ -106,12 +341,59 @@ def initialize_tfidf_content(content: List[List[str]]) -> Tuple[Any, Any, Any]:
     return dictionary, documents_doc2bow, tfidf
 
 
+def tfidf_engine(content: List[List[str]]) -> SparseCosineEngine:
+    """
+    Cosine similarity engine of the tf-idf weighted bag-of-words of content (one sparse matrix for all documents)
+
+    Parameters
+    ----------
+    content
+        content to compare similarity for
+
+    Returns
+    -------
+    engine
+        sparse cosine engine over the tf-idf vectors of shape (len(content), len(dictionary))
+    """
+    dictionary, documents_doc2bow, tfidf = initialize_tfidf_content(content)
+    tfidf_corpus = [tfidf[document] for document in documents_doc2bow]
+    vectors = matutils.corpus2csc(tfidf_corpus, num_terms=len(dictionary), num_docs=len(content),
+                                  dtype=np.float32).T
+    return SparseCosineEngine(content, vectors)
+
+
+def soft_cosine_engine(content: List[List[str]], glove: GloVeModel) -> SparseCosineEngine:
+    """
+    Soft cosine similarity engine of the bag-of-words of content with the term similarities of glove, all documents
+    are one sparse matrix D and a block of the similarity matrix is D[rows] S D[cols]^T
+
+    Parameters
+    ----------
+    content
+        content to compare similarity for
+    glove
+        model providing the (cached) term similarity matrix of the dictionary
+
+    Returns
+    -------
+    engine
+        sparse soft cosine engine over the bag-of-words of shape (len(content), len(dictionary))
+    """
+    dictionary = Dictionary(content)
+    documents_doc2bow = [dictionary.doc2bow(document) for document in content]
+    term_similarity = glove.get_term_similarity_matrix(dictionary).matrix
+    vectors = matutils.corpus2csc(documents_doc2bow, num_terms=len(dictionary), num_docs=len(content),
+                                  dtype=np.float32).T
+    return SparseCosineEngine(content, vectors, term_similarity)
+
+
 def calc_levenshtein_sim(t1: Union[str, List[str]],
                          content: Union[List[str],  List[List[str]]],
                          len_threshold: int = 17) -> List[float]:
     """
     Calculates the levenshtein similarity of one term against all other terms in content
     Both str and List[str] can be entered into this function as a term
+    -> one call of the bit-parallel kernel instead of two levsim calls per term, see LevenshteinScorer
 
     Parameters
     ----------
@@ -127,61 +409,198 @@ def calc_levenshtein_sim(t1: Union[str, List[str]],
     result_lev_sim
         list of levenshtein similarity values
     """
-    result_lev_sim = []
-    if isinstance(t1, list):
-        result_lev_sim = _calc_levenshtein_distance_list(result_lev_sim, t1, content, len_threshold)
-    elif isinstance(t1, str):
-        result_lev_sim = _calc_levenshtein_distance_str(result_lev_sim, t1, content, len_threshold)
-    return result_lev_sim
-
-
-def _calc_levenshtein_distance_str(result_lev_sim: List[float],
-                                   t1: str,
-                                   content: List[str],
-                                   len_threshold: int) -> List[float]:
-    """
-    Implementation of levenshtein distance with t1: str as input
-    """
-    for t2 in content:
-        fixed_t1, fixed_t2 = label_utils.difference_of_str_both(t1, t2)
-        result_real = levsim(t1, t2)  # full strings
-        result_diff = levsim(fixed_t1, fixed_t2)  # different strings
-        # filter results
-        if len(t1) < len_threshold:  # if the string is short itself
-            appending, condition = result_real, 1
-        elif abs(len(t1) - len(fixed_t1)) < len(t1) / 2:  # if more than half the letters are fixed
-            appending, condition = result_diff, 2
-        elif abs(len(fixed_t1) - len(fixed_t2)) <= 3:  # difference compare length of fixed_values
-            appending, condition = result_diff, 3
-        else:  # all other values should take the minimal value
-            appending, condition = min(result_real, result_diff), 4
-
-        result_lev_sim.append(min(appending,
-                                  1.0))  # all values above 1.0 will be decreased to 1 in order to make sense with all other calculations
-    return result_lev_sim
-
-
-def _calc_levenshtein_distance_list(result_lev_sim: List[float],
-                                    t1: List[str],
-                                    content: List[List[str]],
-                                    len_threshold: int) -> List[float]:
-    """
-    Implementation of levenshtein distance with t1: List[str] as input
-    """
-    for t2 in content:
-        fixed_t1, fixed_t2 = label_utils.difference_of_list_both(t1, t2)
-        result_real = levsim(' '.join(t1), ' '.join(t2))
-        result_diff = levsim(' '.join(fixed_t1), ' '.join(fixed_t2))
-        # filter results
-        if len(t1) < len_threshold:  # if the string is short itself
-            appending, condition = result_real, 1
-        elif abs(len(t1) - len(fixed_t1)) < len(t1) / 2:  # if more than half the letters are fixed
-            appending, condition = result_diff, 2
-        elif abs(len(fixed_t1) - len(fixed_t2)) <= 3:  # difference compare length of fixed_values
-            appending, condition = result_diff, 3
-        else:  # all other values should take the minimal value
-            appending, condition = min(result_real, result_diff), 4
-
-        result_lev_sim.append(min(appending,
-                                  1.0))  # all values above 1.0 will be decreased to 1 in order to make sense with all other calculations
-    return result_lev_sim
+    scorer = LevenshteinScorer(content, len_threshold)
+    return scorer.scores([t1], np.zeros(len(content), dtype=np.int64), np.arange(len(content))).tolist()
+
+
+def calc_levenshtein_block(row_content: Union[List[str], List[List[str]]],
+                           col_content: Union[List[str], List[List[str]]],
+                           min_score: float = None,
+                           upper: bool = False,
+                           len_threshold: int = 17) -> np.ndarray:
+    """
+    Levenshtein similarity of every row value (query) against the column values
+    -> with min_score only the candidate pairs of a q-gram blocking index are computed, all other pairs cannot score
+    above min_score and stay 0; all pairs of the block are scored by the bit-parallel kernel in batches
+
+    Parameters
+    ----------
+    row_content
+        queries
+    col_content
+        values the queries are compared to
+    min_score
+        threshold the relevant results have to exceed, None computes all pairs
+    upper
+        row_content and col_content are the same values, only pairs on and above the diagonal are computed
+    len_threshold
+        term length to which only full results are calculated
+
+    Returns
+    -------
+    block
+        similarity scores of shape (len(row_content), len(col_content))
+    """
+    tic = time.perf_counter()
+    block = np.zeros((len(row_content), len(col_content)))
+    index = QGramIndex(col_content, len_threshold=len_threshold) if min_score is not None else None
+    query_ids, value_ids = _levenshtein_candidates(row_content, len(col_content), index, min_score,
+                                                   0 if upper else None)
+
+    scorer = LevenshteinScorer(col_content, len_threshold)
+    block[query_ids, value_ids] = scorer.scores(row_content, query_ids, value_ids)
+    toc = time.perf_counter()
+    logger.info(f'Levenshtein block {block.shape} (min_score={min_score}) scored {len(query_ids)} pairs '
+                f'in {toc - tic:0.4f} seconds')
+    return block
+
+
+def calc_levenshtein_matrix(content: Union[List[str], List[List[str]]],
+                            writer: Writer,
+                            min_score: float = None,
+                            upper: bool = True,
+                            len_threshold: int = 17,
+                            row_batch: int = 512) -> Matrix:
+    """
+    Levenshtein similarity matrix of content streamed batch of rows by batch of rows into a writer, the pairs are
+    selected and scored like in calc_levenshtein_block but no dense block is assembled
+
+    Parameters
+    ----------
+    content
+        values to compare
+    writer
+        assembles a dense matrix or keeps the scores above its floor only
+    min_score
+        threshold the relevant results have to exceed, None computes all pairs
+    upper
+        only pairs on and above the diagonal are computed
+    len_threshold
+        term length to which only full results are calculated
+    row_batch
+        number of queries whose pairs are scored at once
+
+    Returns
+    -------
+    sim_matrix
+        result of the writer
+    """
+    tic = time.perf_counter()
+    index = QGramIndex(content, len_threshold=len_threshold) if min_score is not None else None
+    scorer = LevenshteinScorer(content, len_threshold)
+    n_pairs = 0
+    for start in range(0, len(content), row_batch):
+        queries = content[start:start + row_batch]
+        query_ids, value_ids = _levenshtein_candidates(queries, len(content), index, min_score,
+                                                       start if upper else None)
+        writer.write_pairs(query_ids + start, value_ids, scorer.scores(queries, query_ids, value_ids))
+        n_pairs += len(query_ids)
+    sim_matrix = writer.result()
+    toc = time.perf_counter()
+    logger.info(f'Levenshtein matrix of {len(content)} values (min_score={min_score}) scored {n_pairs} pairs '
+                f'in {toc - tic:0.4f} seconds')
+    return sim_matrix
+
+
+def calc_minhash_matrix(content: Union[List[str], List[List[str]]],
+                        writer: Writer,
+                        min_score: float = None,
+                        row_batch: int = 1024) -> Matrix:
+    """
+    Jaccard similarity matrix of the character shingles of content, the candidate pairs of a MinHash LSH index are
+    verified with their exact jaccard similarity batch of rows by batch of rows; all other pairs stay 0
+
+    Parameters
+    ----------
+    content
+        values to compare
+    writer
+        assembles a dense matrix or keeps the scores above its floor only
+    min_score
+        threshold the relevant results have to exceed, the bands of the index are chosen for it (default of
+        MinHashIndex if None)
+    row_batch
+        number of queries whose candidates are verified at once
+
+    Returns
+    -------
+    sim_matrix
+        result of the writer (upper triangle, the matrix is symmetric)
+    """
+    tic = time.perf_counter()
+    index = MinHashIndex(content, **({} if min_score is None else {'threshold': min_score}))
+    n_pairs = 0
+    for start in range(0, len(content), row_batch):
+        for query_ids, value_ids in index.candidates(slice(start, start + row_batch)):
+            upper = query_ids < value_ids
+            query_ids, value_ids = query_ids[upper], value_ids[upper]
+            writer.write_pairs(query_ids, value_ids, index.jaccard(query_ids, value_ids))
+            n_pairs += len(query_ids)
+    sim_matrix = writer.result()
+    toc = time.perf_counter()
+    logger.info(f'MinHash matrix of {len(content)} values ({index.n_bands} bands of {index.rows_per_band} hashes) '
+                f'verified {n_pairs} candidate pairs in {toc - tic:0.4f} seconds')
+    return sim_matrix
+
+
+def _levenshtein_candidates(queries: Union[List[str], List[List[str]]],
+                            n_values: int,
+                            index: Union[None, QGramIndex],
+                            min_score: float = None,
+                            offset: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs (query id, value id) to score, all pairs without index
+
+    offset: the queries are the values from offset on, only pairs on and above the diagonal are returned
+    """
+    query_ids, value_ids = [], []
+    for i, query in enumerate(queries):
+        start = i + offset if offset is not None else 0
+        if index is None:
+            candidates = np.arange(start, n_values)
+        else:
+            candidates = index.candidates(query, min_score)
+            candidates = candidates[candidates >= start]
+        query_ids.append(np.full(len(candidates), i, dtype=np.int64))
+        value_ids.append(candidates)
+    query_ids = np.concatenate(query_ids) if query_ids else np.zeros(0, dtype=np.int64)
+    value_ids = np.concatenate(value_ids) if value_ids else np.zeros(0, dtype=np.int64)
+    return query_ids, value_ids
+
+
+def calc_levenshtein_pairs(content: Union[List[str], List[List[str]]],
+                           rows: np.ndarray,
+                           cols: np.ndarray,
+                           min_score: float = None,
+                           len_threshold: int = 17) -> np.ndarray:
+    """
+    Levenshtein similarity of the single pairs (content[rows[k]], content[cols[k]]), with min_score the pairs outside
+    of the q-gram blocking candidates stay 0 like in calc_levenshtein_block
+
+    Parameters
+    ----------
+    content
+        values to compare
+    rows
+        query of each pair
+    cols
+        compared value of each pair
+    min_score
+        threshold the relevant results have to exceed, None computes all pairs
+    len_threshold
+        term length to which only full results are calculated
+
+    Returns
+    -------
+    scores
+        similarity per pair
+    """
+    scores = np.zeros(len(rows))
+    computed = np.ones(len(rows), dtype=bool)
+    if min_score is not None:
+        index = QGramIndex(content, len_threshold=len_threshold)
+        for pairs in _group_by_query(rows):
+            computed[pairs] = np.isin(cols[pairs], index.candidates(content[rows[pairs[0]]], min_score))
+    scorer = LevenshteinScorer(content, len_threshold)
+    scores[computed] = scorer.scores(content, rows[computed], cols[computed])
+    return scores
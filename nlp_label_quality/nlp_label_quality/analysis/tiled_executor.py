@@ -0,0 +1,226 @@
+"""
+Tiled execution of similarity matrices in worker processes
+
+The pairwise matrix of an attribute is split into row/column tiles that are computed by a ProcessPoolExecutor. Every
+worker loads the models once in its initializer and keeps them for all following tiles; only the content of the rows
+and columns of a tile is sent to the worker. The blocks are assembled into the final matrix in the main process.
+Workers are spawned (not forked from the GUI process) and receive the session subset of the GloVe vectors instead of
+loading the whole model file, so each worker only holds the vectors the analysis uses.
+"""
+from nlp_label_quality.analysis import sim_utils
+from nlp_label_quality.analysis.matrix_storage import Matrix, Writer, new_writer
+from nlp_label_quality.analysis.nlp_models import Model, GloVeModel, SpaCyModel
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Tuple, Union
+import multiprocessing
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# models of a worker process, loaded once by _initialize_worker
+_worker_models: Dict[str, Model] = {}
+
+
+def get_model_spec(model: Union[GloVeModel, SpaCyModel]) -> Tuple[Callable[..., Model], Dict[str, Any]]:
+    """
+    Return the class and the keyword arguments that rebuild a model with the same configuration in a worker
+    -> a GloVe model restricted to the session vocabulary is rebuilt from the subset vectors (no model file is loaded)
+
+    Parameters
+    ----------
+    model
+        model of the main process
+
+    Returns
+    -------
+    model_spec
+        (model class or factory, keyword arguments), both can be pickled
+    """
+    if isinstance(model, SpaCyModel):
+        return SpaCyModel, {'name': model.name, 'model_file': model.model_file, 'quantization': model.quantization,
+                            'batch_size': model.batch_size, 'n_process': 1, 'profile': model.components}
+    if isinstance(model, GloVeModel) and model.subset_model is not None:
+        words, vectors = model.get_subset_vectors()  # quantized subsets give the same codes when quantized again
+        return GloVeModel.from_vectors, {'words': words, 'vectors': vectors, 'name': model.name,
+                                         'quantization': model.quantization}
+    if isinstance(model, GloVeModel):
+        return GloVeModel, {'name': model.name, 'model_file': model.model_file, 'use_store': model.use_store,
+                            'quantization': model.quantization}
+    raise TypeError(f'No worker specification for {type(model).__name__}')
+
+
+def _initialize_worker(model_specs: Dict[str, Tuple[Callable[..., Model], Dict[str, Any]]]) -> None:
+    tic = time.perf_counter()
+    for name, (model_class, kwargs) in model_specs.items():
+        _worker_models[name] = model_class(**kwargs)
+    toc = time.perf_counter()
+    logger.info(f'Worker {os.getpid()} loaded {list(model_specs)} in {toc - tic:0.4f} seconds')
+
+
+def _compute_tile(model_name: Union[None, str],
+                  function: str,
+                  row_content: List[Any],
+                  col_content: List[Any],
+                  min_score: float = None) -> np.ndarray:
+    """
+    Similarity scores of row_content (queries) against col_content inside a worker
+
+    Parameters
+    ----------
+    model_name
+        name of a worker model, None for levenshtein similarity (no model needed)
+    function
+        name of the similarity function of the model
+    row_content
+        content of the rows of the tile
+    col_content
+        content of the columns of the tile
+    min_score
+        levenshtein only, pairs that cannot exceed it are pruned by q-gram blocking
+
+    Returns
+    -------
+    block
+        scores of shape (len(row_content), len(col_content))
+    """
+    if model_name is None:
+        return sim_utils.calc_levenshtein_block(row_content, col_content, min_score)
+    model = _worker_models[model_name]
+    engine = sim_utils._check_matrix_engine(model, function, row_content + col_content)
+    if engine is not None:
+        return engine.block(slice(0, len(row_content)), slice(len(row_content), len(row_content) + len(col_content)))
+    func_vec = sim_utils._check_function(model, function)
+    return np.asarray([sim_utils.abstract_calc_sim(query, col_content, func_vec) for query in row_content],
+                      dtype=np.float64).reshape(len(row_content), len(col_content))
+
+
+class TiledExecutor:
+    """
+    TiledExecutor computes similarity matrices tile by tile in a pool of worker processes
+
+    Parameters
+    ----------
+    models
+        {model name: model} of the session, the workers load them once as given by get_model_spec when the pool is
+        started; the pool is restarted if the session subset or the quantization of a model changed since
+    max_workers
+        number of worker processes, None uses all cores
+    tile_size
+        number of rows and columns per tile
+    min_size
+        matrices with fewer values are computed in the main process, the pool would not pay off
+    """
+
+    def __init__(self,
+                 models: Dict[str, Model],
+                 max_workers: int = None,
+                 tile_size: int = 256,
+                 min_size: int = 1000) -> None:
+        self.models = models
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.tile_size = tile_size
+        self.min_size = min_size
+        self._pool = None
+        self._pool_state = None
+
+    def should_tile(self, size: int) -> bool:
+        return self.max_workers > 1 and size >= self.min_size
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """
+        Start the worker processes on first use, they are reused for all following matrices as long as the models
+        keep their vectors
+        """
+        state = self._model_state()
+        if self._pool is not None and not self._same_state(state):
+            logger.info('Session vectors changed, worker processes are restarted')
+            self.shutdown()
+        if self._pool is None:
+            model_specs = {name: get_model_spec(model) for name, model in self.models.items()}
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_initialize_worker, initargs=(model_specs,))
+            self._pool_state = state
+            logger.info(f'Started {self.max_workers} worker processes for tiled similarity matrices')
+        return self._pool
+
+    def _model_state(self) -> List[Tuple[str, Any, Any]]:
+        return [(name, model.quantization, getattr(model, 'subset_model', None)) for name, model in self.models.items()]
+
+    def _same_state(self, state: List[Tuple[str, Any, Any]]) -> bool:
+        # subsets are compared by identity, restrict_to_vocabulary always builds a new one
+        return all(name == pool_name and quantization == pool_quantization and subset is pool_subset
+                   for (name, quantization, subset), (pool_name, pool_quantization, pool_subset)
+                   in zip(state, self._pool_state))
+
+    def compute(self,
+                name: str,
+                content: List[Any],
+                model_name: Union[None, str],
+                function: str,
+                symmetric: bool = True,
+                full: bool = False,
+                min_score: float = None,
+                writer: Writer = None) -> Matrix:
+        """
+        Compute a similarity matrix from tiles, for symmetric functions or if full is not set only the tiles of the
+        upper triangle are computed; every tile is passed to the writer as soon as it is done
+
+        Parameters
+        ----------
+        name
+            name of matrix (logging purposes)
+        content
+            content to compare similarity for
+        model_name
+            worker model that provides the function, None for levenshtein similarity
+        function
+            name of the similarity function
+        symmetric
+            mirror the upper triangle to the lower one
+        full
+            compute all tiles of asymmetric functions
+        min_score
+            threshold for q-gram blocking of levenshtein tiles
+        writer
+            assembles the tiles (e.g. SparseWriter keeps the scores above its floor only), dense matrix if None
+
+        Returns
+        -------
+        sim_matrix
+            result of the writer
+        """
+        tic = time.perf_counter()
+        size = len(content)
+        upper = symmetric or not full
+        if writer is None:
+            writer = new_writer(size, symmetric, upper)
+        pool = self._get_pool()
+        futures = {}
+        for row_start in range(0, size, self.tile_size):
+            row_stop = min(row_start + self.tile_size, size)
+            for col_start in range(row_start if upper else 0, size, self.tile_size):
+                col_stop = min(col_start + self.tile_size, size)
+                future = pool.submit(_compute_tile, model_name, function,
+                                     content[row_start:row_stop], content[col_start:col_stop], min_score)
+                futures[future] = (slice(row_start, row_stop), slice(col_start, col_stop))
+        n_tiles = len(futures)
+        for future in as_completed(futures):
+            rows, cols = futures.pop(future)  # blocks are released once they are written
+            writer.write_block(rows, cols, future.result())
+        sim_matrix = writer.result()
+        toc = time.perf_counter()
+        logger.info(f'SimilarityMatrix {name} has been calculated from {n_tiles} tiles with {self.max_workers} '
+                    f'workers in {toc - tic} seconds')
+        return sim_matrix
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            self._pool_state = None
@@ -4,6 +4,8 @@ from nlp_label_quality.model.model import Model
 from nlp_label_quality.view.view import View
 from nlp_label_quality.analysis.analysis import AnalysisModule
 from nlp_label_quality.analysis.nlp_models import GloVeModel, SpaCyModel
+from nlp_label_quality.analysis.resource_manager import ResourceManager, get_default_loaders
+from nlp_label_quality.analysis.session import AnalysisSession
 from nlp_label_quality.view.tkinter_elements.frames import *
 
 from typing import ClassVar
@@ -44,7 +46,12 @@ class TkEventController(Controller):
         analysis module (TODO should be made modular for different interactive analysis modules)
     nlp
 
+    resources
+        background loading of all NLP resources, started together with the application
+    session
+        analysis session of the loaded models (worker processes for tiled similarity matrices)
     """
+    _resource_poll_ms: ClassVar[int] = 500
 
     def __init__(self, model: Model, view: View) -> None:
         self.model = model
@@ -53,10 +60,17 @@ class TkEventController(Controller):
         self.analysis = None
         self.nlp = None
         self.glove = None
+        self.session = None
+        self.resources = ResourceManager(get_default_loaders(self.model.analysis_options, self.model.spacy_processes))
+        self._resource_poll = None
 
     def start(self):
+        self.resources.start()  # models load while the user imports the log and selects attributes
         self.view.setup(self)
+        self._poll_resources()
         self.view.start_main_loop()  # main function that keeps the frontend running and reactive
+        if self.session is not None:
+            self.session.close()  # stop worker processes after the window was closed
 
     def handle_click_restart(self):
         self.view.root.destroy()
@@ -69,9 +83,26 @@ class TkEventController(Controller):
         self._import_file()
 
     def handle_click_start_analysis(self):
+        errors = self.resources.get_errors()
+        if errors:  # report the failed resources and load them again, the analysis can be started once they are ready
+            failed = '; '.join(f'{name}: {error}' for name, error in errors.items())
+            self.frame.update_statusbar(f'NLP resources could not be loaded ({failed}), loading is retried - '
+                                        f'start the analysis again')
+            self.frame.update_button('start_analysis_container', 'start_analysis_button', 'normal')
+            self.resources.retry(list(errors))
+            if self._resource_poll is None:
+                self._poll_resources()
+            return
+        if not self.resources.all_ready():  # check again later instead of blocking the tkinter loop
+            ready, total = self.resources.get_progress()
+            self.frame.update_statusbar(f'Analysis starts as soon as all NLP resources are loaded ({ready}/{total}) ...')
+            self.frame.update_button('start_analysis_container', 'start_analysis_button', 'disabled')
+            self.view.root.after(self._resource_poll_ms, self.handle_click_start_analysis)
+            return
         self.frame.update_statusbar('Please wait until analysis has finished ...')
         self.model.insert_eval_labels()
         self._setup_models()  # one time setup for NLP models
+        self._restrict_embeddings()
         self.run_next_analysis()
 
     def handle_click_run_repair(self):
@@ -96,7 +127,8 @@ class TkEventController(Controller):
             self.model.reset_repair_data()
             self.analysis = AnalysisModule(str(option_index), self, self.nlp, self.glove,
                                               self.model.analysis_options[option_index],
-                                              self.model.analysis_thresholds[option_index])
+                                              self.model.analysis_thresholds[option_index],
+                                              self.session)
 
             self.model.repair_dict = self.analysis.start(self.model.attribute_content)
             self.view.root.switch_frame(RepairSelectFrame)
@@ -109,6 +141,7 @@ class TkEventController(Controller):
 
     def _update_log(self):
         self.model.repair_log()
+        self._restrict_embeddings()
         self.frame.update_button('treeview_selection', 'export_button', 'normal')
         self.frame.update_button('treeview_selection', 'run_analysis_button', 'normal')
 
@@ -132,6 +165,11 @@ class TkEventController(Controller):
                                                      filetypes=(("eventlog files", "*.xes"), ("all files",
                                                                                               ".*")))  # no csv at the moment("eventlog files", "*.csv")
         if import_filename:
+            self.resources.start()
+            if self.nlp is not None:
+                self.nlp.clear_doc_vectors()  # cached document vectors belong to the previous log
+            if self.session is not None:
+                self.session.reset_log()  # kept Attributes and memoized scores belong to the previous log
             self.model.filename = import_filename
             self.frame.update_information_container(self.model.filename)
             self.model.import_log()
@@ -152,20 +190,54 @@ class TkEventController(Controller):
     def _setup_models(self):
         if not self.model.models_loaded:
             tic = time.perf_counter()
-            self.nlp = SpaCyModel('spacy')
-            self.glove = GloVeModel('glove')
+            self.nlp = self.resources.result('spacy')
+            self.glove = self.resources.result('glove')
+            self.session = AnalysisSession(self.nlp, self.glove, self.model.matrix_workers,
+                                           self.model.matrix_tile_size, memo_pairs=self.model.score_memo_pairs,
+                                           incremental=self.model.incremental_analysis,
+                                           sparse_results=self.model.sparse_results,
+                                           matrix_dtype=self.model.matrix_dtype,
+                                           packed_matrices=self.model.packed_matrices,
+                                           fused_max=self.model.fused_max_matrix,
+                                           scratch_dir=self.model.matrix_scratch_dir,
+                                           memmap_min_size=self.model.memmap_min_size,
+                                           dedupe_content=self.model.dedupe_content)
             self.model.models_loaded = True
             toc = time.perf_counter()
             logger.info(f'Models setup in {toc - tic} seconds')
         else:
             pass
 
+    def _restrict_embeddings(self):
+        """
+        Session mode: after preprocessing only the embeddings of tokens from the selected attributes stay active
+        """
+        if self.model.prune_embeddings and self.glove is not None:
+            self.glove.restrict_to_vocabulary(self.model.get_session_vocabulary(), self.model.prune_neighbours)
+
+    def _poll_resources(self):
+        """
+        Show the loading progress of the background resources until all of them are available
+        """
+        if self.frame is not None:
+            self.frame.update_resource_statusbar(self.resources.get_status())
+        if not self.resources.all_ready():
+            self._resource_poll = self.view.root.after(self._resource_poll_ms, self._poll_resources)
+        else:
+            self._resource_poll = None
+
     def get_filename(self):
         return self.model.filename
 
     def get_treeview_headers(self):
         return self.model.treeview_headers
 
+    def get_antonym_library(self):
+        return self.resources.result('verbocean')
+
+    def get_resource_status(self):
+        return self.resources.get_status()
+
     def get_analysis_step(self):
         step = self.model.analysis_step
         total_steps = len(self.model.analysis_options)
@@ -3,8 +3,9 @@ from pm4py.algo.filtering.log.attributes import attributes_filter
 
 from nlp_label_quality.model import repair, file_utils
 from nlp_label_quality.analysis.attribute_value import Attribute
+from nlp_label_quality.analysis.label_utils import preprocess_value
 
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Set
 
 from abc import ABC, abstractmethod
 from os import path
@@ -50,6 +51,32 @@ class TkDataModel(Model):
         self.models_loaded = False
         self.nlp = None
         self.glove = None
+        # session mode: embeddings are restricted to the tokens of the selected attributes (+ top-N neighbours)
+        self.prune_embeddings = True
+        self.prune_neighbours = 0
+        # tiled similarity matrices: worker processes (None = all cores, 1 = main process only) and tile size
+        # -> every worker holds its own copy of the spaCy model and the session GloVe vectors
+        self.matrix_workers = 1
+        self.matrix_tile_size = 256
+        # processes of spaCy's nlp.pipe when documents are parsed (1 = main process only, -1 = all cores)
+        self.spacy_processes = 1
+        # scores of label pairs shared by all analysis steps (max. stored pairs, 0 = disabled); larger matrices skip it
+        self.score_memo_pairs = 1000000
+        # keep Attributes and matrices between the analysis steps, after a repair only the changes are computed
+        self.incremental_analysis = True
+        # similarity matrices only keep the scores above the threshold of their step (memory ~ candidates, not n^2)
+        self.sparse_results = True
+        # storage of dense matrices: dtype of the scores ('float32' or 'float16') and packed upper triangle
+        self.matrix_dtype = 'float32'
+        self.packed_matrices = False
+        # combined steps keep only the running maximum of their options and the option scoring it
+        self.fused_max_matrix = True
+        # dense matrices of attributes with at least memmap_min_size values are memory-mapped to files in the scratch
+        # directory instead of being held in memory (None keeps all matrices in memory)
+        self.matrix_scratch_dir = None
+        self.memmap_min_size = 20000
+        # values whose analysed content is identical are scored once (symmetric pair-local similarities)
+        self.dedupe_content = True
         # log data to analyse
         self._filename = ''
         # noinspection PyTypeChecker
@@ -82,6 +109,7 @@ class TkDataModel(Model):
         # other working options
         # [['leven', 'grammar', 'processed_value', '_'],  # ideal threshold at 0.3 for first test
         #  ['leven', 'grammar_v2', 'processed_value', '_'],
+        #  ['minhash', 'grammar_minhash', 'processed_value', '_'],  # jaccard of shingles, large attributes
         #  [['open', 'test_gl_list_logging', 'glove_tokens', 'test_calc_list_combine_logging'],
         #   ['spacy', 'test_sp_list_logging', 'spacy_lemmas', 'test_calc_list_combine_logging'],
         #   ['open', 'sem_dif_tokens_glove', 'glove_tokens', 'calc_similarity_difference_list'],
@@ -146,6 +174,16 @@ class TkDataModel(Model):
         self._read_attribute_content()
         self._filter_events_and_attribute_content()
 
+    def get_session_vocabulary(self) -> Set[str]:
+        """
+        Return all tokens that appear in the preprocessed values of the selected attributes
+        """
+        vocabulary = set()
+        for values in self.attribute_content.values():
+            for value in values.keys():
+                vocabulary.update(preprocess_value(value).split())
+        return vocabulary
+
     @property
     def analysis_step(self):
         return self._analysis_step
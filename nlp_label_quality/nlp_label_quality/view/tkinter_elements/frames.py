@@ -16,6 +16,9 @@ class WindowFrame(tk.Frame, ABC):
         self.controller = controller
         self._setup_frame()
         self._orient_frame()
+        self.resource_statusbar = tk.Label(self, bd=2, relief='ridge', anchor='sw', bg='gray', fg='white')
+        self.update_resource_statusbar(self.controller.get_resource_status())
+        self.resource_statusbar.pack(side='bottom', anchor='sw', fill='x')
         self.statusbar.pack(side='bottom', anchor='sw', fill='x')
 
     @abstractmethod
@@ -35,6 +38,9 @@ class WindowFrame(tk.Frame, ABC):
     def update_statusbar(self, status):
         self.statusbar.config(text=status)
 
+    def update_resource_statusbar(self, status):
+        self.resource_statusbar.config(text=status)
+
 
 class StartFrame(WindowFrame):
     def __init__(self, master, controller):